@@ -0,0 +1,258 @@
+import os
+import json
+
+import cv2
+import numpy as np
+
+"""
+Packed dataset: all the labeled images in one file, the labels in another one.
+A folder contains :
+    - images.bin : the grayscale images one after the other (uint8, no header)
+    - labels.bin : one LABEL_DTYPE record per image
+    - meta.json : the dimension of the images and the format version
+Both binary files are memory-mapped with Numpy, loading the dataset reads nothing.
+
+Convert a folder of PNG saved by labeling.py, for instance :
+    python labeling/dataset.py data/datasetv3/ data/datasetv3_packed/
+"""
+
+IMAGES_FILE = "images.bin"
+LABELS_FILE = "labels.bin"
+META_FILE = "meta.json"
+
+# Half of the camera frame (456, 228), in Numpy order
+IMAGE_SHAPE = (114, 228)
+
+# The labels given in labeling.py
+# theta : the direction (between -1 and 1)
+# norm : the speed (between 0 and 1)
+# frame : the number of the frame in the video
+# prefix : the random string of the labeling session
+LABEL_DTYPE = np.dtype([
+    ("theta", "<f4"),
+    ("norm", "<f4"),
+    ("frame", "<i4"),
+    ("prefix", "S8"),
+])
+
+
+def get_labels(name):
+    """
+    Dataset labels are contained in the name of the files.
+
+    bhz_frame12_0.079_0.982.png
+    -> direction: 0.079
+    -> speed: 0,964
+
+    @param name: the filename of the image
+    @return direction: the direction value (float between -1 & 1)
+    @return speed: the speed value (float between -1 & 1)
+    """
+    labels = name.split("_")
+
+    direction = float(labels[2])
+    if direction < -1:
+        direction = -1
+    elif direction > 1:
+        direction = 1
+
+    speed =  float(labels[3][:-4])
+    speed *= 2
+    speed -= 1
+    if speed < -1:
+        speed = -1
+    elif speed > 1:
+        speed = 1
+
+    return direction, speed
+
+
+def parse_name(name):
+    """
+    Read all the fields of a filename saved by labeling.py
+
+    bhz_frame12_0.079_0.982.png -> ("bhz", 12, 0.079, 0.982)
+
+    @param name: the filename of the image
+    @return: tuple (prefix, frame, theta, norm)
+    """
+    prefix, frame, theta, norm = name[:-4].split("_")
+    return prefix, int(frame[len("frame"):]), float(theta), float(norm)
+
+
+def targets(labels):
+    """
+    The outputs of the CNN computed from the labels, like get_labels
+
+    @param labels: Numpy array of LABEL_DTYPE records
+    @return: float32 Numpy array of dimension (n, 2): direction and speed between -1 and 1
+    """
+    y = np.empty((len(labels), 2), np.float32)
+    np.clip(labels["theta"], -1, 1, out=y[:, 0])
+    np.clip(labels["norm"]*2 - 1, -1, 1, out=y[:, 1])
+    return y
+
+
+def is_packed(folder):
+    """
+    @param folder: string path to a folder
+    @return: True if the folder contains a packed dataset
+    """
+    return os.path.exists(os.path.join(folder, META_FILE))
+
+
+def load(folder, writable=False):
+    """
+    Memory-map a packed dataset
+
+    @param folder: string path to the packed dataset
+    @param writable: if True, the modifications of the arrays are saved in the files
+    @return images: uint8 Numpy array of dimension (n, 114, 228)
+    @return labels: Numpy array of n LABEL_DTYPE records
+    """
+    with open(os.path.join(folder, META_FILE)) as f:
+        meta = json.load(f)
+    shape = tuple(meta["shape"])
+    count = _count(folder, shape)
+
+    mode = "r+" if writable else "r"
+    if count == 0:
+        return np.empty((0,) + shape, np.uint8), np.empty(0, LABEL_DTYPE)
+
+    images = np.memmap(os.path.join(folder, IMAGES_FILE), np.uint8, mode, shape=(count,) + shape)
+    labels = np.memmap(os.path.join(folder, LABELS_FILE), LABEL_DTYPE, mode, shape=(count,))
+    return images, labels
+
+
+def _count(folder, shape):
+    """
+    Number of complete images, a write interrupted during an append is ignored
+
+    @param folder: string path to the packed dataset
+    @param shape: dimension of one image
+    @return: the number of images
+    """
+    image_size = int(np.prod(shape))
+    nb_images = os.path.getsize(os.path.join(folder, IMAGES_FILE)) // image_size
+    nb_labels = os.path.getsize(os.path.join(folder, LABELS_FILE)) // LABEL_DTYPE.itemsize
+    return min(nb_images, nb_labels)
+
+
+class PackedWriter:
+    """
+    Append images and their labels to a packed dataset, the dataset is created if needed.
+
+    Each append is written at the end of the files right away,
+    so the dataset can be loaded while the labeling goes on.
+    The last images can be removed (undo).
+    """
+    def __init__(self, folder, shape=IMAGE_SHAPE):
+        """
+        Open or create the dataset
+
+        @param folder: string path to the packed dataset
+        @param shape: dimension of the images, used only for a new dataset
+        """
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        self.folder = folder
+
+        meta_path = os.path.join(folder, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                shape = tuple(json.load(f)["shape"])
+        else:
+            with open(meta_path, "w") as f:
+                json.dump({"version": 1, "shape": list(shape), "labels": LABEL_DTYPE.descr}, f)
+        self.shape = tuple(shape)
+
+        self.images = open(os.path.join(folder, IMAGES_FILE), "ab")
+        self.labels = open(os.path.join(folder, LABELS_FILE), "ab")
+
+        # Remove the end of an interrupted append
+        self.count = _count(folder, self.shape)
+        self._truncate(self.count)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, image, theta, norm, frame=0, prefix=""):
+        """
+        Add an image at the end of the dataset
+
+        @param image: uint8 grayscale image of dimension shape
+        @param theta: the direction (value between -1 and 1)
+        @param norm: the speed (value between 0 and 1)
+        @param frame: the number of the frame in the video
+        @param prefix: the name of the labeling session
+        """
+        if image.shape != self.shape or image.dtype != np.uint8:
+            raise ValueError("uint8 image of dimension {} expected, got {} {}".format(
+                self.shape, image.dtype, image.shape))
+
+        record = np.array([(theta, norm, frame, prefix.encode("ascii"))], LABEL_DTYPE)
+        self.images.write(np.ascontiguousarray(image).tobytes())
+        self.labels.write(record.tobytes())
+        self.images.flush()
+        self.labels.flush()
+        self.count += 1
+
+    def pop(self, n=1):
+        """
+        Remove the last images
+
+        @param n: number of images to remove
+        """
+        self._truncate(max(self.count - n, 0))
+
+    def _truncate(self, count):
+        """
+        Keep the first images
+
+        @param count: the number of images kept
+        """
+        self.images.truncate(count * int(np.prod(self.shape)))
+        self.labels.truncate(count * LABEL_DTYPE.itemsize)
+        self.count = count
+
+    def close(self):
+        """
+        Close the files
+        """
+        self.images.close()
+        self.labels.close()
+
+
+def convert_folder(folder, output):
+    """
+    Pack a folder of PNG saved by labeling.py, the images are sorted by name.
+    If the output already exists, the images are appended.
+
+    @param folder: string path to the folder of labeled PNG
+    @param output: string path to the packed dataset
+    @return: the number of images in the packed dataset
+    """
+    names = sorted(name for name in os.listdir(folder) if ".png" in name)
+
+    writer = PackedWriter(output)
+    for name in names:
+        image = cv2.imread(os.path.join(folder, name), cv2.IMREAD_GRAYSCALE)
+        prefix, frame, theta, norm = parse_name(name)
+        writer.append(image, theta, norm, frame, prefix)
+    writer.close()
+
+    return len(writer)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="path to the folder of labeled PNG")
+    parser.add_argument("output", help="path to the packed dataset")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = convert_folder(args.folder, args.output)
+    print("{} images packed in {:.1f} s".format(count, time.perf_counter() - start))
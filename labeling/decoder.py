@@ -0,0 +1,203 @@
+import threading
+from threading import Thread
+from collections import deque
+
+import cv2
+
+"""
+Decoding of the video in a background thread for labeling.py:
+the next frames are ready when the labeler clicks.
+"""
+
+class VideoDecoder:
+    """
+    A thread reads and formats the frames of a video in a ring buffer.
+
+    The buffer keeps up to "ahead" frames not read yet,
+    and the "behind" last frames read (get them with the get method).
+    The frames are identified by their position in the video.
+    Only the thread of the decoder uses the cv2.VideoCapture.
+    """
+    def __init__(self, videopath, transform=None, ahead=32, behind=8):
+        """
+        Open the video
+
+        @param videopath: string path to a video
+        @param transform: function applied to each frame by the thread, None to keep the frame
+        @param ahead: number of frames decoded in advance
+        @param behind: number of frames kept after being read
+        """
+        self.cap = cv2.VideoCapture(videopath)
+        if (self.cap.isOpened()== False):
+            print("Error opening video stream or file")
+
+        self.transform = transform
+        self.ahead = ahead
+        self.behind = behind
+
+        # (position, formatted frame), in the order of the video
+        self.entries = deque()
+        # Position of the next frame decoded
+        self.next_position = 0
+        # Position of the next frame returned by read
+        self.read_position = 0
+        self.finished = False
+        # Position asked by seek, applied by the thread
+        self.seek_to = None
+
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the decoding thread
+
+        @return: self
+        """
+        self.running = True
+        self.thread = Thread(target=self._decode_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the thread and close the video
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.cap.release()
+
+    def _decode_loop(self):
+        """
+        Loop of the decoding thread
+        """
+        while True:
+            with self.condition:
+                while self.running and self.seek_to is None and (
+                        self.finished or self.next_position - self.read_position >= self.ahead):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                if self.seek_to is not None:
+                    self._seek(self.seek_to)
+                    self.condition.notify_all()
+                    continue
+                position = self.next_position
+
+            # Decoded without the lock, read and get are not blocked
+            ret, frame = self.cap.read()
+            if ret and self.transform is not None:
+                frame = self.transform(frame)
+
+            with self.condition:
+                # A seek was asked during the decoding, this frame is not needed
+                if self.seek_to is not None:
+                    continue
+                if not ret:
+                    self.finished = True
+                else:
+                    self.entries.append((position, frame))
+                    self.next_position += 1
+                    self._drop_old()
+                self.condition.notify_all()
+
+    def _seek(self, position):
+        """
+        Move to a frame of the video, called with the lock by the thread.
+        The container is seeked, the frames are read and dropped only if the seek fails.
+
+        @param position: position of the next frame to decode
+        """
+        if not self.cap.set(cv2.CAP_PROP_POS_FRAMES, position) \
+                or int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)) != position:
+            current = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+            if current > position:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                current = 0
+            for _ in range(position - current):
+                if not self.cap.grab():
+                    break
+
+        self.entries.clear()
+        self.next_position = self.read_position = position
+        self.finished = False
+        self.seek_to = None
+
+    def _drop_old(self):
+        """
+        Remove the frames older than "behind" frames before the read position
+        """
+        while self.entries and self.entries[0][0] < self.read_position - self.behind:
+            self.entries.popleft()
+
+    def seek(self, position):
+        """
+        Move to a frame of the video, the buffer is emptied
+
+        @param position: position of the next frame returned by read
+        @return: bool indicate if the video is not finished
+        """
+        with self.condition:
+            if self.thread is None:
+                self._seek(position)
+            else:
+                self.seek_to = position
+                self.condition.notify_all()
+                while self.seek_to is not None:
+                    self.condition.wait()
+
+        return self.peek() is not None
+
+    def peek(self):
+        """
+        Wait for the next frame without reading it
+
+        @return: the formatted frame, None if the video is finished
+        """
+        with self.condition:
+            while not self._available() and not (self.finished or self.thread is None):
+                self.condition.wait()
+            if not self._available():
+                return None
+            return self.get(self.read_position)
+
+    def _available(self):
+        """
+        @return: True if the frame at the read position is decoded
+        """
+        return self.next_position > self.read_position
+
+    def read(self):
+        """
+        Get the next frame, wait for it if it isn't decoded yet
+
+        @return: the formatted frame, None if the video is finished
+        """
+        with self.condition:
+            entry = self.peek()
+            if entry is not None:
+                self.read_position += 1
+                self._drop_old()
+                # The thread can decode one more frame
+                self.condition.notify_all()
+            return entry
+
+    def get(self, position):
+        """
+        Get a frame kept in the buffer
+
+        @param position: position of the frame in the video
+        @return: the formatted frame, None if it isn't in the buffer
+        """
+        with self.condition:
+            if not self.entries:
+                return None
+            i = position - self.entries[0][0]
+            if 0 <= i < len(self.entries):
+                return self.entries[i][1]
+            return None
@@ -0,0 +1,175 @@
+import os
+
+import cv2
+import numpy as np
+
+import dataset
+
+"""
+Detection of the near-duplicate frames: consecutive frames of the 30 fps camera
+are almost the same, labeling or training on all of them is useless.
+
+Each frame is reduced to a signature: the grayscale image downsampled to 16x8 pixels.
+A frame is a near duplicate when the mean absolute difference between its signature
+and the one of the last frame kept is below a threshold (in gray levels, between 0 and 255).
+
+Count the frames kept for a few thresholds, for instance :
+    python labeling/dedup.py data/videos/move_by_hand1.mp4 --thresholds 2 4 8
+    python labeling/dedup.py data/datasetv3_packed/ --thresholds 2 4 8
+"""
+
+SIGNATURE_SIZE = (16, 8)
+DEFAULT_THRESHOLD = 2.0
+
+
+def signature(image, size=SIGNATURE_SIZE):
+    """
+    @param image: an OpenCV image, BGR or grayscale
+    @param size: (width, height) of the signature
+    @return: float32 Numpy array of dimension (height*width,)
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return small.reshape(-1).astype(np.float32)
+
+
+def difference(a, b):
+    """
+    @param a: a signature
+    @param b: a signature
+    @return: mean absolute difference between them
+    """
+    return float(np.abs(a - b).mean())
+
+
+class DuplicateFilter:
+    """
+    Compare each frame of a stream with the last frame kept
+    """
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        """
+        Attribute initialization
+
+        @param threshold: maximum difference of a near duplicate
+        """
+        self.threshold = threshold
+        self.last = None
+        self.nb_skipped = 0
+
+    def is_duplicate(self, image):
+        """
+        A kept frame becomes the reference of the next ones
+
+        @param image: an OpenCV image, BGR or grayscale
+        @return: True if the frame is a near duplicate of the last frame kept
+        """
+        current = signature(image)
+        if self.last is not None and difference(current, self.last) < self.threshold:
+            self.nb_skipped += 1
+            return True
+        self.last = current
+        return False
+
+
+def select(signatures, threshold=DEFAULT_THRESHOLD, sessions=None):
+    """
+    Choose the frames to keep in a sequence of signatures
+
+    @param signatures: Numpy array of dimension (n, size), in the order of the video
+    @param threshold: maximum difference of a near duplicate
+    @param sessions: Numpy array of n ids, the comparison restarts when the id changes
+    @return: bool Numpy array of dimension (n,), True for the frames kept
+    """
+    keep = np.zeros(len(signatures), bool)
+    last = None
+    for i, current in enumerate(signatures):
+        if sessions is not None and i > 0 and sessions[i] != sessions[i-1]:
+            last = None
+        if last is None or np.abs(current - last).mean() >= threshold:
+            keep[i] = True
+            last = current
+    return keep
+
+
+def index_video(videopath, size=SIGNATURE_SIZE):
+    """
+    Compute the signatures of all the frames of a video
+
+    @param videopath: string path to a video
+    @param size: (width, height) of the signatures
+    @return: float32 Numpy array of dimension (n, height*width)
+    """
+    cap = cv2.VideoCapture(videopath)
+    if (cap.isOpened()== False):
+        print("Error opening video stream or file")
+
+    signatures = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        signatures.append(signature(frame, size))
+    cap.release()
+
+    return np.array(signatures, np.float32).reshape(-1, size[0]*size[1])
+
+
+def dataset_order(source):
+    """
+    The order of the frames in the labeling sessions of a dataset.
+    The names of the PNG are sorted by session and frame number (not alphabetically)
+
+    @param source: string path to a folder of labeled PNG or to a packed dataset
+    @return items: list of PNG paths or indexes in the packed dataset, in the order of the sessions
+    @return sessions: list of the session of each item
+    """
+    if dataset.is_packed(source):
+        _, labels = dataset.load(source)
+        order = np.lexsort((labels["frame"], labels["prefix"]))
+        return [int(i) for i in order], [labels["prefix"][i] for i in order]
+
+    names = [name for name in os.listdir(source) if ".png" in name]
+    names.sort(key=lambda name: dataset.parse_name(name)[:2])
+    return [os.path.join(source, name) for name in names], [dataset.parse_name(name)[0] for name in names]
+
+
+def index_dataset(source, size=SIGNATURE_SIZE):
+    """
+    Compute the signatures of all the images of a dataset, in the order of the sessions
+
+    @param source: string path to a folder of labeled PNG or to a packed dataset
+    @param size: (width, height) of the signatures
+    @return items: list of PNG paths or indexes in the packed dataset
+    @return sessions: list of the session of each item
+    @return signatures: float32 Numpy array of dimension (n, height*width)
+    """
+    items, sessions = dataset_order(source)
+    if dataset.is_packed(source):
+        images, _ = dataset.load(source)
+        read = lambda item: images[item]
+    else:
+        read = lambda item: cv2.imread(item, cv2.IMREAD_GRAYSCALE)
+
+    signatures = np.array([signature(read(item), size) for item in items], np.float32)
+    return items, sessions, signatures.reshape(-1, size[0]*size[1])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="path to a video, a folder of labeled PNG or a packed dataset")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[DEFAULT_THRESHOLD],
+                        help="maximum differences of a near duplicate")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        _, sessions, signatures = index_dataset(args.source)
+    else:
+        sessions, signatures = None, index_video(args.source)
+
+    for threshold in args.thresholds:
+        keep = select(signatures, threshold, sessions)
+        print("threshold {:5.1f} : {} frames kept on {} ({:.0f}%)".format(
+            threshold, keep.sum(), len(keep), 100 * keep.mean() if len(keep) else 0))
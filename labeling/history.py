@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+"""
+Compact storage of the frames shown by labeling.py, used by the undo/redo history.
+"""
+
+class FrameStore:
+    """
+    The half size grayscale frames, identified by their number.
+
+    The total size is limited: when it is exceeded, the oldest frames are removed,
+    whatever the depth of the history.
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        """
+        Attribute initialization
+
+        @param max_bytes: maximum size of the frames kept
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # number -> Numpy image, the oldest first
+        self.frames = OrderedDict()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, number):
+        return number in self.frames
+
+    def put(self, number, frame):
+        """
+        Keep a frame, it becomes the newest one
+
+        @param number: the number of the frame
+        @param frame: a Numpy image
+        """
+        old = self.frames.pop(number, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.frames[number] = frame
+        self.nbytes += frame.nbytes
+
+        while self.nbytes > self.max_bytes and len(self.frames) > 1:
+            _, removed = self.frames.popitem(last=False)
+            self.nbytes -= removed.nbytes
+
+    def get(self, number):
+        """
+        @param number: the number of the frame
+        @return: the Numpy image, None if it isn't kept
+        """
+        return self.frames.get(number)
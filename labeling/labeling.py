@@ -7,13 +7,22 @@ import cv2
 
 import string
 import random
-from math import atan
+from math import atan, sin, cos
 import colorsys
+from collections import deque
+
+from dataset import PackedWriter
+from decoder import VideoDecoder
+from writer import FrameWriter
+from history import FrameStore
+from prelabel import Prelabeler
+from dedup import DuplicateFilter
 
 letters = string.ascii_lowercase
 
 WHITE = (255, 255, 255)
 BLUE = (0, 0, 255)
+GREEN = (0, 255, 0)
 
 # input image dimensions
 WIDTH, HEIGHT = 456, 228
@@ -21,23 +30,32 @@ WIDTH, HEIGHT = 456, 228
 class ImageManagement:
     """
     The images are:
-        - loaded from a video
+        - loaded from a video, decoded in advance by a thread (see decoder.py)
         - transformed in pygame format
-        - saved with labels
-        
-    Moreover, there is undo feature.
-    3 attributes manage the undo :
-     - prev: the previous image (data)
-     - prev_name: the filename of the saved images
-     - keep: the buffer where the current image is stored 
-             when the previous image is load
+        - saved with labels, in PNG files or in a packed dataset (see dataset.py),
+          by the threads of a FrameWriter (see writer.py)
+        
+    Moreover, there is an undo/redo feature over several frames.
+    The frames are numbered in the order they are shown (i),
+    their half size grayscale images are kept in a FrameStore of limited size (see history.py)
+    and the images to display are computed again from them.
+    4 attributes manage the undo/redo :
+     - history: the labels of the last frames (number, ticket of the write, theta, norm)
+     - redo: the labels cancelled by the undo
+     - forward: the numbers of the frames to show again before the new frames of the video
+     - store: the grayscale images of the last frames
     """
-    def __init__(self, videopath, imagefolder):
+    def __init__(self, videopath, imagefolder, packed=False, history=100, max_bytes=64*1024*1024,
+                 skip_duplicates=None):
         """
         Open video, create random string for image names and init attributes
         
         @param videopath: string path to a video
         @param imagefolder: string path to the folder where the images will be saved
+        @param packed: if True, the images are appended to a packed dataset in imagefolder
+        @param history: maximum number of undo
+        @param max_bytes: maximum size of the images kept for the undo
+        @param skip_duplicates: if not None, the threshold of the near duplicates not shown (see dedup.py)
         """
         self.videopath = videopath
         
@@ -45,32 +63,38 @@ class ImageManagement:
             os.mkdir(imagefolder)
         self.imagefolder = imagefolder
         
-        self.cap = cv2.VideoCapture(videopath)
-        if (self.cap.isOpened()== False): 
-            print("Error opening video stream or file")
+        self.writer = FrameWriter(PackedWriter(imagefolder) if packed else None)
+        
+        # The frames are formatted by the thread of the decoder
+        self.decoder = VideoDecoder(videopath, self.format).start()
             
-        self.prev = None
-        self.prev_name = None
-        self.current = None
-        self.keep = None
+        self.store = FrameStore(max_bytes)
+        self.history = deque(maxlen=history)
+        self.redo = []
+        self.forward = []
         
+        # The number of the current frame and of the last frame read in the video
         self.i = 0
+        self.last = 0
+        # number of a frame -> its position in the video
+        self.positions = {}
+        
+        # Predictions of a model shown as suggestions (see start_prelabel)
+        self.prelabeler = None
+        
+        self.duplicates = None if skip_duplicates is None else DuplicateFilter(skip_duplicates)
         
         # add prefix for filename to prevent overwritting
         self.rd_s = ''.join(random.choice(letters) for i in range(5))
         
     def goto(self, num):
         """
-        Drop i frames from the video
+        Skip frames of the video by seeking in the container
         
         @param num: the number of frame to skip
         @return: bool indicate if the video is not finished
         """
-        for _ in range(num):
-            ret, _ = self.cap.read()
-            if not ret:
-                return False
-        return True
+        return self.decoder.seek(self.decoder.read_position + num)
             
     def format(self, frame):
         """
@@ -78,63 +102,108 @@ class ImageManagement:
          - image to save (frame)
          - image to display (image)
          
-        @param frame: an image rgb matrix
+        @param frame: an image BGR matrix
         @return: the gray reduce frame and the frame in pygame format
         """
-        frame_b = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        frame_b = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         frame_b = cv2.resize(
-            frame, (0,0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA
+            frame_b, (0,0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA
         )
         
         image = pygame.image.frombuffer(frame, frame.shape[1::-1], "RGB")
         image = pygame.transform.scale(image, (WIDTH*2, HEIGHT*2))
         
         return frame_b, image
+    
+    def display(self, frame_b):
+        """
+        Compute again the image to display from the gray reduce frame
+        
+        @param frame_b: the gray reduce frame
+        @return: the frame in pygame format
+        """
+        frame = cv2.cvtColor(frame_b, cv2.COLOR_GRAY2RGB)
+        image = pygame.image.frombuffer(frame, frame.shape[1::-1], "RGB")
+        return pygame.transform.scale(image, (WIDTH*2, HEIGHT*2))
         
     def next_image(self):
         """
-        Load an image from the buffer if it's not empty. In any other case, load it from the video
+        Load an image to show again after an undo if there is one. In any other case, load it from the video
         
         @return: an image if the video is not finished else None
         """
-        if self.keep is not None:
-            self.current = self.keep
-            self.keep = None
-            return self.current[1]
-        #return None
-        
-        ret, frame = self.cap.read()
-        self.i += 1
-        if ret:
-            frame, image = self.format(frame)
-            entry = (frame, image)
-            self.current = entry
-            return image
+        if self.forward:
+            self.i = self.forward.pop()
+            return self.display(self.store.get(self.i))
+        
+        position = self.decoder.read_position
+        entry = self.decoder.read()
+        # The near duplicates of the last frame shown are skipped
+        while entry is not None and self.duplicates is not None and self.duplicates.is_duplicate(entry[0]):
+            position = self.decoder.read_position
+            entry = self.decoder.read()
+        if entry is not None:
+            self.last += 1
+            self.i = self.last
+            self.positions[self.i] = position
+            self.store.put(self.i, entry[0])
+            return entry[1]
         
     def prev_image(self):
         """
         Undo the last image labeling.
-        If there is no image before or if there was a undo just before
+        If there is no image before or if its image isn't kept anymore
         
         @return: a frame if undo can be done else None
         """
-        if self.prev is not None:
-            self.keep = self.current
-            self.current = self.prev
-            self.prev = None
-            
-            if os.path.exists(self.prev_name):
-                os.remove(self.prev_name)
-            return self.current[1]
-        else:
+        if not self.history:
+            return None
+        
+        number, ticket, theta, norm = self.history[-1]
+        frame_b = self.store.get(number)
+        if frame_b is None:
+            return None
+        
+        self.history.pop()
+        if ticket is not None:
+            self.writer.cancel(ticket)
+        self.redo.append((number, theta, norm, ticket is None))
+        
+        self.forward.append(self.i)
+        self.i = number
+        return self.display(frame_b)
+    
+    def redo_image(self):
+        """
+        Apply again the last label cancelled by an undo, then go to the next image
+        
+        @return: the next image if redo can be done else None
+        """
+        if not self.redo or self.redo[-1][0] != self.i:
             return None
+        
+        _, theta, norm, trash = self.redo.pop()
+        self._save(theta, norm, trash)
+        return self.next_image()
             
     def save_image(self, theta, norm, trash=False):
         """
-        Save the last image send (in next_image or prev_image)
-        and place this image in "previous" state
+        Save the current image (from next_image, prev_image or redo_image)
+        and add it to the history
         But if trash is True, the image will not be save on the disk
         
+        @param theta: an angle (value between -1 and 1)
+        @param norm: an distance (value between 0 and 1)
+        @param trash: boolean indicating if the image is not saved
+        """
+        self._save(theta, norm, trash)
+        # A new label replaces the ones cancelled
+        self.redo.clear()
+    
+    def _save(self, theta, norm, trash):
+        """
+        Submit the current image to the writer and add it to the history
+        
         @param theta: an angle (value between -1 and 1)
         @param norm: an distance (value between 0 and 1)
         @param trash: boolean indicating if the image is not saved
@@ -144,13 +213,38 @@ class ImageManagement:
                     self.rd_s,
                     self.i,
                     theta, norm)
-        self.prev_name = filename
-        self.prev = self.current
-        frame = self.current[0]
         if trash:
-            pass
+            ticket = None
         else:
-            cv2.imwrite(filename, frame)
+            frame_b = self.store.get(self.i)
+            ticket = self.writer.submit(filename, frame_b, theta, norm, self.i, self.rd_s)
+        self.history.append((self.i, ticket, theta, norm))
+    
+    def start_prelabel(self, predictor="cnn", weights_path="weights_last.h5"):
+        """
+        Run a predictor over the video from the next frame, in a background process
+        
+        @param predictor: "cnn" (deep_prediction) or "hough" (line_prediction)
+        @param weights_path: string path to the weights of the CNN
+        """
+        self.prelabeler = Prelabeler(self.videopath, self.decoder.read_position, predictor, weights_path)
+    
+    def suggestion(self):
+        """
+        @return: the (theta, norm) predicted for the current image, None if there isn't one
+        """
+        if self.prelabeler is None or self.i not in self.positions:
+            return None
+        return self.prelabeler.suggestion(self.positions[self.i])
+    
+    def close(self):
+        """
+        Close the video, write the pending images and stop the pre-labeling
+        """
+        self.decoder.stop()
+        self.writer.close()
+        if self.prelabeler is not None:
+            self.prelabeler.close()
 
 
 class App:
@@ -170,6 +264,9 @@ class App:
         
         self.images = manager
         self.x_c, self.y_c = self.weight/2, self.height
+        
+        # (theta, norm) suggested for the displayed image
+        self.suggestion = None
 
     def on_init(self):
         """
@@ -205,6 +302,17 @@ class App:
                 prev_image = self.images.prev_image()
                 if prev_image is not None:
                     self.image2display = prev_image
+            # label again the image like before the undo
+            elif event.key == pygame.K_r:
+                next_image = self.images.redo_image()
+                if next_image is not None:
+                    self.image2display = next_image
+            # accept the suggested label
+            elif event.key == pygame.K_RETURN:
+                if self.suggestion is not None:
+                    self.images.save_image(*self.suggestion)
+                    print(*self.suggestion)
+                    self.next()
             # trash image
             elif event.key == pygame.K_x: 
                 self.images.save_image(0, 0, trash=True)
@@ -215,7 +323,7 @@ class App:
         """
         Call on each refresh
         """
-        pass
+        self.suggestion = self.images.suggestion()
         
     def on_render(self):
         """
@@ -252,6 +360,14 @@ class App:
         
         pygame.draw.line(self._display_surf, color, start, (x_new, y_new), 10)
         
+        # draw suggested label
+        if self.suggestion is not None:
+            theta, norm = self.suggestion
+            length = norm * (400-70) + 70 # magic num, like in process_label
+            end = self.x_c + length*sin(theta), self.y_c - length*cos(theta)
+            pygame.draw.line(self._display_surf, GREEN, start, end, 4)
+            pygame.draw.circle(self._display_surf, GREEN, [int(c) for c in end], 8)
+        
         # and paste
         pygame.display.flip()
         
@@ -320,15 +436,22 @@ if __name__ == "__main__" :
     parser.add_argument("video", help="video path")
     parser.add_argument("output", help="path to output folder")
     parser.add_argument("--frame", help="start to the nth frame")
+    parser.add_argument("--packed", action="store_true", help="save in a packed dataset instead of PNG files")
+    parser.add_argument("--prelabel", choices=["cnn", "hough"], help="suggest the labels with a predictor")
+    parser.add_argument("--weights", default="weights_last.h5", help="path to the weights of the CNN")
+    parser.add_argument("--skip-duplicates", type=float, help="skip the near duplicates below this difference")
     args = parser.parse_args()
     
     if args.output[-1] != "/":
         args.output += "/"
     
-    manager = ImageManagement(args.video, args.output)
+    manager = ImageManagement(args.video, args.output, args.packed, skip_duplicates=args.skip_duplicates)
     if args.frame:
         if not manager.goto(int(args.frame)):
             exit(0)
+    if args.prelabel:
+        manager.start_prelabel(args.prelabel, args.weights)
     
     theApp = App(manager)
     theApp.on_execute()
+    manager.close()
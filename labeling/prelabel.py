@@ -0,0 +1,153 @@
+import os
+import sys
+import queue
+import multiprocessing
+
+import numpy as np
+
+"""
+Pre-labeling for labeling.py: a predictor runs over the video ahead of the labeler
+in a background process, and its predictions are shown as suggestions.
+The labeler only accepts them (Enter) or clicks a better label.
+
+The predictions are converted to labels like dataset.get_labels in reverse:
+theta = direction, norm = (speed + 1) / 2
+"""
+
+PROCESSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processes")
+
+
+def to_labels(direction, speed):
+    """
+    Convert predictions of the car to labels of labeling.py
+
+    @param direction: Numpy array of directions (between -1 and 1)
+    @param speed: Numpy array of speeds (between -1 and 1)
+    @return theta: Numpy array of angles (between -1 and 1)
+    @return norm: Numpy array of distances (between 0 and 1)
+    """
+    theta = np.clip(direction, -1, 1)
+    norm = np.clip((speed + 1) / 2, 0, 1)
+    return theta, norm
+
+
+def _prelabel_worker(videopath, start, predictor, weights_path, results, batch_size):
+    """
+    Loop of the background process: predict the labels by batches of frames
+
+    @param videopath: string path to the video
+    @param start: position of the first frame predicted
+    @param predictor: "cnn" or "hough"
+    @param weights_path: string path to the weights of the CNN
+    @param results: multiprocessing.Queue of (positions, theta, norm) arrays
+    @param batch_size: number of frames predicted at once
+    """
+    sys.path.append(PROCESSES_PATH)
+    from evaluation import read_chunks, CNNEvaluator, HoughEvaluator
+
+    if predictor == "cnn":
+        evaluator = CNNEvaluator(weights_path, workers=2)
+    else:
+        evaluator = HoughEvaluator(workers=2)
+
+    position = start
+    for chunk in read_chunks(videopath, batch_size, start=start):
+        columns = evaluator.predict(chunk)
+        direction = columns["direction"]
+        # The Hough predictor keeps the previous direction when no line is found
+        direction = np.where(np.isnan(direction), 0, direction)
+        theta, norm = to_labels(direction, columns["speed"])
+
+        positions = np.arange(position, position + len(chunk))
+        position += len(chunk)
+        # Blocks when the process is too far ahead of the labeler
+        results.put((positions, theta.astype(np.float32), norm.astype(np.float32)))
+
+    results.put(None)
+    evaluator.close()
+
+
+class Prelabeler:
+    """
+    Start the background process and collect its predictions.
+
+    The process is started with "spawn": the labeling tool has running threads
+    and a pygame window which must not be forked.
+    A batch is taken out of the queue only when it starts less than batch_size frames
+    after the labeler, the next ones stay in the bounded queue and the process waits:
+    it stays at most about (max_batches + 2) * batch_size frames ahead.
+    The suggestions more than batch_size frames behind the labeler are removed.
+    """
+    def __init__(self, videopath, start=0, predictor="cnn", weights_path="weights_last.h5",
+                 batch_size=64, max_batches=4):
+        """
+        Start the background process
+
+        @param videopath: string path to the video
+        @param start: position of the first frame predicted
+        @param predictor: "cnn" or "hough"
+        @param weights_path: string path to the weights of the CNN (.h5 or .tflite)
+        @param batch_size: number of frames predicted at once
+        @param max_batches: number of batches predicted in advance
+        """
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue(max_batches)
+        self.process = context.Process(
+            target=_prelabel_worker,
+            args=(videopath, start, predictor, weights_path, self.results, batch_size),
+            daemon=True)
+        self.process.start()
+
+        self.window = batch_size
+        # position -> (theta, norm), in the order of the positions
+        self.suggestions = {}
+        # Batch taken out of the queue but too far ahead of the labeler
+        self.pending = None
+        self.finished = False
+
+    def _collect(self, position):
+        """
+        Get the predictions done by the process around the labeler, without waiting
+
+        @param position: position of the frame shown to the labeler
+        """
+        while not self.finished:
+            if self.pending is None:
+                try:
+                    self.pending = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                if self.pending is None:
+                    self.finished = True
+                    break
+
+            positions, thetas, norms = self.pending
+            if positions[0] >= position + self.window:
+                break
+            self.pending = None
+            for p, theta, norm in zip(positions, thetas, norms):
+                if p >= position - self.window:
+                    self.suggestions[int(p)] = (float(theta), float(norm))
+
+        # The oldest suggestions are the first ones of the dict
+        while self.suggestions:
+            oldest = next(iter(self.suggestions))
+            if oldest >= position - self.window:
+                break
+            del self.suggestions[oldest]
+
+    def suggestion(self, position):
+        """
+        @param position: position of the frame in the video
+        @return: the suggested (theta, norm), None if it isn't predicted yet
+        """
+        self._collect(position)
+        return self.suggestions.get(position)
+
+    def close(self):
+        """
+        Stop the background process
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
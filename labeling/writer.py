@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+from threading import Thread
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+
+import cv2
+
+"""
+Asynchronous saving of the labeled frames for labeling.py.
+The frames wait a few seconds in a queue before being written,
+so an undo just cancels the pending write instead of deleting a file.
+"""
+
+class FrameWriter:
+    """
+    The frames submitted are encoded in PNG by a pool of threads (not for a packed dataset),
+    then a thread writes them in batches, in the order of submission,
+    once they are older than "delay" seconds.
+
+    A write is identified by the ticket returned by submit.
+    Cancelling a pending write costs nothing; a write already done is removed
+    from the disk (the PNG file is deleted, or the image is popped from the packed dataset).
+    """
+    def __init__(self, packed_writer=None, workers=2, delay=2.0, batch_size=32):
+        """
+        Start the threads
+
+        @param packed_writer: a dataset.PackedWriter, None to write PNG files
+        @param workers: number of encoding threads
+        @param delay: time in seconds during which a write can be cancelled for free
+        @param batch_size: maximum number of frames written at once
+        """
+        self.packed_writer = packed_writer
+        self.delay = delay
+        self.batch_size = batch_size
+
+        # ticket -> (submission time, filename, labels, AsyncResult of the encoding)
+        self.pending = OrderedDict()
+        # (ticket, filename) of the last writes done, for the cancellations
+        self.written = deque(maxlen=1024)
+        self.next_ticket = 0
+        self.nb_written = 0
+        self.nb_cancelled = 0
+
+        self.condition = threading.Condition()
+        # Held while a batch is written, a cancellation waits for the end of the batch
+        self.write_lock = threading.Lock()
+        self.flushing = False
+        self.running = True
+
+        self.pool = ThreadPool(workers)
+        self.thread = Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, filename, frame, theta, norm, frame_number=0, prefix=""):
+        """
+        Queue a labeled frame
+
+        @param filename: string path of the PNG file (not used for a packed dataset)
+        @param frame: the half size grayscale image
+        @param theta: an angle (value between -1 and 1)
+        @param norm: an distance (value between 0 and 1)
+        @param frame_number: the number of the frame in the video
+        @param prefix: the name of the labeling session
+        @return: the ticket of the write
+        """
+        encoding = self.pool.apply_async(self._encode, (frame,))
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.pending[ticket] = (time.monotonic(), filename, (theta, norm, frame_number, prefix), encoding)
+            self.condition.notify_all()
+        return ticket
+
+    def _encode(self, frame):
+        """
+        Encoding task of the pool
+
+        @param frame: the half size grayscale image
+        @return: the PNG bytes, or the image for a packed dataset
+        """
+        if self.packed_writer is not None:
+            return frame
+        return cv2.imencode(".png", frame)[1].tobytes()
+
+    def cancel(self, ticket):
+        """
+        Cancel a write, or remove the frame if it is already written.
+        The writes must be cancelled from the newest one (like an undo).
+
+        @param ticket: the ticket returned by submit
+        @return: True if the write was still pending
+        """
+        with self.write_lock:
+            with self.condition:
+                if self.pending.pop(ticket, None) is not None:
+                    self.nb_cancelled += 1
+                    return True
+
+            if self.written and self.written[-1][0] == ticket:
+                _, filename = self.written.pop()
+                if self.packed_writer is not None:
+                    self.packed_writer.pop()
+                elif os.path.exists(filename):
+                    os.remove(filename)
+                self.nb_written -= 1
+                self.nb_cancelled += 1
+            return False
+
+    def _ready(self):
+        """
+        Called with the lock
+
+        @return: the tickets to write now, in order
+        """
+        limit = time.monotonic() - self.delay
+        tickets = []
+        for ticket, (submitted, _, _, _) in self.pending.items():
+            if len(tickets) == self.batch_size or (submitted > limit and not self.flushing):
+                break
+            tickets.append(ticket)
+        return tickets
+
+    def _write_loop(self):
+        """
+        Loop of the writing thread
+        """
+        while True:
+            with self.condition:
+                tickets = self._ready()
+                while not tickets:
+                    if not self.running:
+                        return
+                    if self.flushing:
+                        self.flushing = False
+                        self.condition.notify_all()
+                    # Wake up when the oldest pending frame is ready
+                    if self.pending:
+                        oldest = next(iter(self.pending.values()))[0]
+                        timeout = max(oldest + self.delay - time.monotonic(), 0.01)
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout)
+                    tickets = self._ready()
+
+            with self.write_lock:
+                with self.condition:
+                    # Some of them could have been cancelled
+                    batch = [(ticket, self.pending.pop(ticket)) for ticket in tickets if ticket in self.pending]
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """
+        Write the encoded frames, called with write_lock
+
+        @param batch: list of (ticket, pending entry)
+        """
+        for ticket, (_, filename, labels, encoding) in batch:
+            data = encoding.get()
+            if self.packed_writer is not None:
+                self.packed_writer.append(data, *labels)
+            else:
+                with open(filename, "wb") as f:
+                    f.write(data)
+            self.written.append((ticket, filename))
+        self.nb_written += len(batch)
+
+    def flush(self):
+        """
+        Write all the pending frames now and wait for the end of the writes
+        """
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            while self.flushing and self.thread.is_alive():
+                self.condition.wait(0.1)
+
+    def close(self):
+        """
+        Write the pending frames and stop the threads
+        """
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.pool.close()
+        if self.packed_writer is not None:
+            self.packed_writer.close()
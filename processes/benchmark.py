@@ -0,0 +1,369 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+
+import time
+
+import cv2
+import numpy as np
+
+"""
+Parity checks and timings of the on-car code with recorded videos.
+Run it from the project root, for instance :
+    python processes/benchmark.py fused data/videos/move_by_hand1.mp4
+"""
+
+def read_frames(videopath, nb_frames=None, size=(456, 228)):
+    """
+    Load the frames of a recorded video in memory
+
+    @param videopath: string path to a video
+    @param nb_frames: maximum number of frames to read, all if None
+    @param size: (width, height) of the frames given to the processes
+    @return: a list of OpenCV images
+    """
+    cap = cv2.VideoCapture(videopath)
+    if (cap.isOpened()== False):
+        print("Error opening video stream or file")
+
+    frames = []
+    while nb_frames is None or len(frames) < nb_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame.shape[1::-1] != size:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        frames.append(frame)
+    cap.release()
+
+    return frames
+
+
+def timeit(function, frames, repeat=3):
+    """
+    Measure the mean time of a function called on each frame
+
+    @param function: a callable with one argument
+    @param frames: a list of arguments
+    @param repeat: number of passes over the frames
+    @return: mean duration in seconds for one call
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            function(frame)
+    return (time.perf_counter() - start) / (repeat*len(frames))
+
+
+def check_fused(frames):
+    """
+    Compare deep_prediction.ProcessChain and deep_prediction.FusedProcessChain
+    The outputs must be identical
+
+    @param frames: a list of OpenCV images of dimension (456, 228, 3)
+    @return: the number of frames with at least one different pixel
+    """
+    from deep_prediction import ProcessChain, FusedProcessChain
+
+    reference = ProcessChain()
+    fused = FusedProcessChain()
+
+    nb_different = 0
+    for frame in frames:
+        expected = reference.transform(frame).astype(np.float32)
+        result = fused.transform(frame)
+        if not np.array_equal(expected, result):
+            nb_different += 1
+
+    print("Frames with a different output : {}/{}".format(nb_different, len(frames)))
+    for name, chain in [
+            ("ProcessChain", reference),
+            ("ProcessChain (buffered)", ProcessChain(buffered=True)),
+            ("FusedProcessChain", fused)]:
+        print("{:<30} {:8.3f} ms".format(name, 1000*timeit(chain.transform, frames)))
+
+    return nb_different
+
+
+def check_remap(frames, calibration_path=None):
+    """
+    Compare calibration.Remap with the separate steps.
+    Without correction, the output must be the ROI selection, the resizing and the crop
+    except on the edges of the ROI (the ROI is tested at the center of the resized pixels).
+    With a correction, it is compared to the three full frame passes
+    (undistortion, perspective warp, then ROI, resizing and crop).
+
+    @param frames: a list of OpenCV images of dimension (456, 228, 3)
+    @param calibration_path: string path to a file of calibration.py, None for an example calibration
+    @return: the mean absolute difference of the corrected images with the three passes
+    """
+    from deep_prediction import CannyTrsf, ROISelection, Resize, Crop
+    from calibration import Calibration, Remap, load_calibration, bottom_perspective
+
+    edges = [CannyTrsf()(frame) for frame in frames]
+    steps = [ROISelection(), Resize(), Crop()]
+    def separate(image):
+        for step in steps:
+            image = step(image)
+        return image
+
+    identity = Remap(Calibration())
+    nb_different = sum(np.count_nonzero(separate(image) != identity(image)) for image in edges)
+    print("Pixels different without correction : {:.3f}%".format(
+        100 * nb_different / (len(edges) * identity(edges[0]).size)))
+
+    if calibration_path is not None:
+        calibration = load_calibration(calibration_path)
+    else:
+        # A wide angle lens and the perspective of experimentations/preprocessing_tests.ipynb
+        camera_matrix = np.array([[300, 0, 228], [0, 300, 114], [0, 0, 1]], np.float64)
+        calibration = Calibration(camera_matrix, [-0.3, 0.1, 0, 0, 0], perspective=bottom_perspective(65, 22))
+    remap = Remap(calibration)
+    buffered = remap.allocate(edges[0])
+
+    height, width = edges[0].shape
+    scale = calibration._scale(edges[0].shape)
+    camera_matrix = scale @ calibration.camera_matrix if calibration.camera_matrix is not None else np.eye(3)
+    new_camera_matrix = scale @ calibration.new_camera_matrix if calibration.new_camera_matrix is not None else np.eye(3)
+    perspective = scale @ calibration.perspective @ np.linalg.inv(scale) if calibration.perspective is not None else np.eye(3)
+    mapx, mapy = cv2.initUndistortRectifyMap(camera_matrix, calibration.dist_coeffs, None, new_camera_matrix,
+                                             (width, height), cv2.CV_32FC1)
+    def three_passes(image):
+        undistorted = cv2.remap(image, mapx, mapy, cv2.INTER_LINEAR)
+        warped = cv2.warpPerspective(undistorted, perspective, (width, height))
+        return separate(warped)
+
+    difference = np.mean([np.abs(three_passes(image).astype(np.float32) - remap(image)).mean() for image in edges])
+    print("Mean absolute difference with the three passes : {:.3f}".format(difference))
+
+    for name, function in [
+            ("ROI, resize, crop", separate),
+            ("Three passes", three_passes),
+            ("Remap", lambda image: remap(image, buffered))]:
+        print("{:<30} {:8.3f} ms".format(name, 1000*timeit(function, edges)))
+
+    return difference
+
+
+def check_backends(frames, weights_path, tolerance=1e-4):
+    """
+    Compare the Keras model and inference.NumpyBackend
+    on the preprocessed frames, one frame per call like on the car
+
+    @param frames: a list of OpenCV images of dimension (456, 228, 3)
+    @param weights_path: string path to the weights saved by Keras
+    @param tolerance: maximum absolute difference accepted
+    @return: the maximum absolute difference between the predictions
+    """
+    from deep_prediction import ProcessChain, build_model
+    from inference import KerasBackend, NumpyBackend
+
+    chain = ProcessChain()
+    tensors = [chain.transform(frame).astype(np.float32) for frame in frames]
+
+    keras_backend = KerasBackend(build_model(weights_path))
+    numpy_backend = NumpyBackend.from_h5(weights_path)
+
+    max_diff = 0
+    for tensor in tensors:
+        diff = np.abs(keras_backend.predict(tensor) - numpy_backend.predict(tensor)).max()
+        max_diff = max(max_diff, diff)
+
+    print("Maximum difference : {:.2e} ({})".format(
+        max_diff, "ok" if max_diff <= tolerance else "TOO LARGE"))
+    for name, backend in [("KerasBackend", keras_backend), ("NumpyBackend", numpy_backend)]:
+        print("{:<30} {:8.3f} ms".format(name, 1000*timeit(backend.predict, tensors)))
+
+    return max_diff
+
+
+def line_process_loop(lines):
+    """
+    The former implementation of line_prediction.ProcessChain.line_process
+    with a Python loop over the lines, kept as reference
+
+    @param lines: list or Numpy array with coordinates of lines
+    @return: None if all lines are not revelant else float
+    """
+    if lines is None:
+        return None
+
+    lenghts = np.array([])
+    origins = np.array([])
+    nb_ignored = 0
+
+    for line in lines:
+        x1, y1, x2, y2 = line.reshape(4)
+        if y1 == y2:
+            continue
+
+        a = (x1-x2)/(y1-y2)
+        b = x1 - a*y1
+
+        lenght = np.sqrt(np.square(x1-x2)+np.square(y1-y2))
+        if 0-300 < b < 456+300:
+            origins = np.append(origins, b)
+            lenghts = np.append(lenghts, lenght)
+        elif lenght > 75:
+            nb_ignored += 1
+
+    if len(origins) == 0:
+        return None
+    else:
+        pt_mean = np.average(origins, weights=lenghts)
+        if pt_mean > 0.5:
+            pt_mean *= 1 + nb_ignored / 3
+        return  pt_mean
+
+
+def check_line_process(frames):
+    """
+    Compare the vectorized line_prediction.ProcessChain.line_process
+    with the former loop on the lines detected in each frame.
+    The results must be identical
+
+    @param frames: a list of OpenCV images of dimension (456, 228, 3)
+    @return: the number of frames with a different result
+    """
+    from line_prediction import ProcessChain
+
+    chain = ProcessChain()
+    all_lines = [chain.detect_lines(chain.region_of_interest(chain.canny_trsf(frame))) for frame in frames]
+
+    nb_different = 0
+    for lines in all_lines:
+        if line_process_loop(lines) != chain.line_process(lines):
+            nb_different += 1
+
+    nb_lines = [0 if lines is None else len(lines) for lines in all_lines]
+    print("Frames with a different result : {}/{}".format(nb_different, len(frames)))
+    print("Lines per frame : mean {:.1f}, max {}".format(np.mean(nb_lines), np.max(nb_lines)))
+    for name, function in [("loop", line_process_loop), ("vectorized", chain.line_process)]:
+        print("{:<30} {:8.3f} ms".format(name, 1000*timeit(function, all_lines)))
+
+    return nb_different
+
+
+def check_control_loop(car_class, rate=100, duration=5, latency=0.0005, fps=30):
+    """
+    Run the moving loop of a car with a simulated PCA9685
+    while another thread sets random targets at the camera frame rate
+
+    @param car_class: Chassis or a child class
+    @param rate: frequency of the moving loop in Hz
+    @param duration: length of the run in seconds
+    @param latency: simulated duration of an I2C write in seconds
+    @param fps: frequency of the new targets
+    @return: the loop statistics (see car.LoopStats.summary)
+    """
+    from threading import Thread
+    from pwm import SimulatedPCA9685
+
+    driver = SimulatedPCA9685(latency=latency)
+    car = car_class(rate=rate, driver=driver).start()
+
+    def camera():
+        rng = np.random.RandomState(0)
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            car.set_direction(rng.uniform(-1, 1))
+            car.set_speed(rng.uniform(0, 1))
+            time.sleep(1 / fps)
+
+    thread = Thread(target=camera)
+    thread.start()
+    thread.join()
+    car.stop()
+
+    stats = car.loop_stats.summary()
+    print("{} at {} Hz, I2C write {:.2f} ms".format(car_class.__name__, rate, 1000*latency))
+    print("  period {:.3f} ms, jitter std {:.3f} ms max {:.3f} ms, {} overruns on {} ticks".format(
+        1000*stats["mean_period"], 1000*stats["jitter_std"], 1000*stats["jitter_max"],
+        stats["overruns"], stats["ticks"]))
+    print("  {} writes sent, {} skipped".format(stats["writes"], stats["skipped_writes"]))
+    for channel, (nb_writes, interval) in sorted(driver.summary().items()):
+        print("  channel {:>2} : {} writes, every {:.2f} ms".format(channel, nb_writes, 1000*interval))
+
+    return stats
+
+
+def check_control_state(car_class, duration=2, nb_writers=3):
+    """
+    Stress the shared control state of a car:
+    writer threads set opposite targets (v, -v) while the moving loop runs
+    and a reader checks that it never gets a direction and a speed from two different writes
+
+    @param car_class: Chassis or a child class
+    @param duration: length of the run in seconds
+    @param nb_writers: number of threads setting the targets
+    @return: the number of torn reads
+    """
+    from threading import Thread
+    from pwm import SimulatedPCA9685
+
+    car = car_class(driver=SimulatedPCA9685(latency=0)).start()
+    end = time.monotonic() + duration
+
+    def writer(seed):
+        rng = np.random.RandomState(seed)
+        while time.monotonic() < end:
+            value = rng.uniform(-1, 1)
+            car.set_targets(value, -value)
+
+    threads = [Thread(target=writer, args=(seed,)) for seed in range(nb_writers)]
+    for thread in threads:
+        thread.start()
+
+    nb_reads, nb_torn = 0, 0
+    while time.monotonic() < end:
+        direction, speed = car.targets.read()
+        nb_reads += 1
+        if direction != -speed:
+            nb_torn += 1
+
+    for thread in threads:
+        thread.join()
+    car.stop()
+
+    print("{} : {} torn reads on {}, {} loop ticks".format(
+        car_class.__name__, nb_torn, nb_reads, car.loop_stats.summary()["ticks"]))
+
+    return nb_torn
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("check", choices=["fused", "remap", "backends", "lines", "control", "state"], help="the check to run")
+    parser.add_argument("video", nargs="?", help="video path (not used by control and state)")
+    parser.add_argument("--frames", type=int, help="maximum number of frames")
+    parser.add_argument("--weights", default="weights_last.h5", help="path to the Keras weights")
+    parser.add_argument("--calibration", help="path to the file of calibration.py (remap)")
+    parser.add_argument("--rate", type=int, default=100, help="frequency of the moving loop")
+    args = parser.parse_args()
+
+    # Single core, like on the Raspberry Pi during a run
+    cv2.setNumThreads(1)
+
+    if args.check == "control":
+        from car import Chassis, Car, F1
+        for car_class in [Chassis, Car, F1]:
+            check_control_loop(car_class, args.rate)
+        exit(0)
+
+    if args.check == "state":
+        from car import Chassis, Car, F1
+        for car_class in [Chassis, Car, F1]:
+            check_control_state(car_class)
+        exit(0)
+
+    frames = read_frames(args.video, args.frames)
+    if args.check == "fused":
+        check_fused(frames)
+    elif args.check == "remap":
+        check_remap(frames, args.calibration)
+    elif args.check == "backends":
+        check_backends(frames, args.weights)
+    elif args.check == "lines":
+        check_line_process(frames)
@@ -0,0 +1,389 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+"""
+Random rectilinear circuits, from experimentations/circuit_generation.ipynb:
+rectangles are placed around a base rectangle, the circuit is the outline of their union.
+
+The vertices of the outline are the corners of the rectangles and the intersections
+of their edges which are not inside another rectangle.
+In a rectilinear polygon, each vertex has one horizontal and one vertical neighbour:
+the vertices of a column (or a row) sorted by coordinate are linked two by two.
+
+The intersections and the inside tests are computed with Numpy on all the edges at once,
+by blocks to bound the memory. The rejection sampling draws the candidates by batches,
+and a uniform grid gives the rectangles near a candidate.
+
+The coordinates are in the units of the notebook (the base rectangle is 600x400).
+
+Generate circuits in parallel, for instance :
+    python processes/circuit.py --circuits 10000 -o data/circuits.npz
+"""
+
+BASE_RECT = (-300, -200, 600, 400)
+# Ranges of the notebook, (min, max) of x, y, width and height
+X_RANGE, Y_RANGE = (-350, 250), (-275, 125)
+WIDTH_RANGE, HEIGHT_RANGE = (80, 200), (75, 150)
+
+# Number of rows of the first operand computed at once
+BLOCK_SIZE = 512
+
+
+class GridIndex:
+    """
+    Uniform grid over the plane: each cell has the indexes of the rectangles crossing it.
+    A query only tests the rectangles of the cells crossed by the query.
+    """
+    def __init__(self, cell_size=100):
+        """
+        Attribute initialization
+
+        @param cell_size: width and height of a cell, about the size of a rectangle
+        """
+        self.cell_size = cell_size
+        # (column, row) -> list of indexes
+        self.cells = {}
+        self.rects = []
+
+    def _cells(self, x, y, w, h):
+        """
+        @return: the (column, row) of the cells crossed by a rectangle
+        """
+        size = self.cell_size
+        columns = range(int(x // size), int((x + w) // size) + 1)
+        rows = range(int(y // size), int((y + h) // size) + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def insert(self, rect):
+        """
+        @param rect: a rectangle (x, y, width, height)
+        @return: the index of the rectangle
+        """
+        index = len(self.rects)
+        self.rects.append(rect)
+        for cell in self._cells(*rect):
+            self.cells.setdefault(cell, []).append(index)
+        return index
+
+    def candidates(self, rect):
+        """
+        @param rect: a rectangle (x, y, width, height), or a point with a size of 0
+        @return: the indexes of the rectangles which may touch it
+        """
+        indexes = set()
+        for cell in self._cells(*rect):
+            indexes.update(self.cells.get(cell, ()))
+        return indexes
+
+    def overlapping(self, rect):
+        """
+        @param rect: a rectangle (x, y, width, height)
+        @return: True if it has a common area with one of the rectangles
+        """
+        return any(overlap_rect(*rect, *self.rects[i]) for i in self.candidates(rect))
+
+    def contains(self, pt):
+        """
+        @param pt: (x, y) coordinates
+        @return: True if the point is strictly inside one of the rectangles
+        """
+        x_pt, y_pt = pt
+        for i in self.candidates((x_pt, y_pt, 0, 0)):
+            x, y, w, h = self.rects[i]
+            if x < x_pt < x + w and y < y_pt < y + h:
+                return True
+        return False
+
+
+def overlap_rect(x1, y1, w1, h1, x2, y2, w2, h2):
+    """
+    @return: True if the two rectangles (x, y, width, height) have a common area
+    """
+    return x1 < x2 + w2 and x2 < x1 + w1 and y1 < y2 + h2 and y2 < y1 + h1
+
+
+def rect_edges(rects):
+    """
+    @param rects: Numpy array of rectangles (x, y, width, height), dimension (k, 4)
+    @return: float Numpy array of the 4k segments (x1, y1, x2, y2)
+    """
+    x, y, w, h = np.asarray(rects, np.float64).T
+    corners = [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+    segments = [np.stack(corners[i] + corners[(i+1) % 4], axis=1) for i in range(4)]
+    return np.concatenate(segments)
+
+
+def segment_intersections(a, b):
+    """
+    Intersections of every segment of a with every segment of b, ends included.
+    The parallel segments have no intersection.
+
+    @param a: Numpy array of segments (x1, y1, x2, y2), dimension (n, 4)
+    @param b: Numpy array of segments (x1, y1, x2, y2), dimension (m, 4)
+    @return found: bool Numpy array of dimension (n, m)
+    @return points: float Numpy array of dimension (n, m, 2), the intersection points where found
+    """
+    p, r = a[:, None, :2], (a[:, 2:] - a[:, :2])[:, None]
+    q, s = b[None, :, :2], (b[:, 2:] - b[:, :2])[None]
+
+    # p + t*r = q + u*s
+    denominator = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    qp = q - p
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denominator
+        u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denominator
+
+        found = (denominator != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+        points = p + t[..., None] * r
+    return found, points
+
+
+def points_in_rects(points, rects):
+    """
+    @param points: Numpy array of (x, y) coordinates, dimension (n, 2)
+    @param rects: Numpy array of rectangles (x, y, width, height), dimension (k, 4)
+    @return: bool Numpy array of dimension (n,), True if the point is strictly inside a rectangle
+    """
+    x, y, w, h = (column[None] for column in np.asarray(rects, np.float64).T)
+    inside = np.zeros(len(points), bool)
+    for start in range(0, len(points), BLOCK_SIZE):
+        px, py = (column[:, None] for column in points[start:start + BLOCK_SIZE].T)
+        inside[start:start + BLOCK_SIZE] = ((x < px) & (px < x + w) & (y < py) & (py < y + h)).any(axis=1)
+    return inside
+
+
+def outline_vertices(rects):
+    """
+    @param rects: list of rectangles (x, y, width, height)
+    @return: float Numpy array of dimension (n, 2), the vertices of the outline of their union
+    """
+    segments = rect_edges(rects)
+    points = [segments[:, :2]]
+    for start in range(0, len(segments), BLOCK_SIZE):
+        found, intersections = segment_intersections(segments[start:start + BLOCK_SIZE], segments)
+        points.append(intersections[found])
+
+    # p + t*r is not exact, the same vertex must have the same coordinates
+    points = np.unique(np.round(np.concatenate(points), 6), axis=0)
+    return points[~points_in_rects(points, rects)]
+
+
+def order_outline(vertices):
+    """
+    Link the vertices of a rectilinear polygon
+
+    @param vertices: Numpy array of (x, y) vertices, dimension (n, 2)
+    @return: list of the closed loops, each one a Numpy array of (x, y) in order
+    """
+    vertices = np.asarray(vertices, np.float64)
+    x, y = vertices.T
+    neighbours = []
+    # The vertices of a column are linked by vertical edges, the ones of a row by horizontal edges
+    for line, along in [(x, y), (y, x)]:
+        order = np.lexsort((along, line))
+        first, second = order[::2], order[1::2]
+        if len(order) % 2 or np.any(line[first] != line[second]):
+            raise ValueError("Degenerated outline")
+        neighbour = np.empty(len(vertices), np.int64)
+        neighbour[first], neighbour[second] = second, first
+        neighbours.append(neighbour)
+    vertical, horizontal = neighbours
+
+    loops = []
+    visited = np.zeros(len(vertices), bool)
+    for start in range(len(vertices)):
+        if visited[start]:
+            continue
+        loop, index, along_x = [start], start, True
+        while True:
+            index = horizontal[index] if along_x else vertical[index]
+            along_x = not along_x
+            if index == start:
+                break
+            loop.append(index)
+        visited[loop] = True
+        loops.append(vertices[loop])
+    return loops
+
+
+def polygon_area(points):
+    """
+    @param points: list of (x, y) vertices of a closed polygon
+    @return: the signed area (shoelace formula)
+    """
+    x, y = np.asarray(points, np.float64).T
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def generate_rectangles(rng, nb_rectangles=7, base=BASE_RECT, min_gap=10, connected_to_base=True,
+                        batch_size=256, max_tries=10000):
+    """
+    Place rectangles by rejection sampling, the candidates are drawn by batches.
+    A rectangle is rejected if more than one of its corners is inside the previous ones,
+    or if one of its edges is closer than min_gap to a parallel edge:
+    the edges of the outline are then longer than min_gap, and never aligned.
+    For the large circuits (connected_to_base False), only the edges of the rectangles
+    near the candidate are compared, they are given by the grid.
+
+    @param rng: a numpy.random.RandomState object
+    @param nb_rectangles: number of rectangles added to the base one
+    @param base: the base rectangle (x, y, width, height)
+    @param min_gap: minimum distance between the lines of two parallel edges
+    @param connected_to_base: every rectangle overlaps the base one (the notebook circuits),
+                              else it overlaps any previous one, and the circuit grows with their number
+    @param batch_size: number of candidates drawn at once
+    @param max_tries: number of candidates drawn without success before restarting from the base one
+    @return: list of rectangles (x, y, width, height), the base one first
+    """
+    def far(values, lines):
+        # Distance to the nearest line, with a binary search in the sorted lines
+        position = np.clip(np.searchsorted(lines, values), 1, len(lines) - 1)
+        return np.minimum(np.abs(values - lines[position - 1]), np.abs(values - lines[position])) >= min_gap
+
+    while True:
+        grid = GridIndex(max(WIDTH_RANGE[1], HEIGHT_RANGE[1]))
+        grid.insert(base)
+        # Sorted coordinates of the vertical and the horizontal edges
+        xs = np.sort([base[0], base[0] + base[2]])
+        ys = np.sort([base[1], base[1] + base[3]])
+        tries = 0
+
+        while len(grid.rects) <= nb_rectangles and tries <= max_tries:
+            if connected_to_base:
+                x_range, y_range = X_RANGE, Y_RANGE
+            else:
+                rects = np.array(grid.rects)
+                x_range = (rects[:, 0].min() - WIDTH_RANGE[1], (rects[:, 0] + rects[:, 2]).max())
+                y_range = (rects[:, 1].min() - HEIGHT_RANGE[1], (rects[:, 1] + rects[:, 3]).max())
+            x = rng.randint(*x_range, batch_size)
+            y = rng.randint(*y_range, batch_size)
+            w = rng.randint(*WIDTH_RANGE, batch_size)
+            h = rng.randint(*HEIGHT_RANGE, batch_size)
+            tries += batch_size
+
+            # Vectorized filters, then the grid for the survivors in order
+            if connected_to_base:
+                valid = far(x, xs) & far(x + w, xs) & far(y, ys) & far(y + h, ys)
+                bx, by, bw, bh = base
+                valid &= (x < bx + bw) & (bx < x + w) & (y < by + bh) & (by < y + h)
+            else:
+                valid = np.ones(batch_size, bool)
+            corners = np.stack([x, y, x + w, y, x + w, y + h, x, y + h], axis=1)[valid].reshape(-1, 2)
+            nb_inside = points_in_rects(corners, grid.rects).reshape(-1, 4).sum(axis=1)
+            valid[valid] = nb_inside <= 1
+
+            for i in np.flatnonzero(valid):
+                rect = (int(x[i]), int(y[i]), int(w[i]), int(h[i]))
+                cx, cy, cw, ch = rect
+                if not connected_to_base:
+                    if not grid.overlapping(rect):
+                        continue
+                    near = [grid.rects[j] for j in grid.candidates(
+                        (cx - min_gap, cy - min_gap, cw + 2*min_gap, ch + 2*min_gap))]
+                    xs = np.sort([v for r in near for v in (r[0], r[0] + r[2])])
+                    ys = np.sort([v for r in near for v in (r[1], r[1] + r[3])])
+                # The previous survivors of the batch have added lines
+                if not (far(np.array([cx, cx + cw]), xs).all() and far(np.array([cy, cy + ch]), ys).all()):
+                    continue
+                corners = [(cx, cy), (cx + cw, cy), (cx + cw, cy + ch), (cx, cy + ch)]
+                if sum(grid.contains(pt) for pt in corners) > 1:
+                    continue
+
+                grid.insert(rect)
+                xs = np.sort(np.concatenate([xs, [cx, cx + cw]]))
+                ys = np.sort(np.concatenate([ys, [cy, cy + ch]]))
+                tries = 0
+                if len(grid.rects) > nb_rectangles:
+                    return grid.rects
+
+
+def generate_circuit(seed=None, nb_rectangles=7, min_gap=10, connected_to_base=True):
+    """
+    Generate a random circuit
+
+    @param seed: seed of the random generator, None for a random one
+    @param nb_rectangles: number of rectangles added to the base one
+    @param min_gap: minimum length of the edges of the outline
+    @param connected_to_base: see generate_rectangles
+    @return: float Numpy array of dimension (n, 2), the vertices of the closed outline
+    """
+    rng = np.random.RandomState(seed)
+    rects = generate_rectangles(rng, nb_rectangles, min_gap=min_gap, connected_to_base=connected_to_base)
+    loops = order_outline(outline_vertices(rects))
+    # The outer loop is the largest one, the other ones are holes
+    return max(loops, key=lambda loop: abs(polygon_area(loop)))
+
+
+def _generate_worker(args):
+    """
+    Task of the pool of generate_circuits
+
+    @param args: (seed, keyword arguments of generate_circuit)
+    @return: the outline
+    """
+    seed, kwargs = args
+    return generate_circuit(seed, **kwargs)
+
+
+def generate_circuits(nb_circuits, seed=0, workers=None, **kwargs):
+    """
+    Generate many circuits with a pool of processes.
+    The circuit i has the seed "seed + i": the result doesn't depend on the number of workers.
+
+    @param nb_circuits: number of circuits
+    @param seed: seed of the first circuit
+    @param workers: number of processes, the number of CPU if None, 0 to stay in this process
+    @param kwargs: arguments of generate_circuit
+    @return: list of outlines
+    """
+    tasks = [(seed + i, kwargs) for i in range(nb_circuits)]
+    if workers == 0:
+        return [_generate_worker(task) for task in tasks]
+    with Pool(workers) as pool:
+        return pool.map(_generate_worker, tasks, chunksize=max(1, nb_circuits // 64))
+
+
+def save_circuits(path, outlines):
+    """
+    Write outlines in a npz file
+
+    @param path: string path to the file
+    @param outlines: list of Numpy arrays of dimension (n, 2)
+    """
+    offsets = np.cumsum([0] + [len(outline) for outline in outlines])
+    np.savez(path, vertices=np.concatenate(outlines), offsets=offsets)
+
+
+def load_circuits(path):
+    """
+    Read a file written by save_circuits
+
+    @param path: string path to the npz file
+    @return: list of outlines
+    """
+    with np.load(path) as data:
+        vertices, offsets = data["vertices"], data["offsets"]
+    return [vertices[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--circuits", type=int, default=1000, help="number of circuits")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first circuit")
+    parser.add_argument("--rectangles", type=int, default=7, help="number of rectangles of a circuit")
+    parser.add_argument("--grow", action="store_true", help="the rectangles overlap any previous one, not the base")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    parser.add_argument("-o", "--output", default="circuits.npz", help="path of the npz file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    outlines = generate_circuits(args.circuits, args.seed, args.workers,
+                                 nb_rectangles=args.rectangles, connected_to_base=not args.grow)
+    duration = time.perf_counter() - start
+    save_circuits(args.output, outlines)
+    print("{} circuits in {:.1f} s ({:.2f} ms each), saved in {}".format(
+        len(outlines), duration, 1000 * duration / len(outlines), args.output))
@@ -0,0 +1,311 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "labeling"))
+
+import json
+import time
+import hashlib
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import dataset
+import dedup
+
+"""
+Build the training arrays (X, y) of the CNN from a labeled dataset.
+The images are decoded and preprocessed (Crop, Normalize) by a pool of processes,
+and the tensors are saved in a cache on the disk.
+
+The cache has one folder per set of preprocessing parameters,
+and each tensor is found by the hash of the content of its image:
+when the parameters are the same, only the new or modified images are preprocessed.
+
+Run it from the project root, for instance :
+    python processes/dataset_builder.py data/datasetv3/ data/cache/
+"""
+
+TENSORS_FILE = "tensors.bin"
+HASHES_FILE = "hashes.bin"
+PARAMS_FILE = "params.json"
+
+# Length of the sha1 digest of the content of an image
+HASH_SIZE = 20
+
+# Incremented when the preprocessing code changes without changing its parameters
+PREPROCESSING_VERSION = 1
+
+
+def preprocessing_params(geometry):
+    """
+    Everything which changes the tensors, the key of the cache
+
+    @param geometry: the Geometry object of the preprocessing
+    @return: dict of JSON values
+    """
+    return {
+        "version": PREPROCESSING_VERSION,
+        "transforms": ["Crop", "Normalize"],
+        "crop": list(geometry.crop),
+        "target_size": list(geometry.target_size),
+    }
+
+
+def params_key(params):
+    """
+    @param params: dict of JSON values
+    @return: string hash of the parameters
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()[:16]
+
+
+def list_frames(source):
+    """
+    List the images of a dataset and their labels
+
+    @param source: string path to a folder of labeled PNG or to a packed dataset
+    @return items: list of the items given to the workers (PNG paths or indexes in the packed dataset)
+    @return y: float32 Numpy array of dimension (n, 2)
+    """
+    if dataset.is_packed(source):
+        _, labels = dataset.load(source)
+        return list(range(len(labels))), dataset.targets(labels)
+
+    names = sorted(name for name in os.listdir(source) if ".png" in name)
+    y = np.array([dataset.get_labels(name) for name in names], np.float32).reshape(-1, 2)
+    return [os.path.join(source, name) for name in names], y
+
+
+class TensorCache:
+    """
+    The preprocessed tensors for one set of parameters.
+
+    tensors.bin contains the float32 tensors one after the other
+    and hashes.bin the hash of the image of each tensor, in the same order.
+    New tensors are appended at the end of both files.
+    Only one builder must write in a cache at the same time.
+    """
+    def __init__(self, folder, params, shape):
+        """
+        Open or create the cache
+
+        @param folder: string path to the root folder of the caches
+        @param params: dict of the preprocessing parameters
+        @param shape: dimension of one tensor
+        """
+        self.folder = os.path.join(folder, params_key(params))
+        self.shape = tuple(shape)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+            with open(os.path.join(self.folder, PARAMS_FILE), "w") as f:
+                json.dump({"params": params, "shape": list(shape)}, f)
+
+        self.tensor_size = int(np.prod(self.shape)) * 4
+        self.tensors = open(os.path.join(self.folder, TENSORS_FILE), "ab")
+        self.hashes = open(os.path.join(self.folder, HASHES_FILE), "ab")
+
+        # Remove the end of an interrupted build
+        count = min(
+            os.path.getsize(os.path.join(self.folder, TENSORS_FILE)) // self.tensor_size,
+            os.path.getsize(os.path.join(self.folder, HASHES_FILE)) // HASH_SIZE)
+        self.tensors.truncate(count * self.tensor_size)
+        self.hashes.truncate(count * HASH_SIZE)
+
+        # hash -> row in tensors.bin
+        self.rows = {}
+        if count > 0:
+            with open(os.path.join(self.folder, HASHES_FILE), "rb") as f:
+                hashes = f.read(count * HASH_SIZE)
+            self.rows = {hashes[i:i+HASH_SIZE]: row for row, i in enumerate(range(0, len(hashes), HASH_SIZE))}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, digest):
+        return digest in self.rows
+
+    def append(self, digest, tensor):
+        """
+        Add a tensor at the end of the cache
+
+        @param digest: bytes hash of the image
+        @param tensor: float32 Numpy array of dimension shape
+        """
+        self.tensors.write(np.ascontiguousarray(tensor, np.float32).tobytes())
+        self.hashes.write(digest)
+        self.rows[digest] = len(self.rows)
+
+    def load(self):
+        """
+        Memory-map all the tensors
+
+        @return: float32 Numpy array of dimension (n,) + shape
+        """
+        self.tensors.flush()
+        self.hashes.flush()
+        if len(self.rows) == 0:
+            return np.empty((0,) + self.shape, np.float32)
+        return np.memmap(os.path.join(self.folder, TENSORS_FILE), np.float32, "r",
+                         shape=(len(self.rows),) + self.shape)
+
+    def close(self):
+        """
+        Close the files
+        """
+        self.tensors.close()
+        self.hashes.close()
+
+
+# Objects of a worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(source, geometry):
+    """
+    Create the transformations once per worker process
+
+    @param source: string path to the dataset
+    @param geometry: the Geometry object of the preprocessing
+    """
+    from deep_prediction import Crop, Normalize
+
+    _worker["crop"] = Crop(geometry)
+    _worker["normalize"] = Normalize(geometry)
+    _worker["images"] = dataset.load(source)[0] if dataset.is_packed(source) else None
+
+
+def _read(item):
+    """
+    @param item: a PNG path or an index in the packed dataset
+    @return: the encoded or raw bytes of the image, used for the hash
+    """
+    if _worker["images"] is not None:
+        return _worker["images"][item].tobytes()
+    with open(item, "rb") as f:
+        return f.read()
+
+
+def _hash_item(item):
+    """
+    Worker task: hash the content of an image
+
+    @param item: a PNG path or an index in the packed dataset
+    @return: bytes sha1 digest
+    """
+    return hashlib.sha1(_read(item)).digest()
+
+
+def _signature_item(item):
+    """
+    Worker task: compute the signature of an image for the near-duplicate detection
+
+    @param item: a PNG path or an index in the packed dataset
+    @return: float32 Numpy array (see dedup.signature)
+    """
+    if _worker["images"] is not None:
+        image = np.asarray(_worker["images"][item])
+    else:
+        image = cv2.imread(item, cv2.IMREAD_GRAYSCALE)
+    return dedup.signature(image)
+
+
+def _preprocess_item(item):
+    """
+    Worker task: decode and preprocess an image like for the training
+
+    @param item: a PNG path or an index in the packed dataset
+    @return: float32 Numpy array of dimension (69, 223, 1)
+    """
+    if _worker["images"] is not None:
+        image = np.asarray(_worker["images"][item])
+    else:
+        image = cv2.imread(item, cv2.IMREAD_GRAYSCALE)
+    tensor = _worker["normalize"](_worker["crop"](image))
+    return tensor.astype(np.float32)
+
+
+def build_dataset(source, cache_folder, workers=None, geometry=None, chunksize=64, dedup_threshold=None):
+    """
+    Get the training arrays of a dataset, only the images missing in the cache are preprocessed
+
+    @param source: string path to a folder of labeled PNG or to a packed dataset
+    @param cache_folder: string path to the root folder of the caches
+    @param workers: number of processes, the number of CPU if None
+    @param geometry: the Geometry object of the preprocessing, CNN_GEOMETRY if None
+    @param chunksize: number of images sent at once to a worker
+    @param dedup_threshold: if not None, the near duplicates are removed (see labeling/dedup.py)
+    @return X: float32 Numpy array of dimension (n, 69, 223, 1)
+    @return y: float32 Numpy array of dimension (n, 2)
+    """
+    tensors, y, rows = build_cache(source, cache_folder, workers, geometry, chunksize, dedup_threshold)
+    return tensors[rows], y
+
+
+def build_cache(source, cache_folder, workers=None, geometry=None, chunksize=64, dedup_threshold=None):
+    """
+    Fill the cache with the missing images of a dataset
+
+    @param source: string path to a folder of labeled PNG or to a packed dataset
+    @param cache_folder: string path to the root folder of the caches
+    @param workers: number of processes, the number of CPU if None
+    @param geometry: the Geometry object of the preprocessing, CNN_GEOMETRY if None
+    @param chunksize: number of images sent at once to a worker
+    @param dedup_threshold: if not None, the near duplicates are removed (see labeling/dedup.py)
+    @return tensors: float32 Numpy array of the cache, memory-mapped
+    @return y: float32 Numpy array of dimension (n, 2)
+    @return rows: int Numpy array, the row in tensors of each image of the dataset
+    """
+    # Imported before the pool, the forked workers don't import it again
+    import deep_prediction
+    if geometry is None:
+        geometry = deep_prediction.CNN_GEOMETRY
+
+    items, y = list_frames(source)
+    cache = TensorCache(cache_folder, preprocessing_params(geometry), geometry.target_shape + (1,))
+
+    with Pool(workers, _init_worker, (source, geometry)) as pool:
+        if dedup_threshold is not None:
+            # The frames are compared in the order of the labeling sessions
+            ordered, sessions = dedup.dataset_order(source)
+            signatures = np.array(pool.map(_signature_item, ordered, chunksize))
+            keep = dedup.select(signatures, dedup_threshold, sessions)
+            kept = set(item for item, k in zip(ordered, keep) if k)
+            mask = np.array([item in kept for item in items], bool)
+            print("{} near duplicates removed".format(len(items) - mask.sum()))
+            items = [item for item, k in zip(items, mask) if k]
+            y = y[mask]
+
+        digests = pool.map(_hash_item, items, chunksize)
+
+        # The same image can be several times in the dataset
+        missing = {}
+        for item, digest in zip(items, digests):
+            if digest not in cache and digest not in missing:
+                missing[digest] = item
+
+        tensors = pool.imap(_preprocess_item, list(missing.values()), chunksize)
+        for digest, tensor in zip(missing, tensors):
+            cache.append(digest, tensor)
+
+    print("{} images, {} preprocessed, {} in the cache".format(len(items), len(missing), len(cache)))
+
+    rows = np.array([cache.rows[digest] for digest in digests], np.int64)
+    tensors = cache.load()
+    cache.close()
+    return tensors, y, rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="path to the folder of labeled PNG or to a packed dataset")
+    parser.add_argument("cache", help="path to the root folder of the caches")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    parser.add_argument("--dedup", type=float, help="remove the near duplicates below this difference")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tensors, y, rows = build_cache(args.dataset, args.cache, args.workers, dedup_threshold=args.dedup)
+    print("Done in {:.1f} s".format(time.perf_counter() - start))
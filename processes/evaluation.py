@@ -0,0 +1,251 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+
+import time
+import queue
+import threading
+from threading import Thread
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+"""
+Offline evaluation of the predictors on recorded videos.
+The video is decoded by a thread, the frames are preprocessed by a pool of threads
+(OpenCV releases the GIL) and the CNN is run on large batches.
+The predictions are saved in a npz file with one array per column (frame, direction, speed...).
+Run it from the project root, for instance :
+    python processes/evaluation.py cnn data/videos/move_by_hand1.mp4 predictions.npz --weights weights_last.h5
+    python processes/evaluation.py hough data/videos/move_by_hand1.mp4 predictions.npz
+"""
+
+def read_chunks(videopath, chunk_size, size=(456, 228), start=0):
+    """
+    Decode a video by chunks of frames
+
+    @param videopath: string path to a video
+    @param chunk_size: number of frames in a chunk
+    @param size: (width, height) of the frames given to the predictors
+    @param start: position of the first frame read
+    @return: generator of lists of OpenCV images
+    """
+    cap = cv2.VideoCapture(videopath)
+    if (cap.isOpened()== False):
+        print("Error opening video stream or file")
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    chunk = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame.shape[1::-1] != size:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        chunk.append(frame)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    cap.release()
+
+    if chunk:
+        yield chunk
+
+
+def prefetch(generator, size=2):
+    """
+    Run a generator in a background thread
+
+    @param generator: any generator
+    @param size: number of items prepared in advance
+    @return: generator of the same items
+    """
+    items = queue.Queue(size)
+    end = object()
+
+    def fill():
+        for item in generator:
+            items.put(item)
+        items.put(end)
+
+    Thread(target=fill, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            return
+        yield item
+
+
+class CNNEvaluator:
+    """
+    The preprocessing of deep_prediction.Image2Prediction (ProcessChain)
+    and the CNN run on batches of frames.
+
+    The batches given to the backend are split in smaller ones (inference_batch):
+    the NumPy backend is faster when its buffers stay in the CPU cache.
+    """
+    def __init__(self, weights_path, workers=4, inference_batch=32):
+        """
+        Attribute initialization
+
+        @param weights_path: string path to Keras weights (.h5) or a TensorFlow Lite model (.tflite)
+        @param workers: number of preprocessing threads
+        @param inference_batch: maximum number of frames given at once to the backend
+        """
+        from inference import load_backend
+        from geometry import CNN_GEOMETRY
+
+        self.backend = load_backend(weights_path)
+        self.inference_batch = inference_batch
+        self.tensor_shape = CNN_GEOMETRY.target_shape + (1,)
+        self.pool = ThreadPool(workers)
+        # One buffered ProcessChain per thread
+        self.local = threading.local()
+
+    def _preprocess(self, args):
+        """
+        Preprocess a frame in a row of the batch
+
+        @param args: tuple (frame, row of the batch)
+        """
+        from deep_prediction import ProcessChain
+
+        chain = getattr(self.local, "chain", None)
+        if chain is None:
+            chain = self.local.chain = ProcessChain(buffered=True)
+        frame, row = args
+        np.copyto(row, chain.transform(frame), casting="unsafe")
+
+    def predict(self, frames):
+        """
+        @param frames: list of OpenCV images of dimension (456, 228, 3)
+        @return: dict of columns for these frames
+        """
+        batch = np.empty((len(frames),) + self.tensor_shape, np.float32)
+        self.pool.map(self._preprocess, zip(frames, batch))
+
+        predictions = np.empty((len(frames), 2), np.float32)
+        for start in range(0, len(frames), self.inference_batch):
+            end = start + self.inference_batch
+            predictions[start:end] = self.backend.predict(batch[start:end])
+        direction, speed = predictions.T
+
+        return {
+            "direction": direction.copy(),
+            "speed": speed.copy(),
+            # Speed sent to the car by Image2Prediction.predict_and_apply
+            "applied_speed": 1.2*speed - 0.2,
+        }
+
+    def close(self):
+        self.pool.close()
+
+
+class HoughEvaluator:
+    """
+    The line detection of line_prediction.ProcessChain run by a pool of threads,
+    then the prediction of line_prediction.Image2Prediction.predict on the whole video
+    """
+    def __init__(self, workers=4, width=456):
+        """
+        Attribute initialization
+
+        @param workers: number of preprocessing threads
+        @param width: width of the frames
+        """
+        from line_prediction import ProcessChain
+
+        self.chain = ProcessChain()
+        self.pool = ThreadPool(workers)
+        self.width = width
+        # The 12 last directions of Image2Prediction.predict
+        self.history = np.zeros(12)
+
+    def _transform(self, frame):
+        """
+        @param frame: an OpenCV image of dimension (456, 228, 3)
+        @return: the target point, NaN if no line is found
+        """
+        point = self.chain.transform(frame)
+        return np.nan if point is None else point
+
+    def predict(self, frames):
+        """
+        When no line is found, Image2Prediction keeps the direction and slows down:
+        the direction is NaN and the speed 0.33
+
+        @param frames: list of OpenCV images of dimension (456, 228, 3)
+        @return: dict of columns for these frames
+        """
+        points = np.array(self.pool.map(self._transform, frames), np.float64)
+        found = ~np.isnan(points)
+
+        x = (points[found] - self.width/2) / self.width
+        raw_direction = 2.5 * np.arctan(x)
+
+        # Mean of the 4 newest directions, with the history of the previous frames
+        directions = np.concatenate([self.history, raw_direction])
+        sums = np.cumsum(np.concatenate([[0], directions]))
+        newest = (sums[4:] - sums[:-4])[-len(raw_direction):] / 4 if len(raw_direction) else raw_direction
+        self.history = directions[-12:]
+
+        direction = np.full(len(frames), np.nan)
+        speed = np.full(len(frames), 0.33)
+        direction[found] = np.clip(raw_direction, -1, 1)
+        speed[found] = 1 - np.abs(newest)*0.9
+
+        return {"point": points, "direction": direction, "speed": speed}
+
+    def close(self):
+        self.pool.close()
+
+
+def evaluate_video(evaluator, videopath, batch_size=256):
+    """
+    Run a predictor on all the frames of a video
+
+    @param evaluator: a CNNEvaluator or a HoughEvaluator
+    @param videopath: string path to a video
+    @param batch_size: number of frames in a batch
+    @return: dict of columns, each one a Numpy array with one value per frame
+    """
+    results = []
+    for chunk in prefetch(read_chunks(videopath, batch_size)):
+        results.append(evaluator.predict(chunk))
+
+    if not results:
+        return {"frame": np.empty(0, np.int64)}
+    columns = {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+    columns["frame"] = np.arange(len(columns["direction"]))
+    return columns
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("predictor", choices=["cnn", "hough"], help="the predictor to evaluate")
+    parser.add_argument("video", help="video path")
+    parser.add_argument("output", help="path to the output npz file")
+    parser.add_argument("--weights", default="weights_last.h5", help="path to the weights of the CNN")
+    parser.add_argument("--batch", type=int, default=256, help="number of frames in a batch")
+    parser.add_argument("--workers", type=int, default=4, help="number of preprocessing threads")
+    parser.add_argument("--inference-batch", type=int, default=32, help="number of frames given at once to the CNN")
+    args = parser.parse_args()
+
+    if args.predictor == "cnn":
+        evaluator = CNNEvaluator(args.weights, args.workers, args.inference_batch)
+    else:
+        evaluator = HoughEvaluator(args.workers)
+
+    start = time.perf_counter()
+    columns = evaluate_video(evaluator, args.video, args.batch)
+    duration = time.perf_counter() - start
+    evaluator.close()
+
+    np.savez(args.output, **columns)
+    nb_frames = len(columns["frame"])
+    print("{} frames in {:.1f} s ({:.0f} frames/s), saved in {}".format(
+        nb_frames, duration, nb_frames / max(duration, 1e-9), args.output))
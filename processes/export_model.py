@@ -0,0 +1,256 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+
+import numpy as np
+
+from inference import NumpyBackend, OnnxBackend, load_h5_weights, save_model
+
+"""
+Export the CNN trained with Keras (deep_prediction.build_model) or with PyTorch
+(Network of experimentations/pytorch/model_training_v3.ipynb) in a format
+independent of the framework, loaded on the car by inference.load_backend:
+    - .npz : the 12 arrays in the Keras layout, run by inference.NumpyBackend
+    - .onnx : the ONNX graph of the same model, run by ONNX Runtime (needs the onnx package)
+
+Both networks have the same layers, only the layouts of the weights differ,
+and the PyTorch one is trained on images normalized between 0 and 255 instead of 0 and 1.
+The first convolution is linear, so the factor 255 is moved in its kernel:
+every exported model takes the tensors of deep_prediction.ProcessChain.
+
+The exported model is checked against the source model: the PyTorch Network for a PyTorch file
+(with the images multiplied by 255, in NCHW), the NumPy forward pass of the weights for a Keras file.
+Run it from the project root, for instance :
+    python processes/export_model.py weights_last.h5 model.npz
+    python processes/export_model.py data/weights/weights_torch_v3_99.weights model.onnx
+"""
+
+INPUT_SHAPE = (69, 223, 1)
+
+# Extensions of the PyTorch files saved with torch.save
+TORCH_EXTENSIONS = (".pt", ".pth", ".weights")
+
+
+def source_framework(source, framework=None):
+    """
+    @param source: string path to the Keras h5 file or to the PyTorch file
+    @param framework: "keras" or "torch", chosen from the extension of source if None
+    @return: "keras" or "torch"
+    """
+    if framework is None:
+        framework = "torch" if source.endswith(TORCH_EXTENSIONS) else "keras"
+    if framework not in ("keras", "torch"):
+        raise ValueError("unknown framework {}, expected keras or torch".format(framework))
+    return framework
+
+
+def keras_weights(path):
+    """
+    Read the weights of a Keras model, without TensorFlow
+
+    @param path: string path to the h5 file, like weights_last.h5
+    @return: list of the 12 Numpy arrays in the order of model.get_weights()
+    """
+    return load_h5_weights(path)
+
+
+def torch_weights(path, input_scale=255.):
+    """
+    Read the state_dict of the PyTorch Network and convert it to the Keras layout:
+        - the Conv2d kernels (out, in, h, w) become (h, w, in, out)
+        - the Linear weights (out, in) are transposed
+        - the inputs of the first Linear are reordered: nn.Flatten reads the
+          feature maps channel first, Keras Flatten reads them channel last
+    In the notebook, MaxPool2d is before ReLU, both orders give the same result.
+
+    @param path: string path to the state_dict saved by torch.save, like in the notebook
+    @param input_scale: maximum of the normalized images of the training
+    @return: list of the 12 Numpy arrays in the order of model.get_weights()
+    """
+    import torch
+
+    state = torch.load(path, map_location="cpu")
+    arrays = [value.detach().numpy().astype(np.float32) for value in state.values()]
+    if len(arrays) != 12:
+        raise ValueError("12 arrays expected in the state_dict, got {}".format(len(arrays)))
+
+    weights = []
+    for i in range(0, 6, 2):
+        weights += [arrays[i].transpose(2, 3, 1, 0), arrays[i+1]]
+    weights[0] = weights[0] * input_scale
+
+    # Dimension (height, width, channels) of the last feature maps
+    height, width = INPUT_SHAPE[:2]
+    for _ in range(3):
+        height, width = (height - 2) // 2, (width - 2) // 2
+    channels = weights[4].shape[3]
+
+    first = arrays[6].reshape(-1, channels, height, width).transpose(2, 3, 1, 0)
+    weights += [first.reshape(height * width * channels, -1), arrays[7]]
+    for i in range(8, 12, 2):
+        weights += [arrays[i].T, arrays[i+1]]
+    return [np.ascontiguousarray(w) for w in weights]
+
+
+def torch_network(path):
+    """
+    The Network of the notebook, with the weights of the state_dict
+
+    @param path: string path to the state_dict saved by torch.save
+    @return: the torch.nn.Module in evaluation mode
+    """
+    import torch
+    from torch import nn
+
+    class Network(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.cnn_layers = nn.Sequential(
+                nn.Conv2d(in_channels=1, out_channels=3, kernel_size=3),
+                nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2)),
+                nn.ReLU(),
+                nn.Conv2d(in_channels=3, out_channels=3, kernel_size=3),
+                nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2)),
+                nn.ReLU(),
+                nn.Conv2d(in_channels=3, out_channels=3, kernel_size=3),
+                nn.MaxPool2d(kernel_size=(2, 2), stride=(2, 2)),
+                nn.ReLU(),
+            )
+            self.flatten = nn.Flatten()
+            self.linear_layers = nn.Sequential(
+                nn.Linear(468, 50),
+                nn.ReLU(),
+                nn.Linear(50, 8),
+                nn.ReLU(),
+                nn.Linear(8, 2),
+            )
+
+        def forward(self, x):
+            return self.linear_layers(self.flatten(self.cnn_layers(x)))
+
+    network = Network()
+    network.load_state_dict(torch.load(path, map_location="cpu"))
+    return network.eval()
+
+
+def save_onnx(path, weights, opset=13):
+    """
+    Write the ONNX graph of the model.
+    The input is NHWC like the other backends, it is transposed for the convolutions.
+
+    @param path: string path to the .onnx file
+    @param weights: list of the 12 arrays in the order of model.get_weights()
+    @param opset: version of the ONNX operators
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    nodes, initializers = [], []
+
+    def constant(name, array):
+        initializers.append(numpy_helper.from_array(np.ascontiguousarray(array, np.float32), name))
+        return name
+
+    nodes.append(helper.make_node("Transpose", ["input"], ["x0"], perm=[0, 3, 1, 2]))
+    item = "x0"
+    for i in range(3):
+        kernel, bias = weights[2*i], weights[2*i + 1]
+        nodes.append(helper.make_node("Conv", [item, constant("conv{}_w".format(i), kernel.transpose(3, 2, 0, 1)),
+                                               constant("conv{}_b".format(i), bias)], ["conv{}".format(i)]))
+        nodes.append(helper.make_node("Relu", ["conv{}".format(i)], ["relu{}".format(i)]))
+        nodes.append(helper.make_node("MaxPool", ["relu{}".format(i)], ["pool{}".format(i)],
+                                      kernel_shape=[2, 2], strides=[2, 2]))
+        item = "pool{}".format(i)
+
+    # Back to channel last before the flatten, like Keras
+    nodes.append(helper.make_node("Transpose", [item], ["nhwc"], perm=[0, 2, 3, 1]))
+    nodes.append(helper.make_node("Flatten", ["nhwc"], ["flat"], axis=1))
+    item = "flat"
+    for i in range(3):
+        weight, bias = weights[6 + 2*i], weights[7 + 2*i]
+        output = "output" if i == 2 else "dense{}".format(i)
+        nodes.append(helper.make_node("Gemm", [item, constant("dense{}_w".format(i), weight),
+                                               constant("dense{}_b".format(i), bias)], [output]))
+        if i < 2:
+            nodes.append(helper.make_node("Relu", [output], ["dense{}_relu".format(i)]))
+            item = "dense{}_relu".format(i)
+
+    graph = helper.make_graph(
+        nodes, "titaniumcar",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["n"] + list(INPUT_SHAPE))],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["n", weights[-1].shape[0]])],
+        initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", opset)],
+                              producer_name="titaniumcar")
+    # Readable by the older ONNX Runtime of the Raspberry Pi
+    model.ir_version = 7
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+
+def export(source, output, framework=None, input_scale=255.):
+    """
+    Convert a trained model, the format of the output is given by its extension
+
+    @param source: string path to the Keras h5 file or to the PyTorch file
+    @param output: string path to the .npz or .onnx file
+    @param framework: "keras" or "torch", chosen from the extension of source if None
+    @param input_scale: maximum of the normalized images of the PyTorch training
+    @return: list of the 12 exported arrays in the order of model.get_weights()
+    """
+    if source_framework(source, framework) == "torch":
+        weights = torch_weights(source, input_scale)
+    else:
+        weights = keras_weights(source)
+
+    if output.endswith(".onnx"):
+        save_onnx(output, weights)
+    elif output.endswith(".npz"):
+        save_model(output, weights, framework)
+    else:
+        raise ValueError("unknown format of {}, expected .npz or .onnx".format(output))
+    return weights
+
+
+def check(output, source, framework=None, input_scale=255., nb_images=16, seed=0):
+    """
+    Compare the exported model with the source model:
+    the forward pass of the PyTorch Network on the images scaled like its training,
+    or the NumPy forward pass of the Keras weights (TensorFlow isn't needed)
+
+    @param output: string path to the .npz or .onnx file
+    @param source: string path to the Keras h5 file or to the PyTorch file
+    @param framework: "keras" or "torch", chosen from the extension of source if None
+    @param input_scale: maximum of the normalized images of the PyTorch training
+    @param nb_images: number of random binary images, like the edges of ProcessChain
+    @param seed: seed of the images
+    @return: the maximum absolute difference between the predictions
+    """
+    rng = np.random.RandomState(seed)
+    batch = (rng.rand(nb_images, *INPUT_SHAPE) < 0.1).astype(np.float32)
+    if source_framework(source, framework) == "torch":
+        import torch
+
+        with torch.no_grad():
+            images = torch.from_numpy(batch * input_scale).permute(0, 3, 1, 2)
+            expected = torch_network(source)(images).numpy()
+    else:
+        expected = NumpyBackend(keras_weights(source)).predict(batch).copy()
+    backend = OnnxBackend(output) if output.endswith(".onnx") else NumpyBackend.from_npz(output)
+    return float(np.abs(backend.predict(batch) - expected).max())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="path to the Keras h5 file or to the PyTorch file")
+    parser.add_argument("output", help="path to the exported model, .npz or .onnx")
+    parser.add_argument("--framework", choices=["keras", "torch"], help="framework of the source, from its extension by default")
+    parser.add_argument("--input-scale", type=float, default=255., help="maximum of the images of the PyTorch training")
+    args = parser.parse_args()
+
+    export(args.source, args.output, args.framework, args.input_scale)
+    print("Saved {} ({} bytes), maximum difference {:.2e}".format(
+        args.output, os.path.getsize(args.output),
+        check(args.output, args.source, args.framework, args.input_scale)))
@@ -0,0 +1,305 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "labeling"))
+
+import json
+import queue
+from threading import Thread
+
+import cv2
+import numpy as np
+
+import dataset
+from dataset_builder import preprocessing_params, PARAMS_FILE, TENSORS_FILE
+
+"""
+Streaming input pipeline for the training of the CNN.
+The images are read lazily from several shards (packed datasets, folders of PNG
+or tensor shards of synthetic.py), shuffled in a buffer of limited size,
+preprocessed like in deep_prediction and grouped in batches by a background thread.
+The tensor shards are already preprocessed, their parameters must be the ones of the geometry.
+The memory used doesn't depend on the size of the dataset, for instance :
+
+    stream = StreamingDataset(["data/packed1/", "data/packed2/"], batch_size=64)
+    model.fit_generator(stream.generator(), steps_per_epoch=len(stream), epochs=10)
+or with tf.data :
+    model.fit(stream.to_tf_dataset(), steps_per_epoch=len(stream), epochs=10)
+"""
+
+def is_tensor_shard(source):
+    """
+    @param source: string path to a folder
+    @return: True if the folder is a shard of preprocessed tensors written by synthetic.py
+    """
+    return all(os.path.exists(os.path.join(source, name)) for name in (PARAMS_FILE, TENSORS_FILE, dataset.LABELS_FILE))
+
+
+class Shard:
+    """
+    Lazy access to the images and labels of one dataset
+    """
+    def __init__(self, source):
+        """
+        Read the labels, the images are read only when needed
+
+        @param source: string path to a packed dataset, a folder of labeled PNG or a tensor shard
+        """
+        self.source = source
+        self.params = None
+        if is_tensor_shard(source):
+            # Like synthetic.load_shard, the tensors are memory-mapped
+            with open(os.path.join(source, PARAMS_FILE)) as f:
+                meta = json.load(f)
+            count, shape = meta["count"], tuple(meta["shape"])
+            self.params = meta["params"]
+            self.images = np.memmap(os.path.join(source, TENSORS_FILE), np.float32, "r", shape=(count,) + shape)
+            self.names = None
+            self.y = dataset.targets(np.fromfile(os.path.join(source, dataset.LABELS_FILE), dataset.LABEL_DTYPE, count))
+        elif dataset.is_packed(source):
+            self.images, labels = dataset.load(source)
+            self.names = None
+            self.y = dataset.targets(labels)
+        else:
+            self.images = None
+            self.names = sorted(name for name in os.listdir(source) if ".png" in name)
+            self.y = np.array([dataset.get_labels(name) for name in self.names], np.float32).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.y)
+
+    @property
+    def preprocessed(self):
+        """
+        @return: True if the images are already the tensors of Crop and Normalize
+        """
+        return self.params is not None
+
+    def image(self, index):
+        """
+        @param index: index of the image in the shard
+        @return: uint8 grayscale image of dimension (114, 228),
+                 or float32 tensor of dimension (69, 223, 1) for a tensor shard
+        @raise IOError: if the PNG can't be read
+        """
+        if self.images is not None:
+            return np.array(self.images[index])
+        path = os.path.join(self.source, self.names[index])
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise IOError("can't read the image {}".format(path))
+        return image
+
+
+class StreamingDataset:
+    """
+    An endless stream of shuffled and preprocessed batches (X, y).
+
+    Each epoch, the shards are read in a random order,
+    and each shard by blocks of consecutive images in a random order
+    (consecutive reads are fast in a memory-mapped file).
+    The images go through a shuffle buffer: a random image of the buffer
+    is taken out each time a new image is put in.
+    A thread prepares the next batches (prefetch) while the model is training,
+    an error in this thread is raised again by the generator.
+
+    Only the shuffle buffer and the prefetched batches are in memory.
+    """
+    def __init__(self, sources, batch_size=64, shuffle_buffer=2048, block_size=256,
+                 prefetch=4, seed=0, geometry=None):
+        """
+        Attribute initialization
+
+        @param sources: list of string paths to packed datasets, folders of labeled PNG or tensor shards
+        @param batch_size: number of images in a batch
+        @param shuffle_buffer: number of images in the shuffle buffer
+        @param block_size: number of consecutive images read in a shard
+        @param prefetch: number of batches prepared in advance
+        @param seed: seed of the shuffles
+        @param geometry: the Geometry object of the preprocessing, CNN_GEOMETRY if None
+        @raise ValueError: if the sources contain no image, the stream would never yield,
+                           or if a tensor shard was preprocessed with other parameters
+        """
+        from deep_prediction import Crop, Normalize, CNN_GEOMETRY
+
+        if geometry is None:
+            geometry = CNN_GEOMETRY
+        self.crop = Crop(geometry)
+        self.normalize = Normalize(geometry)
+        self.tensor_shape = geometry.target_shape + (1,)
+
+        self.shards = [Shard(source) for source in sources]
+        if not sum(len(shard) for shard in self.shards):
+            raise ValueError("no image in the sources {}".format(sources))
+        params = preprocessing_params(geometry)
+        for shard in self.shards:
+            if shard.preprocessed and shard.params != params:
+                raise ValueError("the tensors of {} were preprocessed with {}, expected {}".format(
+                    shard.source, shard.params, params))
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.rng = np.random.RandomState(seed)
+
+        self.queue = None
+        self.thread = None
+        self.running = False
+
+    def __len__(self):
+        """
+        @return: number of batches in an epoch
+        """
+        nb_images = sum(len(shard) for shard in self.shards)
+        return -(-nb_images // self.batch_size)
+
+    def indexes(self):
+        """
+        The order of the reads for one epoch
+
+        @return: generator of (shard, index) tuples
+        """
+        for s in self.rng.permutation(len(self.shards)):
+            shard = self.shards[s]
+            starts = np.arange(0, len(shard), self.block_size)
+            for start in self.rng.permutation(starts):
+                for index in range(start, min(start + self.block_size, len(shard))):
+                    yield shard, index
+
+    def samples(self):
+        """
+        Endless stream of shuffled (image, labels, preprocessed), epoch after epoch
+
+        @return: generator of (image, float32 labels, bool) tuples, the images
+                 of the tensor shards are already preprocessed
+        """
+        buffer = []
+        while True:
+            for shard, index in self.indexes():
+                sample = (shard.image(index), shard.y[index], shard.preprocessed)
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = self.rng.randint(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield sample
+
+            # End of the epoch, the buffer is emptied in a random order
+            # so the epoch contains each image once
+            self.rng.shuffle(buffer)
+            while buffer:
+                yield buffer.pop()
+
+    def batches(self):
+        """
+        Endless stream of preprocessed batches, without prefetch
+
+        @return: generator of (X, y): float32 Numpy arrays of dimension (n, 69, 223, 1) and (n, 2)
+        """
+        samples = self.samples()
+        while True:
+            X = np.empty((self.batch_size,) + self.tensor_shape, np.float32)
+            y = np.empty((self.batch_size, 2), np.float32)
+            for i in range(self.batch_size):
+                image, labels, preprocessed = next(samples)
+                X[i] = image if preprocessed else self.normalize(self.crop(image))
+                y[i] = labels
+            yield X, y
+
+    def start(self):
+        """
+        Start the prefetch thread
+
+        @return: self
+        """
+        self.queue = queue.Queue(self.prefetch)
+        self.running = True
+        self.thread = Thread(target=self._fill, daemon=True)
+        self.thread.start()
+        return self
+
+    def _fill(self):
+        """
+        Loop of the prefetch thread.
+        An exception ends the loop, it is put in the queue instead of a batch
+        """
+        try:
+            for batch in self.batches():
+                if not self._put(batch):
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        """
+        Wait for a free place in the queue, unless the thread is stopped
+
+        @param item: a batch or an exception
+        @return: False if the thread is stopped
+        """
+        while self.running:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        """
+        Stop the prefetch thread
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def generator(self):
+        """
+        Endless stream of prefetched batches, for model.fit_generator
+
+        @return: generator of (X, y) batches
+        @raise RuntimeError: if the prefetch thread failed
+        """
+        if self.thread is None:
+            self.start()
+        while True:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.stop()
+                raise RuntimeError("the prefetch thread failed: {!r}".format(item)) from item
+            yield item
+
+    def to_tf_dataset(self):
+        """
+        The prefetched batches in a tf.data.Dataset, for model.fit
+
+        @return: a tf.data.Dataset of (X, y) batches
+        """
+        import tensorflow as tf
+
+        return tf.data.Dataset.from_generator(
+            self.generator,
+            (tf.float32, tf.float32),
+            (tf.TensorShape((self.batch_size,) + self.tensor_shape), tf.TensorShape((self.batch_size, 2))))
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="paths to packed datasets, folders of labeled PNG or tensor shards")
+    parser.add_argument("--batches", type=int, default=100, help="number of batches read")
+    args = parser.parse_args()
+
+    # Read speed of the pipeline
+    stream = StreamingDataset(args.sources)
+    batches = stream.generator()
+    start = time.perf_counter()
+    for _ in range(args.batches):
+        X, y = next(batches)
+    duration = time.perf_counter() - start
+    stream.stop()
+    print("{} batches of {} images in {:.1f} s ({:.0f} images/s)".format(
+        args.batches, stream.batch_size, duration, args.batches * stream.batch_size / duration))
@@ -0,0 +1,242 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "labeling"))
+
+import time
+
+import cv2
+import numpy as np
+
+import dataset
+
+"""
+Export the trained CNN to TensorFlow Lite in float32, float16 and int8,
+then compare the accuracy, the latency, the size and the memory of each model.
+The int8 model is calibrated with images of the labeled dataset.
+Run it from the project root, for instance :
+    python processes/quantize.py weights_last.h5 data/datasetv3/ data/weights/
+"""
+
+def load_dataset(folder, nb_images=None, seed=0, skip=0):
+    """
+    Load and preprocess the labeled images like for the training.
+    The images are taken in a random permutation of the dataset:
+    with the same seed, different "skip" give disjoint sets (calibration and test)
+
+    @param folder: string path to the folder of labeled PNG or to a packed dataset (see labeling/dataset.py)
+    @param nb_images: number of images to load, all the remaining ones if None
+    @param seed: seed of the permutation
+    @param skip: number of images skipped at the beginning of the permutation
+    @return X: float32 Numpy array of dimension (n, 69, 223, 1)
+    @return y: float32 Numpy array of dimension (n, 2)
+    """
+    from deep_prediction import Crop, Normalize
+
+    if dataset.is_packed(folder):
+        images, labels = dataset.load(folder)
+        indexes = np.arange(len(images))
+        read_image = lambda i: images[i]
+        y = dataset.targets(labels)
+    else:
+        names = sorted(name for name in os.listdir(folder) if ".png" in name)
+        indexes = np.arange(len(names))
+        read_image = lambda i: cv2.imread(os.path.join(folder, names[i]), cv2.IMREAD_GRAYSCALE)
+        y = np.array([dataset.get_labels(name) for name in names], np.float32).reshape(-1, 2)
+
+    indexes = np.random.RandomState(seed).permutation(indexes)
+    end = len(indexes) if nb_images is None else skip + nb_images
+    indexes = indexes[skip:end]
+
+    crop, normalize = Crop(), Normalize()
+    X = np.empty((len(indexes), 69, 223, 1), np.float32)
+    for i, index in enumerate(indexes):
+        X[i] = normalize(crop(read_image(index)))
+
+    return X, y[indexes]
+
+
+def export_tflite(model, session, path, mode, calibration=None):
+    """
+    Convert the Keras model to TensorFlow Lite
+
+    @param model: the Keras model built with a batch size of 1
+    @param session: the TensorFlow session of the model
+    @param path: string path to the output .tflite file
+    @param mode: "float32", "float16" or "int8"
+    @param calibration: float32 Numpy array of images for "int8"
+    @return: the size of the file in bytes
+    @raise RuntimeError: if the TensorFlow version can't export the mode
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_session(session, model.inputs, model.outputs)
+    if mode == "float16":
+        # TensorFlow 1.14 (environment.yml) has no supported_types: setting it is ignored
+        # and the converter makes a dynamic range int8 model instead
+        if not hasattr(converter.target_spec, "supported_types"):
+            raise RuntimeError("the float16 export needs TensorFlow >= 1.15, found {}".format(tf.__version__))
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        if calibration is None:
+            raise ValueError("int8 export needs calibration images")
+
+        def representative_dataset():
+            for image in calibration:
+                yield [image[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif mode != "float32":
+        raise ValueError("Unknown mode : {}".format(mode))
+
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+    # The converters silently fall back to another type when an option isn't supported
+    expected = {"float16": np.float16, "int8": np.int8}.get(mode)
+    if expected is not None and expected not in tensor_types(path):
+        raise RuntimeError("the {} export of TensorFlow {} has no {} tensor, found {}".format(
+            mode, tf.__version__, mode, sorted(t.__name__ for t in tensor_types(path))))
+    return os.path.getsize(path)
+
+
+def tensor_types(path):
+    """
+    @param path: string path to a .tflite file
+    @return: set of the Numpy types of the tensors of the model
+    """
+    from inference import TFLiteBackend
+
+    interpreter = TFLiteBackend(path).interpreter
+    return set(np.dtype(tensor["dtype"]).type for tensor in interpreter.get_tensor_details())
+
+
+def evaluate(backend, X, y):
+    """
+    Run the model image by image, like on the car
+
+    @param backend: an object with a predict method (see titaniumcar/inference.py)
+    @param X: float32 Numpy array of dimension (n, 69, 223, 1)
+    @param y: float32 Numpy array of dimension (n, 2)
+    @return mae: mean absolute error of the direction and of the speed
+    @return latency: mean time of a prediction in seconds
+    """
+    predictions = np.empty_like(y)
+    start = time.perf_counter()
+    for i in range(len(X)):
+        predictions[i] = backend.predict(X[i:i+1])[0]
+    latency = (time.perf_counter() - start) / len(X)
+
+    mae = np.abs(predictions - y).mean(axis=0)
+    return mae, latency
+
+
+def resident_memory():
+    """
+    @return: resident memory of the process in bytes, None without /proc (not Linux)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _backend_memory(path, nb_images):
+    """
+    Task of backend_memory, in the new process
+    """
+    from inference import load_backend
+
+    batch = np.zeros((1, 69, 223, 1), np.float32)
+    before = resident_memory()
+    backend = load_backend(path)
+    for _ in range(nb_images):
+        backend.predict(batch)
+    after = resident_memory()
+    return None if before is None else after - before
+
+
+def backend_memory(path, nb_images=10):
+    """
+    Memory of a model on the car: the growth of the resident memory of a new process
+    from the loading of the model to the end of a few predictions.
+    It contains the runtime (TensorFlow Lite), the weights and the buffers of the inference.
+    A new process doesn't reuse the memory freed by the other models.
+
+    @param path: string path to a model read by inference.load_backend
+    @param nb_images: number of predictions
+    @return: the memory in bytes, None if it can't be measured
+    """
+    from multiprocessing import get_context
+
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(_backend_memory, (path, nb_images))
+
+
+def report(backends, paths, X, y):
+    """
+    Print the accuracy, the latency, the size and the memory of each model
+
+    @param backends: dict name -> backend, the first one is the reference
+    @param paths: dict name -> string path to the model file of the backend
+    @param X: float32 Numpy array of dimension (n, 69, 223, 1)
+    @param y: float32 Numpy array of dimension (n, 2)
+    """
+    print("{:<10} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10}".format(
+        "model", "MAE dir", "delta", "MAE speed", "delta", "latency", "size", "memory"))
+
+    reference = None
+    for name, backend in backends.items():
+        mae, latency = evaluate(backend, X, y)
+        if reference is None:
+            reference = mae
+        delta = mae - reference
+        memory = backend_memory(paths[name])
+        memory = "n/a" if memory is None else "{:.1f}kB".format(memory / 1000)
+        print("{:<10} {:9.4f} {:+9.4f} {:9.4f} {:+9.4f} {:8.3f}ms {:8.1f}kB {:>10}".format(
+            name, mae[0], delta[0], mae[1], delta[1], 1000*latency, os.path.getsize(paths[name])/1000, memory))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("weights", help="path to the Keras weights")
+    parser.add_argument("dataset", help="path to the folder of labeled PNG or to a packed dataset")
+    parser.add_argument("output", help="path to the output folder")
+    parser.add_argument("--calibration", type=int, default=500, help="number of calibration images")
+    parser.add_argument("--test", type=int, default=2000, help="number of evaluation images")
+    args = parser.parse_args()
+
+    import deep_prediction
+    from inference import NumpyBackend, TFLiteBackend
+
+    if not os.path.exists(args.output):
+        os.mkdir(args.output)
+
+    model = deep_prediction.build_model(args.weights)
+    # Created by build_model
+    session = deep_prediction.session
+    # Disjoint sets: the calibration images aren't scored
+    calibration, _ = load_dataset(args.dataset, args.calibration, seed=0)
+    X, y = load_dataset(args.dataset, args.test, seed=0, skip=args.calibration)
+
+    backends = {"numpy": NumpyBackend.from_h5(args.weights)}
+    paths = {"numpy": args.weights}
+    for mode in ["float32", "float16", "int8"]:
+        path = os.path.join(args.output, "model_{}.tflite".format(mode))
+        try:
+            with session.as_default(), session.graph.as_default():
+                export_tflite(model, session, path, mode, calibration)
+        except RuntimeError as error:
+            print("No {} model: {}".format(mode, error))
+            continue
+        backends[mode] = TFLiteBackend(path)
+        paths[mode] = path
+        print("Saved", path)
+
+    report(backends, paths, X, y)
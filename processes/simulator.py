@@ -0,0 +1,485 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+
+import time
+from math import sin, cos, tan, atan, radians
+
+import cv2
+import numpy as np
+
+from circuit import generate_circuit, load_circuits
+from pwm import SimulatedPCA9685
+
+"""
+Headless closed-loop simulator: a car of car.py drives a generated circuit
+with one of the predictors, faster than real time.
+
+The circuit of circuit.py is the centerline of the track, its corners are rounded.
+The track is drawn once on a bird's-eye raster of the floor (1 pixel per cm);
+the camera view is one cv2.warpPerspective of the raster around the car.
+The predictors get the 456x228 RGB frames at 30 fps of simulated time and call
+set_direction/set_speed; the moving loop of the car is stepped at its rate,
+and the PWM it sends to a SimulatedPCA9685 drive a kinematic bicycle model.
+
+The clock is simulated: a lap takes the time of the predictor and the rendering,
+not the time of the car. The pure pursuit controller doesn't use the frames,
+so many laps are run per second to tune the cars.
+
+Run it from the project root, for instance :
+    python processes/simulator.py hough --car Car --circuits 5
+    python processes/simulator.py pursuit --car F1 --circuits 100
+"""
+
+FLOOR_COLOR = (90, 90, 95)
+TAPE_COLOR = (225, 225, 230)
+
+
+class Track:
+    """
+    The floor of a circuit seen from above, in cm
+    """
+    def __init__(self, outline, scale=2.0, width=60, radius=60, tape=4, dash=(30, 20), margin=150, seed=0):
+        """
+        Draw the track
+
+        @param outline: Numpy array of dimension (n, 2), the vertices of the centerline (circuit.py units)
+        @param scale: number of cm per unit of the outline
+        @param width: width of the track in cm, between the borders
+        @param radius: radius of the rounded corners in cm
+        @param tape: width of the lines in cm
+        @param dash: (length of a dash, length of a gap) of the middle line in cm
+        @param margin: floor around the track in cm
+        @param seed: seed of the noise of the floor
+        """
+        outline = np.asarray(outline, np.float64) * scale
+        origin = outline.min(axis=0) - margin
+        size = np.ceil(outline.max(axis=0) + margin - origin).astype(int)
+
+        # The centerline sampled every cm, in the coordinates of the raster
+        points = resample(round_corners(outline - origin, radius), 1.0)
+        # The start is in the middle of the longest straight line
+        lengths = np.linalg.norm(np.roll(outline, -1, axis=0) - outline, axis=1)
+        longest = np.argmax(lengths)
+        middle = (outline[longest] + outline[(longest + 1) % len(outline)]) / 2 - origin
+        start = np.argmin(np.square(points - middle).sum(axis=1))
+        self.points = np.roll(points, -start, axis=0)
+        segments = np.roll(self.points, -1, axis=0) - self.points
+        self.headings = np.arctan2(segments[:, 1], segments[:, 0])
+        self.length = len(self.points)
+        self.width = width
+
+        # The road, the borders on its edges and the dashed middle line
+        self.road = np.zeros((size[1], size[0]), np.uint8)
+        cv2.polylines(self.road, [np.round(self.points).astype(np.int32)], True, 255, width)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (tape, tape))
+        lines = cv2.morphologyEx(self.road, cv2.MORPH_GRADIENT, kernel)
+
+        period = dash[0] + dash[1]
+        starts = np.arange(0, self.length - dash[0], period)
+        dashes = [np.round(self.points[s:s + dash[0]]).astype(np.int32) for s in starts]
+        cv2.polylines(lines, dashes, False, 255, tape)
+
+        rng = np.random.RandomState(seed)
+        noise = rng.normal(0, 6, (size[1], size[0], 1))
+        self.floor = np.clip(np.array(FLOOR_COLOR) + noise, 0, 255).astype(np.uint8)
+        self.floor[lines > 0] = TAPE_COLOR
+
+    def on_track(self, x, y):
+        """
+        @param x: abscissa in the raster
+        @param y: ordinate in the raster
+        @return: True if the point is on the road
+        """
+        height, width = self.road.shape
+        col, row = int(x), int(y)
+        return 0 <= row < height and 0 <= col < width and self.road[row, col] > 0
+
+    def nearest(self, x, y, hint=None, window=200):
+        """
+        The nearest point of the centerline
+
+        @param x: abscissa in the raster
+        @param y: ordinate in the raster
+        @param hint: the last index found, the search is limited around it (None for all the points)
+        @param window: number of points searched on each side of hint
+        @return: the index of the point
+        """
+        if hint is None:
+            indexes = np.arange(self.length)
+        else:
+            indexes = np.arange(hint - window, hint + window + 1) % self.length
+        distances = np.square(self.points[indexes] - (x, y)).sum(axis=1)
+        return int(indexes[np.argmin(distances)])
+
+
+def round_corners(points, radius, nb_points=8):
+    """
+    Replace each corner of a closed polyline by a curve tangent to its two edges
+
+    @param points: Numpy array of dimension (n, 2)
+    @param radius: distance between the corner and the start of the curve,
+                   reduced to the half of the shorter edge
+    @param nb_points: number of points of a curve
+    @return: Numpy array of the new polyline
+    """
+    previous = np.roll(points, 1, axis=0)
+    following = np.roll(points, -1, axis=0)
+    result = []
+    for before, corner, after in zip(previous, points, following):
+        d_in, d_out = corner - before, after - corner
+        len_in, len_out = np.linalg.norm(d_in), np.linalg.norm(d_out)
+        d_in, d_out = d_in / len_in, d_out / len_out
+        r = min(radius, len_in / 2, len_out / 2)
+        # Quadratic Bezier between the tangent points, close to an arc for a right angle
+        start, end = corner - r * d_in, corner + r * d_out
+        t = np.linspace(0, 1, nb_points)[:, None]
+        result.append((1 - t)**2 * start + 2 * t * (1 - t) * corner + t**2 * end)
+    return np.concatenate(result)
+
+
+def resample(points, step):
+    """
+    @param points: Numpy array of dimension (n, 2), a closed polyline
+    @param step: distance between two points of the result
+    @return: Numpy array of points regularly spaced along the polyline
+    """
+    closed = np.vstack([points, points[:1]])
+    distances = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(closed, axis=0), axis=1))])
+    samples = np.arange(0, distances[-1], step)
+    return np.stack([np.interp(samples, distances, closed[:, 0]),
+                     np.interp(samples, distances, closed[:, 1])], axis=1)
+
+
+class Camera:
+    """
+    A pinhole camera above the floor, looking forward and tilted down.
+    The floor coordinates are in cm, in the frame of the car (forward, right).
+    """
+    def __init__(self, size=(456, 228), fov=100, height=25, pitch=25, offset=10):
+        """
+        Compute the projection of the floor
+
+        @param size: (width, height) of the frames
+        @param fov: horizontal field of view in degrees
+        @param height: height of the camera in cm
+        @param pitch: angle with the horizontal in degrees
+        @param offset: distance in cm of the camera in front of the rear axle
+        """
+        self.size = size
+        self.offset = offset
+        width, rows = size
+        focal = (width / 2) / tan(radians(fov) / 2)
+        cx, cy = width / 2, rows / 2
+        p = radians(pitch)
+
+        # (forward, right, 1) on the floor -> homogeneous pixel
+        self.floor_to_image = np.array([
+            [cx * cos(p), focal, cx * height * sin(p)],
+            [cy * cos(p) - focal * sin(p), 0, focal * height * cos(p) + cy * height * sin(p)],
+            [cos(p), 0, height * sin(p)],
+        ])
+        self.image_to_floor = np.linalg.inv(self.floor_to_image)
+        # The rows above the horizon (and just below, too far) show the wall
+        self.horizon = int(np.clip(np.ceil(cy - focal * tan(p)) + 2, 0, rows))
+
+    def render(self, track, x, y, heading, dst=None):
+        """
+        The frame seen from a pose of the car
+
+        @param track: a Track object
+        @param x: abscissa of the car in the raster
+        @param y: ordinate of the car in the raster
+        @param heading: angle of the car in radians, in the raster
+        @param dst: optional preallocated RGB frame
+        @return: RGB Numpy array of dimension (228, 456, 3)
+        """
+        c, s = cos(heading), sin(heading)
+        pose = np.array([
+            [c, -s, x + self.offset * c],
+            [s, c, y + self.offset * s],
+            [0, 0, 1],
+        ])
+        matrix = pose @ self.image_to_floor
+        frame = cv2.warpPerspective(track.floor, matrix, self.size, dst,
+                                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=FLOOR_COLOR)
+        frame[:self.horizon] = 40
+        return frame
+
+
+class VehicleModel:
+    """
+    Kinematic bicycle model driven by the PWM of the servo and the ESC.
+    The PWM values are the physical ones, whatever the ranges of the car class:
+    a car class with a higher start PWM drives faster at the same target.
+    """
+    def __init__(self, wheelbase=26, max_steer=25, max_speed=300, steering=(315, 410, 530), throttle=(405, 414),
+                 tau_speed=0.4, tau_brake=0.15, tau_steer=0.05):
+        """
+        Attribute initialization
+
+        @param wheelbase: distance between the axles in cm
+        @param max_steer: angle of the wheels at the full lock in degrees
+        @param max_speed: speed at the full throttle in cm/s
+        @param steering: (full left, straight, full right) PWM of the servo
+        @param throttle: (neutral, full throttle) PWM of the ESC, lower values brake
+        @param tau_speed: time constant of the acceleration in seconds
+        @param tau_brake: time constant of the braking in seconds
+        @param tau_steer: time constant of the servo in seconds
+        """
+        self.wheelbase = wheelbase
+        self.max_steer = radians(max_steer)
+        self.max_speed = max_speed
+        self.steering = steering
+        self.throttle = throttle
+        self.tau_speed = tau_speed
+        self.tau_brake = tau_brake
+        self.tau_steer = tau_steer
+
+        self.reset(0, 0, 0)
+
+    def reset(self, x, y, heading):
+        """
+        Put the car stopped at a pose
+        """
+        self.x, self.y, self.heading = x, y, heading
+        self.speed = 0.
+        self.steer = 0.
+
+    def step(self, steer_pwm, speed_pwm, dt):
+        """
+        Move the car during dt
+
+        @param steer_pwm: last PWM sent to the servo
+        @param speed_pwm: last PWM sent to the ESC
+        @param dt: duration in seconds
+        """
+        left, straight, right = self.steering
+        if steer_pwm >= straight:
+            target_steer = self.max_steer * min((steer_pwm - straight) / (right - straight), 1)
+        else:
+            target_steer = -self.max_steer * min((straight - steer_pwm) / (straight - left), 1)
+
+        neutral, full = self.throttle
+        if speed_pwm > neutral:
+            target_speed, tau = self.max_speed * min((speed_pwm - neutral) / (full - neutral), 1), self.tau_speed
+        elif speed_pwm < neutral:
+            target_speed, tau = 0., self.tau_brake
+        else:
+            target_speed, tau = 0., self.tau_speed
+
+        self.steer += (target_steer - self.steer) * min(dt / self.tau_steer, 1)
+        self.speed += (target_speed - self.speed) * min(dt / tau, 1)
+
+        self.x += self.speed * cos(self.heading) * dt
+        self.y += self.speed * sin(self.heading) * dt
+        # Positive angles turn to the right: the ordinates of the raster go down
+        self.heading += self.speed / self.wheelbase * tan(self.steer) * dt
+
+
+class PurePursuit:
+    """
+    A controller using the position of the car instead of the frames,
+    to tune the car classes without the cost of the rendering and of the predictors
+    """
+    uses_frames = False
+
+    def __init__(self, simulator, lookahead=80, speed=0.8):
+        """
+        Attribute initialization
+
+        @param simulator: the Simulator driven
+        @param lookahead: distance in cm of the point followed on the centerline
+        @param speed: target speed given to the car
+        """
+        self.simulator = simulator
+        self.lookahead = lookahead
+        self.speed = speed
+
+    def analyze(self, frame):
+        """
+        Same interface as Image2Prediction, the frame is None
+
+        @param frame: not used
+        """
+        simulator, vehicle = self.simulator, self.simulator.vehicle
+        target = simulator.track.points[(simulator.index + self.lookahead) % simulator.track.length]
+        angle = np.arctan2(target[1] - vehicle.y, target[0] - vehicle.x) - vehicle.heading
+        angle = (angle + np.pi) % (2 * np.pi) - np.pi
+        steer = atan(2 * vehicle.wheelbase * sin(angle) / self.lookahead)
+
+        simulator.car.set_targets(steer / vehicle.max_steer, self.speed)
+
+
+class Simulator:
+    """
+    Run a car and a predictor on a track.
+
+    Leaving the road is an off-track event: the car is put back stopped
+    on the centerline, like after a crash on the real circuit.
+    """
+    def __init__(self, track, car, camera=None, vehicle=None, fps=30):
+        """
+        Attribute initialization, the car is at the start of the track
+
+        @param track: a Track object
+        @param car: an instance of Chassis or a child class, with a SimulatedPCA9685, not started
+        @param camera: a Camera object, the default one if None
+        @param vehicle: a VehicleModel object, the default one if None
+        @param fps: frame rate of the camera
+        """
+        self.track = track
+        self.car = car
+        self.camera = camera if camera is not None else Camera()
+        self.vehicle = vehicle if vehicle is not None else VehicleModel()
+        self.fps = fps
+
+        self.frame = np.empty((self.camera.size[1], self.camera.size[0], 3), np.uint8)
+        self.reset(0)
+
+    def reset(self, index):
+        """
+        Put the car stopped on the centerline
+
+        @param index: index of the point of the centerline
+        """
+        x, y = self.track.points[index]
+        self.vehicle.reset(x, y, self.track.headings[index])
+        self.car.set_targets(0, 0)
+        self.index = index
+
+    def pwm(self):
+        """
+        @return: the last (servo, ESC) PWM sent by the car, straight and neutral before the first ones
+        """
+        values = self.car.pwm.values
+        steer = values.get(self.car.direction["pin"], self.vehicle.steering[1])
+        speed = values.get(self.car.speed["pin"], self.vehicle.throttle[0])
+        return steer, speed
+
+    def run(self, predictor, laps=1, max_time=120, stall_time=10):
+        """
+        Drive until the end of the laps
+
+        @param predictor: an object with an analyze(frame) method applying its predictions to the car,
+                          like Image2Prediction, the frame is None if its "uses_frames" attribute is False
+        @param laps: number of laps
+        @param max_time: maximum simulated time in seconds
+        @param stall_time: the run stops when the car doesn't progress during this time in seconds
+        @return: dict with the lap times, the off-track events, the simulated and the real durations
+        """
+        uses_frames = getattr(predictor, "uses_frames", True)
+        dt = 1 / self.car.rate
+        ticks_per_frame = max(int(round(self.car.rate / self.fps)), 1)
+
+        lap_times, off_track = [], []
+        sim_time, lap_start, nb_frames = 0., 0., 0
+        progress, best, best_time = 0, 0, 0.
+        start = time.perf_counter()
+
+        tick = 0
+        while len(lap_times) < laps and sim_time < max_time and sim_time - best_time < stall_time:
+            vehicle = self.vehicle
+            if tick % ticks_per_frame == 0:
+                frame = None
+                if uses_frames:
+                    frame = self.camera.render(self.track, vehicle.x, vehicle.y, vehicle.heading, self.frame)
+                predictor.analyze(frame)
+                nb_frames += 1
+
+            self.car.step()
+            vehicle.step(*self.pwm(), dt)
+            sim_time += dt
+            tick += 1
+
+            index = self.track.nearest(vehicle.x, vehicle.y, self.index)
+            if not self.track.on_track(vehicle.x, vehicle.y):
+                off_track.append((round(sim_time, 2), index))
+                self.reset(index)
+
+            # Progress along the centerline, the lap ends after a whole turn
+            delta = (index - self.index + self.track.length // 2) % self.track.length - self.track.length // 2
+            progress += delta
+            self.index = index
+            if progress > best:
+                best, best_time = progress, sim_time
+            if progress >= self.track.length * (len(lap_times) + 1):
+                lap_times.append(sim_time - lap_start)
+                lap_start = sim_time
+
+        return {
+            "lap_times": lap_times,
+            "off_track": off_track,
+            "distance": progress / 100,
+            "sim_time": sim_time,
+            "real_time": time.perf_counter() - start,
+            "frames": nb_frames,
+            "finished": len(lap_times) == laps,
+        }
+
+
+def build_predictor(name, car, weights_path="weights_last.h5"):
+    """
+    @param name: "hough", "cnn" or "pursuit" (the pursuit is built by the simulator)
+    @param car: the car driven
+    @param weights_path: path to the weights of the CNN (see inference.load_backend)
+    @return: an Image2Prediction, None for "pursuit"
+    """
+    if name == "hough":
+        from line_prediction import Image2Prediction
+        return Image2Prediction(None, car)
+    if name == "cnn":
+        from deep_prediction import Image2Prediction
+        from inference import load_backend
+        return Image2Prediction(None, car, load_backend(weights_path))
+    return None
+
+
+if __name__ == "__main__":
+    import argparse
+    import car as car_module
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("predictor", choices=["hough", "cnn", "pursuit"], help="the driver of the car")
+    parser.add_argument("--car", default="Car", choices=["Chassis", "Car", "F1"], help="class of car.py")
+    parser.add_argument("--circuits", type=int, default=1, help="number of random circuits")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first circuit")
+    parser.add_argument("--circuit-file", help="npz file of circuit.py, its circuits are used instead of new ones")
+    parser.add_argument("--laps", type=int, default=1, help="number of laps on each circuit")
+    parser.add_argument("--weights", default="weights_last.h5", help="path to the weights of the CNN")
+    parser.add_argument("--record", help="path to a video of the frames of the first circuit")
+    args = parser.parse_args()
+
+    # Single core, like on the Raspberry Pi during a run
+    cv2.setNumThreads(1)
+
+    outlines = load_circuits(args.circuit_file) if args.circuit_file else None
+    for seed in range(args.seed, args.seed + args.circuits):
+        outline = outlines[seed % len(outlines)] if outlines else generate_circuit(seed)
+        track = Track(outline, seed=seed)
+        car = getattr(car_module, args.car)(driver=SimulatedPCA9685(latency=0))
+        simulator = Simulator(track, car)
+        predictor = build_predictor(args.predictor, car, args.weights)
+        if predictor is None:
+            predictor = PurePursuit(simulator)
+
+        out = None
+        if args.record and seed == args.seed:
+            out = cv2.VideoWriter(args.record, cv2.VideoWriter_fourcc(*"MJPG"), simulator.fps, simulator.camera.size)
+            analyze = predictor.analyze
+            def recorded(frame, analyze=analyze):
+                if frame is not None:
+                    out.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                analyze(frame)
+            predictor.analyze = recorded
+
+        try:
+            result = simulator.run(predictor, args.laps)
+        finally:
+            # Writes the index and the last frames of the video
+            if out is not None:
+                out.release()
+        laps = " ".join("{:.2f}".format(t) for t in result["lap_times"]) or "-"
+        print("circuit {:4d} ({:5.1f} m) : laps {} s, {} off track, {:.1f} s simulated in {:.2f} s".format(
+            seed, track.length / 100, laps, len(result["off_track"]), result["sim_time"], result["real_time"]))
@@ -0,0 +1,384 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "titaniumcar"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "labeling"))
+
+import json
+import random
+import shutil
+import tempfile
+from math import atan, sin, cos, radians
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import dataset
+from circuit import generate_circuit
+from dataset_builder import preprocessing_params, PARAMS_FILE, TENSORS_FILE
+from simulator import Track, Camera
+
+try:
+    from roadsimulator.colors import ColorRange
+    from roadsimulator.layers.layers import Background, DrawLines, Perspective, Crop as CropLayer
+    from roadsimulator.simulator import Simulator as RoadSimulator
+except ImportError:
+    RoadSimulator = None
+
+"""
+Generation of synthetic training images, directly in the format of the training:
+the preprocessed tensors (Crop, Normalize, like dataset_builder.py) and their labels.
+
+The images are made by a source in each process of a pool:
+    - "track" : the circuits of circuit.py seen by the camera of simulator.py from random poses,
+      labeled with the direction of a pure pursuit on the centerline
+    - "roadsimulator" : the layer stack of experimentations/image_generation.ipynb
+      (needs the roadsimulator package and a folder of ground images)
+
+The output folder contains shards of shard_size images, one per task of the pool.
+The shard i is generated with the seed "seed + i": the images don't depend on the number of workers,
+and a stopped generation continues with the missing shards when it is run again.
+A shard folder contains :
+    - tensors.bin : the float32 tensors (69, 223, 1) one after the other
+    - labels.bin : one dataset.LABEL_DTYPE record per tensor, the prefix is "s" and the number of the shard
+    - params.json : the preprocessing parameters (same key as the cache of dataset_builder.py) and the source
+The shards are read by load_shard, or streamed for the training with the other datasets:
+    StreamingDataset(list_shards("data/synthetic/") + ["data/packed1/"]) (input_pipeline.py)
+
+Run it from the project root, for instance :
+    python processes/synthetic.py data/synthetic/ --frames 300000
+    python processes/synthetic.py data/synthetic_road/ --source roadsimulator --backgrounds data/images/ground/
+"""
+
+SHARD_NAME = "shard_{:05d}"
+
+
+class TrackSource:
+    """
+    Frames of the simulated circuits, from poses around the centerline.
+    A new circuit is drawn every frames_per_track images.
+    """
+    def __init__(self, rng, frames_per_track=500, max_offset=0.35, max_yaw=20, lookahead=80,
+                 wheelbase=26, max_steer=25, speeds=(0.9, 0.5)):
+        """
+        Attribute initialization
+
+        @param rng: the np.random.RandomState of the worker
+        @param frames_per_track: number of images of a circuit
+        @param max_offset: maximum distance to the centerline, in half widths of the track
+        @param max_yaw: maximum angle with the centerline in degrees
+        @param lookahead: distance in cm of the point followed on the centerline
+        @param wheelbase: distance between the axles in cm
+        @param max_steer: angle of the wheels at the full lock in degrees
+        @param speeds: (straight, full lock) speed labels, between 0 and 1
+        """
+        self.rng = rng
+        self.frames_per_track = frames_per_track
+        self.max_offset = max_offset
+        self.max_yaw = radians(max_yaw)
+        self.lookahead = lookahead
+        self.wheelbase = wheelbase
+        self.max_steer = radians(max_steer)
+        self.speeds = speeds
+
+        self.camera = Camera()
+        self.track = None
+        self.count = 0
+
+    def sample(self):
+        """
+        @return image: uint8 grayscale image of dimension (114, 228), like the labeled frames
+        @return theta: the direction (between -1 and 1)
+        @return norm: the speed (between 0 and 1)
+        """
+        if self.count % self.frames_per_track == 0:
+            seed = self.rng.randint(2**31 - 1)
+            self.track = Track(generate_circuit(seed), seed=seed)
+        self.count += 1
+        track, rng = self.track, self.rng
+
+        index = rng.randint(track.length)
+        heading = track.headings[index]
+        offset = rng.uniform(-self.max_offset, self.max_offset) * track.width / 2
+        x = track.points[index, 0] - offset * sin(heading)
+        y = track.points[index, 1] + offset * cos(heading)
+        yaw = heading + rng.uniform(-self.max_yaw, self.max_yaw)
+
+        # Pure pursuit of the centerline, positive angles turn to the right
+        target = track.points[(index + self.lookahead) % track.length]
+        distance = max(np.hypot(target[0] - x, target[1] - y), 1.)
+        angle = np.arctan2(target[1] - y, target[0] - x) - yaw
+        angle = (angle + np.pi) % (2 * np.pi) - np.pi
+        steer = atan(2 * self.wheelbase * sin(angle) / distance)
+        theta = float(np.clip(steer / self.max_steer, -1, 1))
+        norm = self.speeds[0] + (self.speeds[1] - self.speeds[0]) * abs(theta)
+
+        frame = self.camera.render(track, x, y, yaw)
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        image = cv2.resize(gray, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        return augment(image, rng), theta, norm
+
+
+def augment(image, rng, contrast=(0.7, 1.3), brightness=(-30, 30), noise=4):
+    """
+    Random lighting and sensor noise
+
+    @param image: uint8 grayscale image
+    @param rng: a np.random.RandomState
+    @param contrast: range of the gain
+    @param brightness: range of the offset in gray levels
+    @param noise: standard deviation of the gaussian noise in gray levels
+    @return: the new uint8 image
+    """
+    result = image * rng.uniform(*contrast) + rng.uniform(*brightness)
+    result += rng.normal(0, noise, image.shape)
+    return np.clip(result, 0, 255).astype(np.uint8)
+
+
+if RoadSimulator is not None:
+    class Blue(ColorRange):
+        """
+        Color Blue defined from a circuit picture
+        """
+        def __init__(self, name="blue"):
+            color = ColorRange(red=(115, 135), green=(125, 135), blue=(115, 125))
+
+            self.name = name
+            self.samples = color.samples
+            self.red, self.green, self.blue = color.red, color.green, color.blue
+            self.red_range, self.green_range, self.blue_range = color.red_range, color.green_range, color.blue_range
+            self.colors = color.colors
+
+
+class RoadSimulatorSource:
+    """
+    The layer stack of image_generation.ipynb.
+    roadsimulator writes its images in a folder, they are generated by batches
+    in a temporary folder and read back with the direction written in their name.
+    """
+    def __init__(self, rng, backgrounds="data/images/ground/", batch=64, speed=0.8):
+        """
+        Create the layers
+
+        @param rng: the np.random.RandomState of the worker, it seeds the random modules used by roadsimulator
+        @param backgrounds: string path to the folder of the ground images
+        @param batch: number of images generated at once
+        @param speed: speed label of all the images (roadsimulator only gives a direction)
+        """
+        if RoadSimulator is None:
+            raise ImportError("the roadsimulator source needs the roadsimulator package")
+
+        seed = rng.randint(2**31 - 1)
+        random.seed(seed)
+        np.random.seed(seed)
+
+        blue = Blue()
+        self.simulator = RoadSimulator([
+            Background(n_backgrounds=1, path=backgrounds, output_size=(725, 500)),
+            DrawLines(color_range=blue, thickness_range=[8, 7], middle_line=(50, 30, "dashed", blue)),
+            Perspective(output_dim=(528, 300)),
+            CropLayer(output_dim=(528, 146)),
+        ])
+        self.batch = batch
+        self.speed = speed
+        self.pending = []
+
+    def sample(self):
+        """
+        @return image: uint8 grayscale image of dimension (114, 228), like the labeled frames
+        @return theta: the direction (between -1 and 1)
+        @return norm: the speed (between 0 and 1)
+        """
+        if not self.pending:
+            folder = tempfile.mkdtemp()
+            try:
+                self.simulator.generate(n_examples=self.batch, path=folder)
+                for root, _, names in os.walk(folder):
+                    for name in sorted(names):
+                        image = cv2.imread(os.path.join(root, name), cv2.IMREAD_GRAYSCALE)
+                        if image is not None:
+                            image = cv2.resize(image, dataset.IMAGE_SHAPE[::-1], interpolation=cv2.INTER_AREA)
+                            self.pending.append((image, roadsimulator_direction(name), self.speed))
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+            if not self.pending:
+                raise RuntimeError("roadsimulator didn't write any image")
+        return self.pending.pop(0)
+
+
+def roadsimulator_direction(name):
+    """
+    The direction written by roadsimulator at the end of the name of an image
+
+    @param name: the filename of the image
+    @return: the direction (between -1 and 1)
+    """
+    numbers = []
+    for field in os.path.splitext(name)[0].replace("-", "_-").split("_"):
+        try:
+            numbers.append(float(field))
+        except ValueError:
+            pass
+    if not numbers:
+        raise ValueError("no direction in the name {}".format(name))
+    return float(np.clip(numbers[-1], -1, 1))
+
+
+SOURCES = {
+    "track": TrackSource,
+    "roadsimulator": RoadSimulatorSource,
+}
+
+
+# Objects of a worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(output, source, geometry, options):
+    """
+    Create the transformations once per worker process
+
+    @param output: string path to the folder of the shards
+    @param source: name of the source in SOURCES
+    @param geometry: the Geometry object of the preprocessing
+    @param options: dict of keyword arguments of the source
+    """
+    from deep_prediction import Crop, Normalize
+
+    _worker["output"] = output
+    _worker["source"] = source
+    _worker["geometry"] = geometry
+    _worker["options"] = options
+    _worker["crop"] = Crop(geometry)
+    _worker["normalize"] = Normalize(geometry)
+
+
+def _generate_shard(task):
+    """
+    Worker task: generate a shard in a temporary folder, renamed when it is complete
+
+    @param task: (index of the shard, seed, number of images)
+    @return: string path to the shard
+    """
+    index, seed, size = task
+    name = SHARD_NAME.format(index)
+    path = os.path.join(_worker["output"], name)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    source = SOURCES[_worker["source"]](np.random.RandomState(seed), **_worker["options"])
+    labels = np.zeros(size, dataset.LABEL_DTYPE)
+    # The prefix of the labels is the session id of dedup.py, one per shard
+    prefix = "s{:05d}".format(index).encode("ascii")
+    geometry = _worker["geometry"]
+    with open(os.path.join(tmp, TENSORS_FILE), "wb") as f:
+        for i in range(size):
+            image, theta, norm = source.sample()
+            tensor = _worker["normalize"](_worker["crop"](image))
+            f.write(np.ascontiguousarray(tensor, np.float32).tobytes())
+            labels[i] = (theta, norm, i, prefix)
+    labels.tofile(os.path.join(tmp, dataset.LABELS_FILE))
+
+    with open(os.path.join(tmp, PARAMS_FILE), "w") as f:
+        json.dump({
+            "params": preprocessing_params(geometry),
+            "shape": list(geometry.target_shape + (1,)),
+            "count": size,
+            "source": _worker["source"],
+            "options": _worker["options"],
+            "seed": seed,
+        }, f)
+
+    os.rename(tmp, path)
+    return path
+
+
+def list_shards(output):
+    """
+    @param output: string path to the folder of the shards
+    @return: sorted list of the paths to the complete shards
+    """
+    if not os.path.isdir(output):
+        return []
+    return [os.path.join(output, name) for name in sorted(os.listdir(output))
+            if name.startswith("shard_") and not name.endswith(".tmp")]
+
+
+def load_shard(folder):
+    """
+    Memory-map a shard
+
+    @param folder: string path to the shard
+    @return X: float32 Numpy array of dimension (n, 69, 223, 1)
+    @return y: float32 Numpy array of dimension (n, 2), like dataset.targets
+    """
+    with open(os.path.join(folder, PARAMS_FILE)) as f:
+        meta = json.load(f)
+    count, shape = meta["count"], tuple(meta["shape"])
+    X = np.memmap(os.path.join(folder, TENSORS_FILE), np.float32, "r", shape=(count,) + shape)
+    labels = np.fromfile(os.path.join(folder, dataset.LABELS_FILE), dataset.LABEL_DTYPE, count)
+    return X, dataset.targets(labels)
+
+
+def generate_shards(output, nb_frames, shard_size=4096, seed=0, source="track", workers=None,
+                    geometry=None, **options):
+    """
+    Generate the missing shards with a pool of processes
+
+    @param output: string path to the folder of the shards, created if needed
+    @param nb_frames: total number of images, rounded up to whole shards
+    @param shard_size: number of images of a shard
+    @param seed: seed of the first shard
+    @param source: name of the source in SOURCES
+    @param workers: number of processes, the number of CPU if None, 0 to stay in this process
+    @param geometry: the Geometry object of the preprocessing, CNN_GEOMETRY if None
+    @param options: keyword arguments of the source
+    @return: list of the paths to the shards
+    """
+    # Imported before the pool, the forked workers don't import it again
+    import deep_prediction
+    if geometry is None:
+        geometry = deep_prediction.CNN_GEOMETRY
+    if source not in SOURCES:
+        raise ValueError("unknown source {}, expected one of {}".format(source, sorted(SOURCES)))
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+    nb_shards = -(-nb_frames // shard_size)
+    done = set(os.path.basename(path) for path in list_shards(output))
+    tasks = [(i, seed + i, shard_size) for i in range(nb_shards) if SHARD_NAME.format(i) not in done]
+    print("{} shards of {} images, {} to generate".format(nb_shards, shard_size, len(tasks)))
+
+    initargs = (output, source, geometry, options)
+    if workers == 0:
+        _init_worker(*initargs)
+        for task in tasks:
+            print(_generate_shard(task))
+    else:
+        with Pool(workers, _init_worker, initargs) as pool:
+            for path in pool.imap_unordered(_generate_shard, tasks):
+                print(path)
+
+    return [os.path.join(output, SHARD_NAME.format(i)) for i in range(nb_shards)]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="path to the folder of the shards")
+    parser.add_argument("--frames", type=int, default=100000, help="number of images")
+    parser.add_argument("--shard-size", type=int, default=4096, help="number of images of a shard")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first shard")
+    parser.add_argument("--source", default="track", choices=sorted(SOURCES), help="generator of the images")
+    parser.add_argument("--backgrounds", help="folder of the ground images of the roadsimulator source")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    args = parser.parse_args()
+
+    options = {"backgrounds": args.backgrounds} if args.backgrounds else {}
+    start = time.perf_counter()
+    shards = generate_shards(args.output, args.frames, args.shard_size, args.seed, args.source,
+                             args.workers, **options)
+    print("{} images in {} shards, done in {:.1f} s".format(
+        sum(len(load_shard(shard)[1]) for shard in shards), len(shards), time.perf_counter() - start))
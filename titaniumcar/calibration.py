@@ -0,0 +1,327 @@
+import os
+
+import cv2
+import numpy as np
+
+from geometry import CNN_GEOMETRY, HOUGH_GEOMETRY
+
+"""
+Geometric correction of the frames: the undistortion of the lens
+(experimentations/calibration_camera.ipynb) and the bird's-eye perspective
+(experimentations/preprocessing_tests.ipynb).
+
+The undistortion, the perspective warp, the ROI and the resizing/crop of a Geometry
+are composed in a single table: for each pixel of the output, its position in the raw frame.
+The table is converted to fixed point and applied with one cv2.remap,
+only on the rows of the output which cross the ROI.
+With a perspective, the ROI and the crop of the geometry are defined in the corrected frame.
+
+Create the calibration artifact from the chessboard images, for instance :
+    python titaniumcar/calibration.py data/images/chess_board/ -o calibration.npz --perspective 65 22
+"""
+
+# Coordinate of the pixels which are not computed, remap gives 0 with BORDER_CONSTANT
+OUTSIDE = -16
+
+
+class Calibration:
+    """
+    The parameters of the camera for a reference resolution,
+    scaled for the resolution of the frames actually received.
+
+    The remap tables are cached per (geometry, resolution, resize, perspective) and saved with the parameters,
+    so the car loads them instead of computing them. The copy returned by undistortion shares the cache.
+    """
+    def __init__(self, camera_matrix=None, dist_coeffs=None, new_camera_matrix=None, perspective=None,
+                 resolution=(456, 228)):
+        """
+        Attribute initialization, the missing corrections are the identity
+
+        @param camera_matrix: 3x3 intrinsic matrix of the camera (cv2.calibrateCamera)
+        @param dist_coeffs: distortion coefficients of the camera
+        @param new_camera_matrix: 3x3 intrinsic matrix of the undistorted frame, camera_matrix if None
+        @param perspective: 3x3 matrix from the undistorted frame to the bird's-eye view
+        @param resolution: (width, height) of the frame where the matrices are defined
+        """
+        self.camera_matrix = None if camera_matrix is None else np.array(camera_matrix, np.float64)
+        self.dist_coeffs = None if dist_coeffs is None else np.array(dist_coeffs, np.float64).reshape(-1)
+        if new_camera_matrix is None:
+            new_camera_matrix = self.camera_matrix
+        self.new_camera_matrix = None if new_camera_matrix is None else np.array(new_camera_matrix, np.float64)
+        self.perspective = None if perspective is None else np.array(perspective, np.float64)
+        self.resolution = tuple(resolution)
+
+        # (geometry key, shape, resize, with perspective) -> (map1, map2, rows)
+        self.maps = {}
+
+    def undistortion(self):
+        """
+        The same correction of the lens without the perspective,
+        for the predictors tuned on the perspective view of the camera
+
+        @return: a Calibration object without perspective, itself if it has none
+        """
+        if self.perspective is None:
+            return self
+        undistortion = Calibration(self.camera_matrix, self.dist_coeffs, self.new_camera_matrix, None, self.resolution)
+        # Its tables are saved and loaded with the ones of the full calibration
+        undistortion.maps = self.maps
+        return undistortion
+
+    def _scale(self, shape):
+        """
+        @param shape: the shape of the frame (height, width, ...)
+        @return: 3x3 matrix from the reference frame to the frame
+        """
+        height, width = shape[:2]
+        return np.diag([width / self.resolution[0], height / self.resolution[1], 1.])
+
+    def source_points(self, points, shape):
+        """
+        Position in the raw frame of points of the corrected frame
+
+        @param points: float Numpy array of (x, y) coordinates in the corrected frame, dimension (n, 2)
+        @param shape: the shape of the frame (height, width, ...)
+        @return: float32 Numpy array of (x, y) coordinates in the raw frame, dimension (n, 2)
+        """
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        scale = self._scale(shape)
+        # Homogeneous coordinates
+        points = np.hstack([points, np.ones((len(points), 1))])
+
+        if self.perspective is not None:
+            perspective = scale @ self.perspective @ np.linalg.inv(scale)
+            points = points @ np.linalg.inv(perspective).T
+            points /= points[:, 2:]
+
+        if self.camera_matrix is not None:
+            # Undistorted pixels -> normalized coordinates -> pixels of the distorted frame
+            rays = points @ np.linalg.inv(scale @ self.new_camera_matrix).T
+            dist = self.dist_coeffs if self.dist_coeffs is not None else np.zeros(5)
+            projected, _ = cv2.projectPoints(rays.reshape(-1, 1, 3), np.zeros(3), np.zeros(3),
+                                             scale @ self.camera_matrix, dist)
+            return projected.reshape(-1, 2).astype(np.float32)
+
+        return points[:, :2].astype(np.float32)
+
+    def remap_table(self, geometry, shape, resize=True):
+        """
+        The fixed point table of the composed transformation, computed once per resolution
+
+        @param geometry: a Geometry object with the roi, the resizing and the crop
+        @param shape: the shape of the frame (height, width, ...)
+        @param resize: True for an output resized and cropped like the CNN input,
+                       False for an output with the size of the frame (line detection)
+        @return map1: int16 Numpy array of dimension (height, width, 2) of cv2.convertMaps
+        @return map2: uint16 Numpy array of dimension (height, width) of cv2.convertMaps
+        @return rows: slice of the rows crossing the ROI, the other ones are 0
+        """
+        shape = tuple(shape[:2])
+        key = (geometry_key(geometry), shape, resize, self.perspective is not None)
+        table = self.maps.get(key)
+        if table is None:
+            table = self._build_table(geometry, shape, resize)
+            self.maps[key] = table
+        return table
+
+    def _build_table(self, geometry, shape, resize):
+        """
+        Compute a table for remap_table
+        """
+        height, width = shape
+        if resize:
+            out_height, out_width = geometry.target_shape
+            resized_width, resized_height = geometry.resized_size
+            top = geometry.crop[0]
+            # Center of the output pixels in the frame, like a resizing
+            sx, sy = width / resized_width, height / resized_height
+            xs = (np.arange(out_width) + 0.5) * sx - 0.5
+            ys = (np.arange(out_height) + top + 0.5) * sy - 0.5
+        else:
+            out_height, out_width = height, width
+            xs = np.arange(out_width, dtype=np.float64)
+            ys = np.arange(out_height, dtype=np.float64)
+        grid_x, grid_y = np.meshgrid(xs, ys)
+
+        # The ROI is tested at the center of each output pixel
+        mask = geometry.mask(shape)
+        inside = mask[np.clip(np.round(grid_y).astype(int), 0, height - 1),
+                      np.clip(np.round(grid_x).astype(int), 0, width - 1)] > 0
+
+        map_xy = np.full((out_height, out_width, 2), OUTSIDE, np.float32)
+        map_xy[inside] = self.source_points(np.stack([grid_x[inside], grid_y[inside]], axis=1), shape)
+        map1, map2 = cv2.convertMaps(map_xy, None, cv2.CV_16SC2)
+
+        used = np.flatnonzero(inside.any(axis=1))
+        rows = slice(int(used[0]), int(used[-1]) + 1) if len(used) else slice(0, 0)
+        return map1, map2, rows
+
+    def save(self, path):
+        """
+        Write the parameters and the tables computed so far in a npz file
+
+        @param path: string path to the file
+        """
+        arrays = {"resolution": np.array(self.resolution)}
+        for name in ["camera_matrix", "dist_coeffs", "new_camera_matrix", "perspective"]:
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        for i, ((key, shape, resize, perspective), (map1, map2, rows)) in enumerate(self.maps.items()):
+            arrays["key_{}".format(i)] = np.array(key)
+            arrays["info_{}".format(i)] = np.array(shape + (resize, perspective, rows.start, rows.stop))
+            arrays["map1_{}".format(i)] = map1
+            arrays["map2_{}".format(i)] = map2
+        np.savez(path, **arrays)
+
+
+def geometry_key(geometry):
+    """
+    @param geometry: a Geometry object
+    @return: a hashable summary of the roi, the crop and the sizes
+    """
+    return tuple(geometry.roi_poly.reshape(-1)) + tuple(geometry.crop) + \
+        tuple(geometry.target_size) + tuple(geometry.reference)
+
+
+def load_calibration(path):
+    """
+    Read a file written by Calibration.save
+
+    @param path: string path to the npz file
+    @return: a Calibration object, with its saved tables
+    """
+    with np.load(path) as data:
+        params = {name: data[name] for name in ["camera_matrix", "dist_coeffs", "new_camera_matrix", "perspective"]
+                  if name in data}
+        calibration = Calibration(resolution=tuple(data["resolution"]), **params)
+
+        i = 0
+        while "key_{}".format(i) in data:
+            key = tuple(float(value) for value in data["key_{}".format(i)])
+            height, width, resize, perspective, start, stop = (int(value) for value in data["info_{}".format(i)])
+            table = data["map1_{}".format(i)], data["map2_{}".format(i)], slice(start, stop)
+            calibration.maps[(key, (height, width), bool(resize), bool(perspective))] = table
+            i += 1
+
+    return calibration
+
+
+def calibrate(folder, pattern=(3, 3), resolution=(456, 228)):
+    """
+    Compute the intrinsic parameters of the camera from pictures of a chessboard
+
+    @param folder: string path to a folder of .jpg chessboard pictures
+    @param pattern: number of inner corners (columns, rows) of the chessboard
+    @param resolution: (width, height) of the frames of the car, the pictures are resized to it
+    @return: a Calibration object without perspective
+    """
+    nx, ny = pattern
+    objp = np.zeros((ny*nx, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+
+    objpoints = [] # 3D points in real world space
+    imgpoints = [] # 2D points in image plane
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if ".jpg" not in name:
+                continue
+            image = cv2.imread(os.path.join(root, name))
+            image = cv2.resize(image, resolution, interpolation=cv2.INTER_AREA)
+            image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+            ret, corners = cv2.findChessboardCorners(gray, pattern, None)
+            if ret:
+                imgpoints.append(corners)
+                objpoints.append(objp)
+
+    if not imgpoints:
+        raise ValueError("No chessboard found in {}".format(folder))
+
+    _, mtx, dist, _, _ = cv2.calibrateCamera(objpoints, imgpoints, resolution, None, None)
+    # alpha=0: only valid pixels in the undistorted frame
+    newcameramtx, _ = cv2.getOptimalNewCameraMatrix(mtx, dist, resolution, 0, resolution)
+    return Calibration(mtx, dist, newcameramtx, resolution=resolution)
+
+
+def bottom_perspective(left, right, resolution=(456, 228)):
+    """
+    The bird's-eye perspective of experimentations/preprocessing_tests.ipynb:
+    the bottom corners of the frame are moved to the center, the top ones stay
+
+    @param left: number of pixels the bottom left corner is moved to the right
+    @param right: number of pixels the bottom right corner is moved to the left
+    @param resolution: (width, height) of the frame
+    @return: 3x3 perspective matrix
+    """
+    w, h = resolution
+    src = np.array([[0, 0], [w, 0], [0, h], [w, h]], dtype=np.float32)
+    dest = np.array([[0, 0], [w, 0], [left, h], [w - right, h]], dtype=np.float32)
+    return cv2.getPerspectiveTransform(src, dest)
+
+
+class Remap:
+    """
+    Undistort, warp, select the ROI, resize and crop in one step.
+    Same input and output as ROISelection, Resize and Crop of deep_prediction together
+    (or ROI selection only when resize is False).
+    """
+    def __init__(self, calibration, geometry=CNN_GEOMETRY, resize=True):
+        """
+        Attribute initialization
+
+        @param calibration: a Calibration object
+        @param geometry: a Geometry object with the roi, the resizing and the crop
+        @param resize: resize and crop the output like the CNN input
+        """
+        self.calibration = calibration
+        self.geometry = geometry
+        self.resize = resize
+
+    def __call__(self, image, dst=None):
+        """
+        Apply the transformation, only on the rows crossing the ROI
+
+        @param image: a grayscale OpenCV image
+        @param dst: optional preallocated output (see allocate), its other rows must be 0
+        @return: the corrected image
+        """
+        map1, map2, rows = self.calibration.remap_table(self.geometry, image.shape, self.resize)
+        if dst is None:
+            dst = self.allocate(image)
+        cv2.remap(image, map1[rows], map2[rows], cv2.INTER_LINEAR, dst[rows], cv2.BORDER_CONSTANT, 0)
+        return dst
+
+    def allocate(self, image):
+        """
+        Create the output buffer for the buffered mode
+
+        @param image: a grayscale OpenCV image
+        @return: an image of 0 with the output dimensions
+        """
+        map1, _, _ = self.calibration.remap_table(self.geometry, image.shape, self.resize)
+        return np.zeros(map1.shape[:2] + image.shape[2:], image.dtype)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="folder of the chessboard pictures")
+    parser.add_argument("-o", "--output", default="calibration.npz", help="path of the calibration file")
+    parser.add_argument("--pattern", type=int, nargs=2, default=(3, 3), help="inner corners of the chessboard")
+    parser.add_argument("--perspective", type=float, nargs=2, metavar=("LEFT", "RIGHT"),
+                        help="shift of the bottom corners for the bird's-eye view")
+    args = parser.parse_args()
+
+    calibration = calibrate(args.folder, tuple(args.pattern))
+    if args.perspective is not None:
+        calibration.perspective = bottom_perspective(*args.perspective)
+
+    # The tables of the frames of the car are saved in the file,
+    # the Hough predictor uses the undistortion only (line_prediction.ProcessChain)
+    shape = calibration.resolution[::-1]
+    calibration.remap_table(CNN_GEOMETRY, shape, resize=True)
+    calibration.undistortion().remap_table(HOUGH_GEOMETRY, shape, resize=False)
+    calibration.save(args.output)
+    print("Saved in", args.output)
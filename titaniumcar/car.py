@@ -1,9 +1,154 @@
 from threading import Thread, Lock
 from math import log
+from array import array
 
 import cv2
 import numpy as np
-from time import sleep, time
+from time import sleep, time, monotonic
+
+from pwm import PCA9685Driver
+from instrumentation import RateLimitedLogger
+
+
+class LoopStats:
+    """
+    Timing statistics of a periodic loop, updated at each tick.
+    Only counters and sums are kept, nothing is allocated.
+    """
+    def __init__(self, period):
+        """
+        Attribute initialization
+        
+        @param period: the targeted period in seconds
+        """
+        self.period = period
+        self.reset()
+        
+    def reset(self):
+        """
+        Clear all counters
+        """
+        self.last = None
+        self.ticks = 0
+        self.sum = 0.
+        self.sum_sq = 0.
+        self.max_jitter = 0.
+        self.overruns = 0
+        self.writes = 0
+        self.skipped_writes = 0
+        
+    def tick(self, now):
+        """
+        Record the start of an iteration
+        
+        @param now: monotonic time in seconds
+        """
+        if self.last is not None:
+            period = now - self.last
+            self.ticks += 1
+            self.sum += period
+            self.sum_sq += period * period
+            jitter = abs(period - self.period)
+            if jitter > self.max_jitter:
+                self.max_jitter = jitter
+        self.last = now
+        
+    def summary(self):
+        """
+        @return: dict with the mean period, the jitter (std and max),
+                 the number of overruns and of PWM writes
+        """
+        if self.ticks == 0:
+            mean = std = 0.
+        else:
+            mean = self.sum / self.ticks
+            std = max(self.sum_sq / self.ticks - mean * mean, 0.) ** 0.5
+        return {
+            "target_period": self.period,
+            "mean_period": mean,
+            "jitter_std": std,
+            "jitter_max": self.max_jitter,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "writes": self.writes,
+            "skipped_writes": self.skipped_writes,
+        }
+
+
+# Indexes of the values in Snapshot objects
+DIRECTION, SPEED = 0, 1
+
+
+class Snapshot:
+    """
+    A few floats shared between threads, the reader is never blocked (seqlock).
+    
+    The writer makes the sequence number odd, writes the values, then makes it even.
+    The reader copies the values and retries if the sequence number was odd or has changed,
+    so it never gets values coming from two different writes.
+    The writer threads are serialized by a lock that the reader never takes.
+    """
+    __slots__ = ("seq", "values", "write_lock")
+    
+    def __init__(self, size):
+        """
+        Attribute initialization
+        
+        @param size: number of values, all initialized at 0
+        """
+        self.seq = 0
+        self.values = array("d", bytes(8 * size))
+        self.write_lock = Lock()
+        
+    def write(self, index, value):
+        """
+        Set one value
+        
+        @param index: index of the value
+        @param value: float
+        """
+        with self.write_lock:
+            self.seq += 1
+            self.values[index] = value
+            self.seq += 1
+            
+    def write_all(self, *values):
+        """
+        Set all the values at once, a reader gets all the old ones or all the new ones
+        
+        @param values: floats, as many as the size
+        """
+        with self.write_lock:
+            self.seq += 1
+            for index, value in enumerate(values):
+                self.values[index] = value
+            self.seq += 1
+    
+    def get(self, index):
+        """
+        Read one value, a single float is never torn
+        
+        @param index: index of the value
+        @return: float
+        """
+        return self.values[index]
+            
+    def read(self):
+        """
+        Read a consistent copy of all the values
+        
+        @return: tuple of floats
+        """
+        while True:
+            seq = self.seq
+            if seq & 1:
+                # A write is in progress, let the writer thread run
+                sleep(0)
+                continue
+            values = tuple(self.values)
+            if self.seq == seq:
+                return values
+
 
 class Chassis:
     """
@@ -13,45 +158,59 @@ class Chassis:
         - compute_speed
         - compute_direction
         
-        In these methods, firstly, the current value must follow the variation of the targeted value.
+        In these methods, firstly, the current value must follow the variation of the targeted value
+        (given in argument) and be saved in "currents".
         On the other hand, the pwm must be computed and returned with the current value.
         
-    "set_speed" and "set_direction" methods shouldn't be rewritten
+    "set_speed", "set_direction" and "set_targets" methods shouldn't be rewritten
     to preserve the abstraction of the interface.
         
     The speed/direction dictionary could have new key/value.
+    
+    The targeted and current values are in Snapshot objects ("targets" and "currents"),
+    the camera thread and the moving loop never wait for each other.
+    
+    The moving loop runs at a fixed rate with absolute deadlines,
+    so its period doesn't depend on the I2C latency and the compute time.
+    A PWM is only sent when its integer value changes.
     """
-    def __init__(self):
+    def __init__(self, rate=100, driver=None):
         """
         Attribute initialization
+        
+        @param rate: frequency of the moving loop in Hz
+        @param driver: PWM driver (see pwm.py), the real PCA9685 if None.
+                       Without the hardware, pass a pwm.SimulatedPCA9685 explicitly
+        @raise Exception: the error of the PCA9685 (I2C, wiring) when driver is None
         """
         self.speed = {
             "range_pwm": (375, 409, 413), # Be careful, wrong values could destroy the car.
-            "current": 0,
-            "target":  0,
             "pin": 5,
             
         }
         
         self.direction = {
             "range_pwm": (315, 410, 530),
-            "current": 0,
-            "target":  0,
             "pin": 15,
             
         }
         
-        self.speed_lock = Lock()
-        self.dir_lock = Lock()
-        
-        # Connection initialization with servos 
-        try:
-            from Adafruit_PCA9685 import PCA9685
-
-            self.pwm = PCA9685()
-            self.pwm.set_pwm_freq(60)
-        except Exception as e:
-            print("Error :", e)
+        # (direction, speed) written by the setters and read by the moving loop
+        self.targets = Snapshot(2)
+        # (direction, speed) applied by the moving loop
+        self.currents = Snapshot(2)
+        
+        self.rate = rate
+        self.loop_stats = LoopStats(1 / rate)
+        self.running = False
+        # pin -> last PWM sent
+        self.last_pwm = {}
+        
+        # Connection initialization with servos.
+        # No silent fallback: the loops must not run without motor output on the car
+        if driver is None:
+            driver = PCA9685Driver(60)
+        self.pwm = driver
 
 
     def start(self):
@@ -64,64 +223,104 @@ class Chassis:
         @return: itself after init
         """
         self.high_speed_trace = 0
+        self.running = True
     
         self.move_thread = Thread(target=self._moving_loop, args=())
         self.move_thread.start()
         
         return self
-        
     
+    def stop(self):
+        """
+        Stop the moving loop and wait for its end
+        """
+        self.running = False
+        self.move_thread.join()
+        
     def _moving_loop(self):
         """
-        Compute then apply.
-        We insert a little delay after to prevent fits and starts during course correction
+        Compute then apply, once per period.
+        The fixed rate prevents fits and starts during course correction.
+        
+        The deadlines are absolute: the time spent in the iteration is not added to the period.
+        If a deadline is missed (overrun), the next one is taken from now
+        instead of running the late iterations in a row.
         """
+        period = 1 / self.rate
+        self.loop_stats = LoopStats(period)
+        deadline = monotonic()
         
-        while True:
-            pwm = self.compute_speed()
-            self.pwm.set_pwm(self.speed["pin"], 0, int(pwm))
-            
-            pwm = self.compute_direction()
-            self.pwm.set_pwm(self.direction["pin"], 0, int(pwm))
+        while self.running:
+            self.loop_stats.tick(monotonic())
+            self.step()
             
-            sleep(0.01)
+            deadline += period
+            delay = deadline - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                self.loop_stats.overruns += 1
+                deadline = monotonic()
+    
+    def step(self):
+        """
+        One iteration of the moving loop: compute and send the PWM
+        """
+        direction, speed = self.targets.read()
+        
+        pwm = self.compute_speed(speed)
+        self._set_pwm(self.speed["pin"], int(pwm))
+        
+        pwm = self.compute_direction(direction)
+        self._set_pwm(self.direction["pin"], int(pwm))
     
-    def compute_speed(self):
+    def _set_pwm(self, pin, value):
+        """
+        Send the PWM on the I2C bus only if it has changed
+        
+        @param pin: the channel of the PCA9685
+        @param value: integer PWM value
+        """
+        if self.last_pwm.get(pin) == value:
+            self.loop_stats.skipped_writes += 1
+            return
+        self.pwm.set_pwm(pin, 0, value)
+        self.last_pwm[pin] = value
+        self.loop_stats.writes += 1
+    
+    def compute_speed(self, target):
         """
         Set the current value with the target.
         Compute PWM from current value
         
+        @param target: the targeted speed
         @return: pwm value
         """
+        value = target
+        self.currents.write(SPEED, value)
         
-        self.speed_lock.acquire()
-        self.speed["current"] = self.speed["target"] 
-        self.speed_lock.release()
-        
-        stop_pwm, start_pwm, max_pwm = speed["range_pwm"]
-        value = self.speed["current"]
+        stop_pwm, start_pwm, max_pwm = self.speed["range_pwm"]
         
         # If the target speed is negative, we consider that it is 0
         if value > 0:
-            pwm_val = (max_pwm - start_pwm) * speed["current"] + start_pwm
+            pwm_val = (max_pwm - start_pwm) * value + start_pwm
         else:
             pwm_val = start_pwm
         return pwm_val
         
     
-    def compute_direction(self):
+    def compute_direction(self, target):
         """
         Set the current value with the target.
         Compute PWM from current value
         
+        @param target: the targeted direction
         @return: pwm value
         """
-        self.dir_lock.acquire()
-        self.direction["current"] = self.direction["target"] 
-        self.dir_lock.release()
+        value = target
+        self.currents.write(DIRECTION, value)
                         
         max_left_pwm, straight_pwm, max_right_pwm = self.direction["range_pwm"]
-        value = self.direction["current"]
         
         # The PWM computation is not the same if the car turn to the right or to the left
         if value > 0:
@@ -137,14 +336,8 @@ class Chassis:
         @param value: normalized speed with a float
         @return: cliped value
         """
-        if value > 1:
-            value = 1
-        elif value < -1:
-            value = -1
-    
-        self.speed_lock.acquire()
-        self.speed["target"] = value
-        self.speed_lock.release()
+        value = self._clip(value)
+        self.targets.write(SPEED, value)
         
         return value
     
@@ -155,15 +348,34 @@ class Chassis:
         @param value: normalized direction with a float
         @return: cliped value
         """
+        value = self._clip(value)
+        self.targets.write(DIRECTION, value)
+        
+        return value
+    
+    def set_targets(self, direction, speed):
+        """
+        Clip the values, then set the desired direction and speed at once:
+        the moving loop never applies only one of them
+        
+        @param direction: normalized direction with a float
+        @param speed: normalized speed with a float
+        @return: cliped values
+        """
+        direction, speed = self._clip(direction), self._clip(speed)
+        self.targets.write_all(direction, speed)
+        
+        return direction, speed
+    
+    def _clip(self, value):
+        """
+        @param value: a float
+        @return: the value clipped between -1 and 1
+        """
         if value > 1:
             value = 1
         elif value < -1:
             value = -1
-    
-        self.dir_lock.acquire()
-        self.direction["target"] = value
-        self.dir_lock.release()
-        
         return value
         
     def configure(self):
@@ -209,13 +421,11 @@ class Car(Chassis):
     If the new value is close to the last one, we can change it.
     But if they are completely differents, the value applied is a mix between the 2.
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, rate=100, driver=None):
+        super().__init__(rate, driver)
         
         self.speed = {
             "range_pwm": (390, 407, 414),
-            "current": 0,
-            "target":  0,
             "pin": 5,
             "inertia": 0.8,
             
@@ -223,52 +433,48 @@ class Car(Chassis):
         
         self.direction = {
             "range_pwm": (315, 410, 530),
-            "current": 0,
-            "target":  0,
             "pin": 10,
             "inertia": 0.7,
             
         }
     
-    def compute_speed(self):
+    def compute_speed(self, target):
         """
         Set the current value with the target.
         Then compute PWM from current value
         
+        @param target: the targeted speed
         @return: pwm value
         """
-        self.speed_lock.release()
-        self.speed["current"] = self._compute_offset(
-                self.speed["target"],
-                self.speed["current"],
+        value = self._compute_offset(
+                target,
+                self.currents.get(SPEED),
                 self.speed["inertia"]
         )
-        self.speed_lock.release()
+        self.currents.write(SPEED, value)
         
         stop_pwm, start_pwm, max_pwm = self.speed["range_pwm"]
-        value = self.speed["current"]
         if value > 0:
             pwm_val = (max_pwm - start_pwm)* value + start_pwm
         else:
             pwm_val = start_pwm
         return pwm_val
     
-    def compute_direction(self):
+    def compute_direction(self, target):
         """
         Set the current value with the target.
         Then compute PWM from current value
         
+        @param target: the targeted direction
         @return: pwm value
         """
-        self.dir_lock.acquire()
-        self.direction["current"] = self._compute_offset(
-                    self.direction["target"],
-                    self.direction["current"],
+        value = self._compute_offset(
+                    target,
+                    self.currents.get(DIRECTION),
                     self.direction["inertia"]
             )
-        self.dir_lock.release()
+        self.currents.write(DIRECTION, value)
         
-        value = self.direction["current"]
         max_left_pwm, straight_pwm, max_right_pwm = self.direction["range_pwm"]
         if value > 0:
             pwm_val = (max_right_pwm - straight_pwm)* value + straight_pwm
@@ -325,54 +531,52 @@ class F1(Car):
     
     Many magic numbers in compute_speed method, they were obtained empirically.
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, rate=100, driver=None):
+        super().__init__(rate, driver)
          
         self.speed = {
             "range_pwm": (375, 409, 413), # if battery is low 375 410 417
-            "current": 0,
-            "target":  0,
             "pin": 5,
             
         }
         
         self.direction = {
             "range_pwm": (315, 410, 530),
-            "current": 0,
-            "target":  0,
             "pin": 15,
             "inertia": 0.7,
             
         }
+        
+        # Also set by start, for a car stepped without its thread (simulator)
+        self.high_speed_trace = 0
+        
+        # The brakes happen in the control loop, at most one line per second
+        self.log = RateLimitedLogger("car")
     
-    def compute_speed(self):
+    def compute_speed(self, target):
         """
         Set the current value with the target.
         Then compute PWM from current value
         
+        @param target: the targeted speed
         @return: pwm value
         """
-        
-        self.speed_lock.acquire()
-        speed = self.speed
-        
         # The case of no clipping
-        if speed["target"] < 0 and self.high_speed_trace == 0:
-            speed["current"] = 0
+        if target < 0 and self.high_speed_trace == 0:
+            value = 0
         # No clipping
         else:
             # For logs
-            if speed["target"] < 0:
-                print("BREAK !")
-            speed["current"] = speed["target"]
-        self.speed = speed
-        self.speed_lock.release()
+            if target < 0:
+                self.log.log("BREAK !", target=target)
+            value = target
+        self.currents.write(SPEED, value)
         
         # When the car accelerates quickly is the only case
         # where the trace is filling 
-        if speed["current"] > 0.45:
+        if value > 0.45:
             self.high_speed_trace += 0.4
-        elif speed["current"] < 0: 
+        elif value < 0: 
             self.high_speed_trace -= 0.1
         else:
             self.high_speed_trace -= 0.02
@@ -384,9 +588,9 @@ class F1(Car):
         elif self.high_speed_trace > 1.2:
             self.high_speed_trace = 1.2
         
-        stop_pwm, start_pwm, max_pwm = speed["range_pwm"]
-        if speed["current"] >= 0:
-            pwm_val = (max_pwm - start_pwm)* speed["current"] + start_pwm
+        stop_pwm, start_pwm, max_pwm = self.speed["range_pwm"]
+        if value >= 0:
+            pwm_val = (max_pwm - start_pwm)* value + start_pwm
         else:
             pwm_val = stop_pwm
         return pwm_val
@@ -1,27 +1,43 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' 
 
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras import layers
-from tensorflow.keras.models import load_model
-
 import cv2
 import numpy as np
 
-from picamera import PiCamera
-from picamera.array import PiRGBAnalysis
-from picamera.color import Color
+try:
+    from picamera import PiCamera
+    from picamera.array import PiRGBAnalysis
+    from picamera.color import Color
+except ImportError:
+    # Off the car (benchmarks on recorded videos), the frames are given by hand to analyze
+    class PiRGBAnalysis:
+        """
+        Minimal stand-in of picamera.array.PiRGBAnalysis
+        """
+        def __init__(self, camera, size=None):
+            self.camera = camera
+            self.size = size
+            
+        def close(self):
+            pass
 
-from f1 import Car
+from car import Car
+from pipeline import Pipeline
+from inference import load_backend
+from geometry import CNN_GEOMETRY
+from calibration import Remap
+from instrumentation import StageTimer, RateLimitedLogger
 
 import time
+from threading import Lock
 
-session = tf.Session()
-keras.backend.set_session(session)
+# The TensorFlow session of build_model.
+# TensorFlow is only imported by build_model: the backends of inference.py don't need it
+session = None
 
 """
-The image resolution is not correctly handled if it is no longer (456, 228).
+The ROI, the resizing and the crop are defined in geometry.CNN_GEOMETRY
+for a (456, 228) frame, and scaled for the other resolutions.
 """
 
 class CannyTrsf:
@@ -36,107 +52,221 @@ class CannyTrsf:
         @param blur_size: the kernel size for gaussian blur
         """
         self.blur_size = (blur_size, blur_size)
+        
+        # Intermediate images kept between frames in buffered mode
+        self.scratch = {}
     
-    def __call__(self, image):
+    def __call__(self, image, dst=None):
         """
         Apply the transformation
 
         @param image: a RGB OpenCV image
+        @param dst: optional preallocated output (see allocate)
         @return: image's edges
         """
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        blur = cv2.GaussianBlur(gray, self.blur_size, 0)
-        canny = cv2.Canny(blur, 20, 100)
-        return canny
+        if dst is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            blur = cv2.GaussianBlur(gray, self.blur_size, 0)
+            canny = cv2.Canny(blur, 20, 100)
+            return canny
+        
+        shape = image.shape[:2]
+        if shape not in self.scratch:
+            self.scratch[shape] = np.empty(shape, np.uint8), np.empty(shape, np.uint8)
+        gray, blur = self.scratch[shape]
+        
+        cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=gray)
+        cv2.GaussianBlur(gray, self.blur_size, 0, dst=blur)
+        cv2.Canny(blur, 20, 100, edges=dst)
+        return dst
+    
+    def allocate(self, image):
+        """
+        Create the output buffer for the buffered mode
+        
+        @param image: a RGB OpenCV image
+        @return: an empty grayscale image
+        """
+        return np.empty(image.shape[:2], np.uint8)
   
     
 class ROISelection:
     """
     Set to (0, 0, 0) each pixel outside the roi
     """
-    def __init__(self, poly):
+    def __init__(self, geometry=CNN_GEOMETRY):
         """
         Attribute initialization
 
-        @param poly: an array of coordinates for roi
+        @param geometry: a Geometry object with the roi
         """
-        self.poly = poly
+        self.geometry = geometry
         
-    def __call__(self, image):
+    def __call__(self, image, dst=None):
         """
         Apply the transformation
+        The mask is drawn once per resolution by the geometry
 
         @param image: a grayscale OpenCV image
+        @param dst: optional preallocated output (see allocate)
         @return: the image with only roi
         """
-        mask = np.zeros_like(image)
-        cv2.fillPoly(mask, (self.poly,), 255)
-        masked_image = cv2.bitwise_and(image, mask)
+        mask = self.geometry.mask(image.shape)
+        masked_image = cv2.bitwise_and(image, mask, dst=dst)
         return masked_image
+    
+    def allocate(self, image):
+        """
+        Create the output buffer for the buffered mode
+        
+        @param image: a grayscale OpenCV image
+        @return: an empty image with the same shape
+        """
+        return np.empty_like(image)
 
     
 class Resize():
     """
-    Divide by 2 the image dimensions
+    Resize the image before the crop,
+    it divides by 2 the dimensions of a (456, 228) frame
     """
-    def __call__(self, sample):
+    def __init__(self, geometry=CNN_GEOMETRY):
+        """
+        Attribute initialization
+
+        @param geometry: a Geometry object with the resized size
+        """
+        self.geometry = geometry
+        
+    def __call__(self, sample, dst=None):
         """
         Apply the transformation
 
         @param image: a OpenCV image
+        @param dst: optional preallocated output (see allocate)
         @return: the resized image
         """
-        image = cv2.resize(sample, (0,0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        image = cv2.resize(sample, self.geometry.resized_size, dst, interpolation=cv2.INTER_AREA)
         return image
+    
+    def allocate(self, sample):
+        """
+        Create the output buffer for the buffered mode
+        
+        @param sample: a OpenCV image
+        @return: an empty image with the resized dimensions
+        """
+        width, height = self.geometry.resized_size
+        return np.empty((height, width) + sample.shape[2:], sample.dtype)
 
 
 class Crop:
     """
     Remove pixels on the top and the right
     """
-    def __call__(self, sample):
+    def __init__(self, geometry=CNN_GEOMETRY):
+        """
+        Attribute initialization
+
+        @param geometry: a Geometry object with the crop
+        """
+        self.geometry = geometry
+        
+    def __call__(self, sample, dst=None):
         """
         Apply the transformation
+        The cropped image is a view, dst is never used
 
-        @param image: a OpenCV image
+        @param image: a resized OpenCV image
         @return: the cropped image
         """
-        width = sample.shape[1]
-        return sample[45:, :width-5]
+        return sample[self.geometry.crop_slices]
+    
+    def allocate(self, sample):
+        """
+        No buffer is needed for a view
+        """
+        return None
     
        
 class Normalize():
     """
     Normalized the image with mean of 0 and std of 1
     """
-    def __call__(self, sample):
+    def __init__(self, geometry=CNN_GEOMETRY):
+        """
+        Attribute initialization
+
+        @param geometry: a Geometry object with the target size
+        """
+        self.geometry = geometry
+        
+    def __call__(self, sample, dst=None):
         """
         Apply the transformation
         
+        Be careful, cv2.normalize keeps the depth of the source,
+        so an uint8 image is rounded to 0 or 1.
+        
         @param image: a grayscale OpenCV image
+        @param dst: optional preallocated output (see allocate)
         @return: a Numpy array normalized image with dimension of (69, 223, 1)
         """
         image = sample
-        norm_img = np.zeros(image.shape)
-        norm_img = cv2.normalize(image, norm_img, 0, 1, cv2.NORM_MINMAX)
-        norm_img = norm_img.reshape(69, 223, -1)
+        if dst is None:
+            norm_img = np.zeros(image.shape)
+            norm_img = cv2.normalize(image, norm_img, 0, 1, cv2.NORM_MINMAX)
+        else:
+            norm_img = cv2.normalize(image, dst, 0, 1, cv2.NORM_MINMAX)
+        norm_img = norm_img.reshape(self.geometry.target_shape + (-1,))
         
         return norm_img
+    
+    def allocate(self, sample):
+        """
+        Create the output buffer for the buffered mode
+        
+        @param sample: a grayscale OpenCV image
+        @return: an empty image with the same shape and depth
+        """
+        return np.empty(sample.shape, sample.dtype)
 
 
 class ToTensor:
     """
     Add the batch dimension in axis 0
     """
-    def __call__(self, sample):
+    def __init__(self, geometry=CNN_GEOMETRY):
+        """
+        Attribute initialization
+
+        @param geometry: a Geometry object with the target size
+        """
+        self.geometry = geometry
+        
+    def __call__(self, sample, dst=None):
         """
         Apply the transformation
         
         @param image: a Numpy array of dimension (69, 223, 1)
+        @param dst: optional preallocated float32 output (see allocate)
         @return: a Numpy array of dimension (1, 69, 223, 1)
         """
-        image = sample.reshape(-1, 69, 223, 1)
+        if dst is None:
+            image = sample.reshape((-1,) + self.geometry.target_shape + (1,))
+        else:
+            np.copyto(dst[0], sample)
+            image = dst
         return image
+    
+    def allocate(self, sample):
+        """
+        Create the output buffer for the buffered mode
+        
+        @param sample: a Numpy array of dimension (69, 223, 1)
+        @return: an empty float32 tensor of dimension (1, 69, 223, 1)
+        """
+        return np.empty((1,) + self.geometry.target_shape + (1,), np.float32)
 
 
 class ProcessChain:
@@ -144,34 +274,92 @@ class ProcessChain:
     Create the preprocess pipeline before going in the CNN.
     Each element must be callable.
     Take care about the dimension between the return and the argument for the next class.
+    
+    In buffered mode, each element writes in an output allocated once per resolution
+    (see the "allocate" methods), so no image is allocated for each frame.
+    The returned tensor is then overwritten by the next frame.
+    
+    With a calibration (see calibration.py), ROISelection, Resize and Crop are replaced
+    by a single Remap which also corrects the lens distortion and the perspective.
     """
-    def __init__(self):
+    def __init__(self, buffered=False, geometry=CNN_GEOMETRY, calibration=None):
         """
         Initialization of the preprocess pipeline, "line"
+        
+        @param buffered: reuse preallocated buffers between frames
+        @param geometry: a Geometry object with the roi, the resizing and the crop
+        @param calibration: a calibration.Calibration object, None for no correction
         """
-        self.line = [
-            CannyTrsf(),
-            ROISelection(
-            	# Your ROI could be different depending of the camera orientation
-            	# and the size of the returned image
-                np.array([(0, 131), (0, 228), (450, 228), (450, 131), (300, 94), (150, 94)])
-            ),
-            Resize(),
-            Crop(),
-            Normalize(),
-            ToTensor()
+        self.buffered = buffered
+        # input shape -> list of output buffers, one for each element of "line"
+        self.buffers = {}
+        
+        if calibration is None:
+            geometric = [ROISelection(geometry), Resize(geometry), Crop(geometry)]
+        else:
+            geometric = [Remap(calibration, geometry)]
+        
+        self.line = [CannyTrsf()] + geometric + [
+            Normalize(geometry),
+            ToTensor(geometry)
         ]
 
-    def transform(self, image):
+    @property
+    def stages(self):
+        """
+        The names of the steps for instrumentation.StageTimer
+        
+        @return: list of the class names of "line"
+        """
+        return [type(process).__name__ for process in self.line]
+
+    def transform(self, image, timer=None, row=None):
         """
         Iterate through "line" and return the last item
         
         @param image: a OpenCV image of dimension (456, 228, 3)
+        @param timer: a StageTimer where the end of each step is saved, or None
+        @param row: the row of the frame in the timer
         @return: a Numpy array of dimension (1, 69, 223, 1)
         """
+        if self.buffered:
+            return self._transform_buffered(image, timer, row)
+        
         item = image
         for process in self.line:
             item = process(item)
+            if timer is not None:
+                timer.mark(row, type(process).__name__)
+        
+        return item
+    
+    def _transform_buffered(self, image, timer=None, row=None):
+        """
+        Iterate through "line" with the buffers of the image resolution.
+        They are allocated during the first frame of each resolution.
+        
+        @param image: a OpenCV image of dimension (456, 228, 3)
+        @param timer: a StageTimer where the end of each step is saved, or None
+        @param row: the row of the frame in the timer
+        @return: a float32 Numpy array of dimension (1, 69, 223, 1)
+        """
+        buffers = self.buffers.get(image.shape)
+        
+        item = image
+        if buffers is None:
+            buffers = []
+            for process in self.line:
+                dst = process.allocate(item)
+                buffers.append(dst)
+                item = process(item, dst)
+                if timer is not None:
+                    timer.mark(row, type(process).__name__)
+            self.buffers[image.shape] = buffers
+        else:
+            for process, dst in zip(self.line, buffers):
+                item = process(item, dst)
+                if timer is not None:
+                    timer.mark(row, type(process).__name__)
         
         return item
     
@@ -192,32 +380,182 @@ class ProcessChain:
             change_keeper.append(item)
         
         return item, change_keeper
+
+
+class FusedProcessChain:
+    """
+    Same output as ProcessChain but the steps are fused in a single pass.
+    
+    The crop is done first: only the bottom band of the frame
+    which survives Crop is converted, blurred and passed in Canny.
+    A margin of rows is kept above the band,
+    so the edges near the top of the crop are computed like on the full frame.
+    Only a weak edge linked to a strong one above the margin can still differ
+    (hysteresis of Canny), a larger margin makes it rarer.
+    Then the cached ROI mask, the resize and the normalization are applied in place
+    in buffers allocated once per resolution.
+    
+    The returned tensor is overwritten by the next frame.
+    
+    The frame must be an integer multiple of the resized size of the geometry,
+    like (456, 228) for (228, 114), to resize the band like the whole frame.
+    """
+    def __init__(self, geometry=CNN_GEOMETRY, blur_size=5, margin=8):
+        """
+        Attribute initialization
+        
+        @param geometry: a Geometry object with the roi, the resizing and the crop
+        @param blur_size: the kernel size for gaussian blur
+        @param margin: number of rows computed above the cropped band
+        """
+        self.geometry = geometry
+        self.blur_size = (blur_size, blur_size)
+        self.margin = margin
+        
+        # input shape -> dict of buffers
+        self.buffers = {}
+        
+    def _allocate(self, shape):
+        """
+        Create the buffers and the ROI mask for a resolution
+        
+        @param shape: the shape of the RGB frame
+        @return: a dict with the first row of the band and all the buffers
+        """
+        geometry = self.geometry
+        height, width = shape[:2]
+        resized_width, resized_height = geometry.resized_size
+        factor = height // resized_height
+        if factor * resized_height != height or factor * resized_width != width:
+            raise ValueError("The frame {}x{} is not a multiple of {}x{}".format(
+                width, height, resized_width, resized_height))
+        
+        # The margin is rounded up to a multiple of factor to keep the resized pixels aligned
+        crop_top = geometry.crop_top(shape)
+        margin = -(-self.margin // factor) * factor
+        top = max(0, crop_top - margin)
+        band = (height - top, width)
         
+        small = np.empty((band[0] // factor, resized_width), np.uint8)
+        crop_columns = geometry.crop_slices[1]
+        
+        buffers = {
+            "top": top,
+            "gray": np.empty(band, np.uint8),
+            "blur": np.empty(band, np.uint8),
+            "edges": np.empty(band, np.uint8),
+            "mask": geometry.mask(shape)[top:],
+            "small": small,
+            # Crop in the resized band
+            "crop": small[(crop_top - top) // factor:, crop_columns],
+            "tensor": np.empty((1,) + geometry.target_shape + (1,), np.float32),
+        }
+        self.buffers[shape] = buffers
+        return buffers
+    
+    @property
+    def stages(self):
+        """
+        The steps are fused, there is a single stage for instrumentation.StageTimer
+        
+        @return: list of the stage names
+        """
+        return [type(self).__name__]
+    
+    def transform(self, image, timer=None, row=None):
+        """
+        Apply all the steps on the useful band of the frame
+        
+        @param image: a OpenCV image of dimension (456, 228, 3)
+        @param timer: a StageTimer where the end of the step is saved, or None
+        @param row: the row of the frame in the timer
+        @return: a float32 Numpy array of dimension (1, 69, 223, 1)
+        """
+        buffers = self.buffers.get(image.shape)
+        if buffers is None:
+            buffers = self._allocate(image.shape)
+            
+        band = image[buffers["top"]:]
+        gray, blur, edges = buffers["gray"], buffers["blur"], buffers["edges"]
+        
+        cv2.cvtColor(band, cv2.COLOR_RGB2GRAY, dst=gray)
+        cv2.GaussianBlur(gray, self.blur_size, 0, dst=blur)
+        cv2.Canny(blur, 20, 100, edges=edges)
+        cv2.bitwise_and(edges, buffers["mask"], dst=edges)
+        cv2.resize(edges, buffers["small"].shape[::-1], buffers["small"], interpolation=cv2.INTER_AREA)
+        
+        # Like Normalize, the depth is kept so the values are 0 or 1
+        crop = buffers["crop"]
+        cv2.normalize(crop, crop, 0, 1, cv2.NORM_MINMAX)
+        
+        tensor = buffers["tensor"]
+        np.copyto(tensor[0, :, :, 0], crop)
+        if timer is not None:
+            timer.mark(row, type(self).__name__)
+        return tensor
+
+
 class Image2Prediction(PiRGBAnalysis):
     """
     Wrap the whole process from frame to apply predicted speed and direction
     """
-    def __init__(self, camera, car, model, output=None, record=False):
+    def __init__(self, camera, car, model, output=None, record=False, buffered=True, fused=False,
+                 asynchronous=False, calibration=None):
         """
         Initialization of the attributes
         and create preprocess pipeline with ProcessChain class
         
         output and record are not used in the final version
         
+        In asynchronous mode, the camera thread only gives the frame to a Pipeline.
+        The preprocessing and the inference run on their own threads,
+        always on the newest frame, the stale ones are dropped.
+        In both modes, an error of the preprocessing or of the model stops the car
+        and is raised by analyze (or by close).
+        
+        The end of each stage is saved in a StageTimer (see stats),
+        the predictions are logged at most once per second.
+        
         @param camera: PiCamera instance
         @param car: instance of Chassis or a child class
-        @param model: regression to predict a speed and a direction
+        @param model: regression to predict a speed and a direction, a backend of inference.py
+        @param buffered: use the preallocated buffers of ProcessChain
+        @param fused: use FusedProcessChain instead of ProcessChain
+        @param asynchronous: run the preprocessing and the inference on separate threads
+        @param calibration: a calibration.Calibration object to correct the frames, not with fused
         """
         super().__init__(camera)
         
         self.car = car
-        self.process = ProcessChain()
+        if fused:
+            if calibration is not None:
+                raise ValueError("FusedProcessChain doesn't support the calibration")
+            self.process = FusedProcessChain()
+        else:
+            self.process = ProcessChain(buffered=buffered, calibration=calibration)
         
         self.output_vid = output
         self.record = record
         
         self.model = model
         
+        # Set by stop_car: the next predictions aren't applied.
+        # The lock makes the check and set_targets atomic with respect to stop_car
+        self.stopped = False
+        self.car_lock = Lock()
+        
+        self.timer = StageTimer(["capture"] + self.process.stages + ["inference", "apply"])
+        self.log = RateLimitedLogger("deep_prediction")
+        
+        if asynchronous:
+            # The items are (row in the timer, frame or tensor)
+            self.pipeline = Pipeline([
+                lambda item: (item[0], self.preprocess(item[1], item[0])),
+                lambda item: self.predict_and_apply(item[1], item[0]),
+            ], on_error=self.stop_car).start()
+        else:
+            self.pipeline = None
+        
     def analyze(self, frame):
         """
         For each frame, this method is called
@@ -228,25 +566,105 @@ class Image2Prediction(PiRGBAnalysis):
         
         @param frame: a Numpy array usable like a OpenCV image
         """
-        with session.as_default():
-            frame = self.process.transform(frame)
-            p_dir, p_speed = self.model.predict(frame.astype(np.float32))[0]
-            
-            # Magic numbers to shift the speed
-            p_speed = 1.2*p_speed - 0.2
-            
-            print(p_dir, p_speed)
-            
-            self.car.set_direction(p_dir)
-            self.car.set_speed(p_speed)
+        row = self.timer.begin()
+        if self.pipeline is not None:
+            self.pipeline.put((row, frame))
+        else:
+            try:
+                self.predict_and_apply(self.process.transform(frame, self.timer, row), row)
+            except Exception as error:
+                self.stop_car(error)
+                raise
+    
+    def stop_car(self, error=None):
+        """
+        Failure hook: the car must not keep driving with the last prediction.
+        The stop is sticky, a prediction still running on another thread is not applied
+        
+        @param error: the exception of the preprocessing or of the model
+        """
+        with self.car_lock:
+            self.stopped = True
+            self.car.set_targets(0, 0)
+    
+    def preprocess(self, frame, row=None):
+        """
+        Preprocessing stage of the asynchronous mode
+        
+        @param frame: a Numpy array usable like a OpenCV image
+        @param row: the row of the frame in the timer, None to not measure
+        @return: a float32 Numpy array of dimension (1, 69, 223, 1)
+        """
+        timer = self.timer if row is not None else None
+        # Copy because the buffers of the chain are overwritten by the next frame
+        return np.array(self.process.transform(frame, timer, row), dtype=np.float32)
+    
+    def predict_and_apply(self, tensor, row=None):
+        """
+        Put the image in CNN and apply the predicted speed and direction
         
+        @param tensor: a Numpy array of dimension (1, 69, 223, 1)
+        @param row: the row of the frame in the timer, None to not measure
+        """
+        p_dir, p_speed = self.model.predict(tensor.astype(np.float32, copy=False))[0]
+        if row is not None:
+            self.timer.mark(row, "inference")
+        
+        # Magic numbers to shift the speed
+        p_speed = 1.2*p_speed - 0.2
+        
+        with self.car_lock:
+            if self.stopped:
+                return
+            self.car.set_targets(p_dir, p_speed)
+        if row is not None:
+            self.timer.mark(row, "apply")
+        
+        self.log.log(direction=p_dir, speed=p_speed)
+    
+    def dropped(self):
+        """
+        @return: number of frames dropped by the asynchronous mode
+        """
+        return sum(self.pipeline.dropped) if self.pipeline is not None else 0
+    
+    def stats(self):
+        """
+        Statistics of the last frames (see StageTimer.stats)
         
-def build_model():
+        @return: dict with the fps, the dropped frames and the p50/p99 of each stage
+        """
+        return self.timer.stats(self.dropped())
+    
+    def close(self):
+        """
+        Stop the threads of the asynchronous mode
+        """
+        try:
+            if self.pipeline is not None:
+                self.pipeline.stop()
+        finally:
+            print(self.timer.report(self.dropped()))
+            super().close()
+        
+        
+def build_model(weights_path='weights_last.h5'):
     """
     Create and load the CNN model that was trained before
+    TensorFlow is imported here, the model is run with inference.KerasBackend
     
+    @param weights_path: string path to the weights saved by Keras
     @return: the Keras model
     """
+    import tensorflow as tf
+    from tensorflow import keras
+    from tensorflow.keras import layers
+    
+    global session
+    if session is None:
+        session = tf.Session()
+        keras.backend.set_session(session)
+    
     model = keras.Sequential([
         layers.Conv2D(3, (3, 3), padding="valid", activation="relu"),
         layers.MaxPooling2D(pool_size=(2, 2)),
@@ -264,7 +682,7 @@ def build_model():
         layers.Dense(2, activation=None),
     ])
     model.build((1, 69, 223, 1))
-    model.load_weights('weights_last.h5')
+    model.load_weights(weights_path)
 
     # Check if the ouput values is not NAN
     test = np.random.rand(1, 69, 223, 1)    
@@ -273,16 +691,27 @@ def build_model():
     return model
         
 if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    
     car = Car().start()
     out = cv2.VideoWriter('vid.avi',cv2.VideoWriter_fourcc(*"MJPG"), 5, (456,228))
-    model = build_model()
+    # The Numpy forward pass avoids the overhead of the Keras predict for each frame
+    # KerasBackend(build_model()) gives the same predictions
+    # A quantized model can be used with its .tflite file (see processes/quantize.py)
+    # A Keras or PyTorch model exported by processes/export_model.py with its .npz or .onnx file
+    model = load_backend('weights_last.h5')
+    # The lens and the perspective are corrected with the file of calibration.py:
+    # Image2Prediction(..., calibration=load_calibration("calibration.npz"))
 
     with PiCamera(resolution=(456, 228), framerate=30) as camera:
         # Fix the camera's white-balance gains
         camera.awb_mode = 'off'
         camera.awb_gains = (1.4, 1.5)
         # Construct the analysis output and start recording data to it
-        with Image2Prediction(camera, car, model, output=out) as i2p:
+        with Image2Prediction(camera, car, model, output=out, asynchronous=True) as i2p:
+            # The statistics are written by a background thread
+            i2p.timer.start_dumping("stats.json", dropped=i2p.dropped)
             camera.start_recording(i2p, 'rgb')
             try:
                 while True:
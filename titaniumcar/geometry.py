@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+
+"""
+Geometry of the frames shared by the predictors:
+the ROI polygon, the resizing and the crop before the CNN.
+Everything is defined for a reference resolution then scaled
+and cached for the resolution of the frames actually received.
+"""
+
+class Geometry:
+    """
+    The ROI polygon is given in the coordinates of the reference frame.
+    The frame is resized to "target size + crop", then the crop removes
+    rows on the top and columns on the right to get the target size.
+
+    The masks and the scaled polygons are computed once per resolution.
+    """
+    def __init__(self, roi_poly, crop=(45, 5), target_size=(223, 69), reference=(456, 228)):
+        """
+        Attribute initialization
+
+        @param roi_poly: list of (x, y) coordinates of the roi in the reference frame
+        @param crop: number of (top rows, right columns) removed after the resizing
+        @param target_size: (width, height) of the image given to the CNN
+        @param reference: (width, height) of the frame where roi_poly is defined
+        """
+        self.roi_poly = np.array(roi_poly, dtype=np.float64)
+        self.crop = crop
+        self.target_size = target_size
+        self.reference = reference
+
+        # The size before the crop, (228, 114) by default: half of the reference frame
+        self.resized_size = (target_size[0] + crop[1], target_size[1] + crop[0])
+
+        # (height, width) -> cached values
+        self.polys = {}
+        self.masks = {}
+
+    @property
+    def target_shape(self):
+        """
+        Dimension of the cropped image in Numpy order
+
+        @return: (height, width) tuple
+        """
+        return self.target_size[1], self.target_size[0]
+
+    @property
+    def crop_slices(self):
+        """
+        Slices of the resized image to get the cropped one
+
+        @return: tuple of slices (rows, columns)
+        """
+        top, right = self.crop
+        return slice(top, None), slice(0, self.resized_size[0] - right)
+
+    def poly(self, shape):
+        """
+        The ROI polygon scaled for a resolution
+
+        @param shape: the shape of the frame (height, width, ...)
+        @return: int32 Numpy array of (x, y) coordinates
+        """
+        shape = tuple(shape[:2])
+        poly = self.polys.get(shape)
+        if poly is None:
+            height, width = shape
+            scale = (width / self.reference[0], height / self.reference[1])
+            poly = np.round(self.roi_poly * scale).astype(np.int32)
+            self.polys[shape] = poly
+        return poly
+
+    def mask(self, shape):
+        """
+        The ROI mask for a resolution, 255 inside and 0 outside
+
+        @param shape: the shape of the frame (height, width, ...)
+        @return: uint8 Numpy array of dimension (height, width), don't modify it
+        """
+        shape = tuple(shape[:2])
+        mask = self.masks.get(shape)
+        if mask is None:
+            mask = np.zeros(shape, np.uint8)
+            cv2.fillPoly(mask, (self.poly(shape),), 255)
+            self.masks[shape] = mask
+        return mask
+
+    def crop_top(self, shape):
+        """
+        The first row of the frame which survives the crop
+
+        @param shape: the shape of the frame (height, width, ...)
+        @return: row index in the frame
+        """
+        return int(self.crop[0] * shape[0] / self.resized_size[1])
+
+
+# Your ROI could be different depending of the camera orientation
+CNN_GEOMETRY = Geometry([(0, 131), (0, 228), (450, 228), (450, 131), (300, 94), (150, 94)])
+# The line detection uses a few more columns on the right
+HOUGH_GEOMETRY = Geometry([(0, 131), (0, 228), (454, 228), (454, 131), (300, 94), (150, 94)])
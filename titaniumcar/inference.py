@@ -0,0 +1,361 @@
+import numpy as np
+
+"""
+Inference backends for the CNN of deep_prediction.build_model.
+The quantized models are run by TFLiteBackend.
+Each backend has a "predict" method working like the Keras one:
+a float32 batch of dimension (n, 69, 223, 1) gives an array of dimension (n, 2).
+
+The models trained with Keras or PyTorch are exported by processes/export_model.py
+in a common format, run on the car without TensorFlow nor PyTorch:
+    - .npz : the 12 arrays in the Keras layout, run by NumpyBackend
+    - .onnx : the same graph for ONNX Runtime, run by OnnxBackend
+"""
+
+# Version of the .npz model files, saved in them
+MODEL_FORMAT_VERSION = 1
+
+def load_h5_weights(path):
+    """
+    Read the weights saved by Keras (save_weights or save)
+    without TensorFlow.
+    The order is the one of model.get_weights()
+
+    @param path: string path to the h5 file
+    @return: list of Numpy arrays
+    """
+    import h5py
+
+    def decode(name):
+        return name.decode("utf8") if isinstance(name, bytes) else name
+
+    weights = []
+    with h5py.File(path, "r") as f:
+        group = f["model_weights"] if "model_weights" in f else f
+        for layer_name in group.attrs["layer_names"]:
+            layer = group[decode(layer_name)]
+            for weight_name in layer.attrs["weight_names"]:
+                weights.append(np.array(layer[decode(weight_name)], dtype=np.float32))
+    return weights
+
+
+def save_model(path, weights, framework="keras"):
+    """
+    Write the weights in the common .npz format
+
+    @param path: string path to the npz file
+    @param weights: list of the 12 arrays in the order and the layout of model.get_weights()
+    @param framework: name of the framework of the training, kept for information
+    """
+    if len(weights) != 12:
+        raise ValueError("12 arrays expected, got {}".format(len(weights)))
+    arrays = {"weight_{:02d}".format(i): np.asarray(w, np.float32) for i, w in enumerate(weights)}
+    np.savez(path, version=MODEL_FORMAT_VERSION, framework=framework, **arrays)
+
+
+def load_model(path):
+    """
+    Read a file written by save_model
+
+    @param path: string path to the npz file
+    @return: list of the 12 Numpy arrays in the order of model.get_weights()
+    """
+    with np.load(path) as data:
+        version = int(data["version"])
+        if version > MODEL_FORMAT_VERSION:
+            raise ValueError("{} has the version {} of the model format, this code reads up to {}".format(
+                path, version, MODEL_FORMAT_VERSION))
+        names = sorted(name for name in data.files if name.startswith("weight_"))
+        return [np.array(data[name], np.float32) for name in names]
+
+
+class KerasBackend:
+    """
+    The Keras model with its TensorFlow session
+    """
+    def __init__(self, model, session=None):
+        """
+        Attribute initialization
+
+        @param model: the Keras model
+        @param session: the TensorFlow session of the model, Keras one if None
+        """
+        if session is None:
+            from tensorflow import keras
+            session = keras.backend.get_session()
+
+        self.model = model
+        self.session = session
+
+    def predict(self, batch):
+        """
+        Run the model
+
+        @param batch: a float32 Numpy array of dimension (n, 69, 223, 1)
+        @return: a Numpy array of dimension (n, 2)
+        """
+        with self.session.as_default():
+            return self.model.predict(batch)
+
+
+class NumpyBackend:
+    """
+    The forward pass of deep_prediction.build_model written with Numpy:
+        3 x (Conv2D 3x3 valid + relu, MaxPooling 2x2), Flatten,
+        Dense(50) + relu, Dense(8) + relu, Dense(2)
+
+    All the intermediate arrays are allocated once per batch size.
+    The returned array is overwritten by the next call with the same batch size.
+    """
+    def __init__(self, weights, input_shape=(69, 223, 1)):
+        """
+        Attribute initialization
+
+        @param weights: list of the 12 arrays in the order of model.get_weights()
+        @param input_shape: dimension of one image
+        """
+        if len(weights) != 12:
+            raise ValueError("12 arrays expected, got {}".format(len(weights)))
+
+        weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.convs = [(weights[i], weights[i+1]) for i in range(0, 6, 2)]
+        self.denses = [(weights[i], weights[i+1]) for i in range(6, 12, 2)]
+        self.input_shape = input_shape
+
+        # batch size -> dict of buffers
+        self.buffers = {}
+
+    @classmethod
+    def from_h5(cls, path):
+        """
+        Create the backend from weights saved by Keras
+
+        @param path: string path to the h5 file, like weights_last.h5
+        @return: a NumpyBackend
+        """
+        return cls(load_h5_weights(path))
+
+    @classmethod
+    def from_npz(cls, path):
+        """
+        Create the backend from a model exported by processes/export_model.py
+
+        @param path: string path to the npz file
+        @return: a NumpyBackend
+        """
+        return cls(load_model(path))
+
+    @classmethod
+    def from_keras(cls, model):
+        """
+        Create the backend from a built Keras model
+
+        @param model: the Keras model
+        @return: a NumpyBackend
+        """
+        return cls(model.get_weights())
+
+    def _allocate(self, n):
+        """
+        Create the buffers for a batch size
+
+        @param n: the batch size
+        @return: a dict of Numpy arrays
+        """
+        height, width, _ = self.input_shape
+        buffers = {"conv": [], "cols": [], "pool": [], "dense": []}
+        for kernel, _ in self.convs:
+            kh, kw, inputs, channels = kernel.shape
+            height, width = height - kh + 1, width - kw + 1
+            buffers["conv"].append(np.empty((n, height, width, channels), np.float32))
+            buffers["cols"].append(np.empty((n, height, width, kh*kw*inputs), np.float32))
+            height, width = height // 2, width // 2
+            buffers["pool"].append(np.empty((n, height, width, channels), np.float32))
+
+        for weight, _ in self.denses:
+            buffers["dense"].append(np.empty((n, weight.shape[1]), np.float32))
+
+        self.buffers[n] = buffers
+        return buffers
+
+    def predict(self, batch):
+        """
+        Run the forward pass
+
+        @param batch: a float32 Numpy array of dimension (n, 69, 223, 1)
+        @return: a Numpy array of dimension (n, 2)
+        """
+        n = batch.shape[0]
+        buffers = self.buffers.get(n)
+        if buffers is None:
+            buffers = self._allocate(n)
+
+        item = batch
+        for (kernel, bias), conv, cols, pool in zip(
+                self.convs, buffers["conv"], buffers["cols"], buffers["pool"]):
+            conv2d(item, kernel, bias, conv, cols)
+            np.maximum(conv, 0, out=conv)
+            max_pool2d(conv, pool)
+            item = pool
+
+        item = item.reshape(n, -1)
+        last = len(self.denses) - 1
+        for i, ((weight, bias), dense) in enumerate(zip(self.denses, buffers["dense"])):
+            np.matmul(item, weight, out=dense)
+            dense += bias
+            if i != last:
+                np.maximum(dense, 0, out=dense)
+            item = dense
+
+        return item
+
+
+class TFLiteBackend:
+    """
+    A model exported for TensorFlow Lite, in float32, float16 or int8 (see processes/quantize.py)
+
+    The lightweight tflite_runtime package is used if it is installed,
+    else the interpreter of TensorFlow.
+    The model has a batch size of 1, a batch is run image by image.
+    The returned array is overwritten by the next call with the same batch size.
+    """
+    def __init__(self, path):
+        """
+        Load the model and allocate its tensors
+
+        @param path: string path to the .tflite file
+        """
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+        # With an integer input, the image is quantized in this buffer
+        self.input_buffer = np.empty(self.input["shape"], self.input["dtype"])
+        # batch size -> output array
+        self.buffers = {}
+
+    def predict(self, batch):
+        """
+        Run the model on each image of the batch
+
+        @param batch: a float32 Numpy array of dimension (n, 69, 223, 1)
+        @return: a float32 Numpy array of dimension (n, 2)
+        """
+        n = batch.shape[0]
+        result = self.buffers.get(n)
+        if result is None:
+            result = np.empty((n,) + tuple(self.output["shape"][1:]), np.float32)
+            self.buffers[n] = result
+
+        in_scale, in_zero = self.input["quantization"]
+        out_scale, out_zero = self.output["quantization"]
+        for i in range(n):
+            if self.input_buffer.dtype == np.float32:
+                np.copyto(self.input_buffer[0], batch[i])
+            else:
+                info = np.iinfo(self.input_buffer.dtype)
+                quantized = np.clip(np.round(batch[i] / in_scale + in_zero), info.min, info.max)
+                np.copyto(self.input_buffer[0], quantized, casting="unsafe")
+
+            self.interpreter.set_tensor(self.input["index"], self.input_buffer)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output["index"])[0]
+
+            if output.dtype == np.float32:
+                result[i] = output
+            else:
+                result[i] = (output.astype(np.float32) - out_zero) * out_scale
+
+        return result
+
+
+class OnnxBackend:
+    """
+    A model exported to ONNX (see processes/export_model.py), run by ONNX Runtime.
+    Its input is the batch of the other backends, in the NHWC layout and between 0 and 1,
+    whatever the framework of the training.
+    """
+    def __init__(self, path, threads=None):
+        """
+        Load the model
+
+        @param path: string path to the .onnx file
+        @param threads: number of threads of an operator, chosen by ONNX Runtime if None
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        """
+        Run the model
+
+        @param batch: a float32 Numpy array of dimension (n, 69, 223, 1)
+        @return: a float32 Numpy array of dimension (n, 2)
+        """
+        return self.session.run(None, {self.input: batch.astype(np.float32, copy=False)})[0]
+
+
+def load_backend(path):
+    """
+    Choose the backend from the file extension
+
+    @param path: string path to Keras weights (.h5), an exported model (.npz or .onnx)
+                 or a TensorFlow Lite model (.tflite)
+    @return: a backend with a predict method
+    """
+    if path.endswith(".tflite"):
+        return TFLiteBackend(path)
+    if path.endswith(".onnx"):
+        return OnnxBackend(path)
+    if path.endswith(".npz"):
+        return NumpyBackend.from_npz(path)
+    return NumpyBackend.from_h5(path)
+
+
+def conv2d(image, kernel, bias, out, cols):
+    """
+    Valid convolution (correlation like Keras).
+    The windows are copied in "cols" (im2col), then a single matrix product is done.
+
+    @param image: Numpy array of dimension (n, h, w, c)
+    @param kernel: Numpy array of dimension (kh, kw, c, o)
+    @param bias: Numpy array of dimension (o,)
+    @param out: output Numpy array of dimension (n, h-kh+1, w-kw+1, o)
+    @param cols: buffer of dimension (n, h-kh+1, w-kw+1, kh*kw*c)
+    """
+    kh, kw, channels, outputs = kernel.shape
+    height, width = out.shape[1:3]
+
+    for i in range(kh):
+        for j in range(kw):
+            start = (i*kw + j) * channels
+            np.copyto(cols[..., start:start+channels], image[:, i:i+height, j:j+width, :])
+
+    np.matmul(cols.reshape(-1, kh*kw*channels), kernel.reshape(-1, outputs), out=out.reshape(-1, outputs))
+    out += bias
+
+
+def max_pool2d(image, out):
+    """
+    Max pooling 2x2 with a stride of 2, the last odd row/column is ignored like Keras
+
+    @param image: Numpy array of dimension (n, h, w, c)
+    @param out: output Numpy array of dimension (n, h//2, w//2, c)
+    """
+    height, width = out.shape[1:3]
+    np.maximum(image[:, 0:2*height:2, 0:2*width:2], image[:, 1:2*height:2, 0:2*width:2], out=out)
+    np.maximum(out, image[:, 0:2*height:2, 1:2*width:2], out=out)
+    np.maximum(out, image[:, 1:2*height:2, 1:2*width:2], out=out)
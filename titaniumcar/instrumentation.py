@@ -0,0 +1,176 @@
+import json
+import logging
+from threading import Thread, Event
+from time import monotonic
+
+import numpy as np
+
+"""
+Measures of the inference loop on the car, with a low overhead:
+the hot path only writes monotonic timestamps in a preallocated array.
+The statistics are computed on demand, or written in a file by a background thread.
+"""
+
+class StageTimer:
+    """
+    Timestamps of the stages of each frame, in a ring buffer.
+
+    A frame gets a row with begin (the first stage, the capture),
+    then each stage writes its end time with mark.
+    The oldest rows are overwritten after "capacity" frames.
+    """
+    def __init__(self, stages, capacity=1024):
+        """
+        Allocate the ring buffer
+
+        @param stages: list of the stage names, in the order of the loop, the first one is the capture
+        @param capacity: number of frames kept
+        """
+        self.stages = list(stages)
+        self.index = {name: i for i, name in enumerate(self.stages)}
+        self.capacity = capacity
+
+        self.times = np.full((capacity, len(self.stages)), np.nan)
+        # Number of frames begun
+        self.count = 0
+
+    def begin(self):
+        """
+        Start a frame, called at its arrival
+
+        @return: the row of the frame
+        """
+        row = self.count % self.capacity
+        times = self.times[row]
+        times.fill(np.nan)
+        times[0] = monotonic()
+        self.count += 1
+        return row
+
+    def mark(self, row, stage):
+        """
+        Save the end time of a stage
+
+        @param row: the row of the frame (from begin)
+        @param stage: the name of the stage
+        """
+        self.times[row, self.index[stage]] = monotonic()
+
+    def stats(self, dropped=0):
+        """
+        Statistics of the frames in the ring buffer
+
+        @param dropped: number of frames dropped by the pipeline
+        @return: dict with the number of frames, the fps, the dropped frames,
+                 and the p50/p99 durations in ms of each stage and of the whole loop
+        """
+        nb_rows = min(self.count, self.capacity)
+        times = self.times[:nb_rows].copy()
+
+        stats = {"frames": self.count, "dropped": dropped, "fps": 0.}
+        arrivals = np.sort(times[:, 0])
+        if nb_rows > 1 and arrivals[-1] > arrivals[0]:
+            stats["fps"] = (nb_rows - 1) / (arrivals[-1] - arrivals[0])
+
+        stats["stages"] = {}
+        durations = np.diff(times, axis=1)
+        for name, duration in zip(self.stages[1:], durations.T):
+            stats["stages"][name] = percentiles(duration)
+        stats["stages"]["total"] = percentiles(times[:, -1] - times[:, 0])
+
+        return stats
+
+    def report(self, dropped=0):
+        """
+        @param dropped: number of frames dropped by the pipeline
+        @return: a string with the statistics, one line per stage
+        """
+        stats = self.stats(dropped)
+        lines = ["{} frames, {:.1f} fps, {} dropped".format(stats["frames"], stats["fps"], stats["dropped"])]
+        for name, (p50, p99) in stats["stages"].items():
+            lines.append("  {:<20} p50 {:7.3f} ms  p99 {:7.3f} ms".format(name, p50, p99))
+        return "\n".join(lines)
+
+    def dump(self, path, dropped=0):
+        """
+        Write the statistics in a JSON file
+
+        @param path: string path to the file
+        @param dropped: number of frames dropped by the pipeline
+        """
+        with open(path, "w") as f:
+            json.dump(self.stats(dropped), f, indent=2)
+
+    def start_dumping(self, path, interval=5.0, dropped=None):
+        """
+        Write the statistics periodically from a background thread
+
+        @param path: string path to the JSON file, overwritten each time
+        @param interval: time in seconds between two writes
+        @param dropped: function returning the number of dropped frames, or None
+        @return: an Event to set to stop the thread
+        """
+        stop = Event()
+
+        def loop():
+            while not stop.wait(interval):
+                self.dump(path, dropped() if dropped is not None else 0)
+
+        Thread(target=loop, daemon=True).start()
+        return stop
+
+
+def percentiles(durations):
+    """
+    @param durations: Numpy array of durations in seconds, NaN for the unfinished frames
+    @return: the (p50, p99) in ms, NaN if there is no duration
+    """
+    durations = durations[~np.isnan(durations)]
+    if len(durations) == 0:
+        return float("nan"), float("nan")
+    p50, p99 = np.percentile(durations, [50, 99]) * 1000
+    return float(p50), float(p99)
+
+
+class RateLimitedLogger:
+    """
+    A replacement of the prints of the loops: at most one line per interval,
+    with fields written as key=value.
+    The lines skipped in between are counted in the next one.
+    """
+    def __init__(self, name, interval=1.0):
+        """
+        Attribute initialization
+
+        @param name: name of the logger (in the "titaniumcar" logger)
+        @param interval: minimum time in seconds between two lines
+        """
+        self.logger = logging.getLogger("titaniumcar." + name)
+        self.interval = interval
+        self.last = -float("inf")
+        self.skipped = 0
+
+    def log(self, message="", **fields):
+        """
+        Write a line if the last one is old enough
+
+        @param message: text at the beginning of the line
+        @param fields: values written as key=value
+        """
+        now = monotonic()
+        if now - self.last < self.interval:
+            self.skipped += 1
+            return
+
+        parts = [message] if message else []
+        for key, value in fields.items():
+            if isinstance(value, (float, np.floating)):
+                parts.append("{}={:.3f}".format(key, value))
+            else:
+                parts.append("{}={}".format(key, value))
+        if self.skipped:
+            parts.append("skipped={}".format(self.skipped))
+
+        self.logger.info(" ".join(parts))
+        self.last = now
+        self.skipped = 0
@@ -5,13 +5,46 @@ from collections import deque
 import math
 import time
 
-from picamera import PiCamera
-from picamera.array import PiRGBAnalysis
-from picamera.color import Color
+try:
+    from picamera import PiCamera
+    from picamera.array import PiRGBAnalysis
+    from picamera.color import Color
+except ImportError:
+    # Off the car (benchmarks on recorded videos), the frames are given by hand to analyze
+    class PiRGBAnalysis:
+        """
+        Minimal stand-in of picamera.array.PiRGBAnalysis
+        """
+        def __init__(self, camera, size=None):
+            self.camera = camera
+            self.size = size
+            
+        def close(self):
+            pass
 
 from car import Car
+from geometry import HOUGH_GEOMETRY
+from calibration import Remap
+from instrumentation import StageTimer, RateLimitedLogger
 
 class ProcessChain:
+    def __init__(self, geometry=HOUGH_GEOMETRY, calibration=None):
+        """
+        Attribute initialization
+        
+        @param geometry: a Geometry object with the roi
+        @param calibration: a calibration.Calibration object to correct the lens
+                            in the ROI selection, None for no correction
+        """
+        self.geometry = geometry
+        # The frame keeps its size, the lines are detected in the undistorted frame.
+        # The perspective is not applied: the thresholds of HoughLinesP and the range
+        # of the convergence point are tuned on the perspective view of the camera
+        if calibration is not None:
+            self.remap = Remap(calibration.undistortion(), geometry, resize=False)
+        else:
+            self.remap = None
+        
     def canny_trsf(self, image):
         """
         Applying a gaussian Blur to smooth the image
@@ -28,22 +61,15 @@ class ProcessChain:
     def region_of_interest(self, image):
         """
         Set to (0, 0, 0) each pixel outside the roi
+        The mask is drawn once per resolution by the geometry
+        With a calibration, the undistorted frame is computed in the roi
 
         @param image: a grayscale OpenCV image
         @return: the image with only roi
         """
-        height = image.shape[0]
-        # coordinates of the roi
-        poly = np.array([
-            (0, 131),
-            (0, height),
-            (454, height),
-            (454, 131),
-            (300, 94),
-            (150, 94)
-        ])
-        mask = np.zeros_like(image)
-        cv2.fillPoly(mask, (poly,), 255)
+        if self.remap is not None:
+            return self.remap(image)
+        mask = self.geometry.mask(image.shape)
         masked_image = cv2.bitwise_and(image, mask)
         return masked_image
         
@@ -68,29 +94,24 @@ class ProcessChain:
         if lines is None:
             return None
 
-        lenghts = np.array([])
-        origins = np.array([])
-        nb_ignored = 0
-        
-        for line in lines:
-            # get lenght of the line
-            # and coordinate of intersection of line and abscissa
-            x1, y1, x2, y2 = line.reshape(4)
-            if y1 == y2:
-                continue
-            
-            a = (x1-x2)/(y1-y2)
-            b = x1 - a*y1
-            
-            lenght = np.sqrt(np.square(x1-x2)+np.square(y1-y2))
-            # if intersection point if too away, remove it
-            if 0-300 < b < 456+300:
-                origins = np.append(origins, b)
-                lenghts = np.append(lenghts, lenght)
-            # when length is too small, the uncertainty of the direction is too large 
-            # so, just increment counter
-            elif lenght > 75:
-                nb_ignored += 1
+        x1, y1, x2, y2 = np.asarray(lines).reshape(-1, 4).T
+        # horizontal lines never cross the abscissa
+        not_horizontal = y1 != y2
+        x1, y1, x2, y2 = x1[not_horizontal], y1[not_horizontal], x2[not_horizontal], y2[not_horizontal]
+        
+        # get lenght of the lines
+        # and coordinate of intersection of lines and abscissa
+        a = (x1-x2)/(y1-y2)
+        b = x1 - a*y1
+        lenght = np.sqrt(np.square(x1-x2)+np.square(y1-y2))
+        
+        # if intersection point if too away, remove it
+        in_range = (0-300 < b) & (b < 456+300)
+        origins = b[in_range]
+        lenghts = lenght[in_range]
+        # when length is too small, the uncertainty of the direction is too large 
+        # so, just count the long ones
+        nb_ignored = np.count_nonzero(~in_range & (lenght > 75))
         
         if len(origins) == 0:
             return None
@@ -103,38 +124,56 @@ class ProcessChain:
                 pt_mean *= 1 + nb_ignored / 3
             return  pt_mean
 
-    def transform(self, image):
+    # The names of the steps for instrumentation.StageTimer
+    stages = ["canny", "roi", "hough", "line_process"]
+
+    def transform(self, image, timer=None, row=None):
         """
         Apply all transformations
         
         @param image: a OpenCV image of dimension (456, 228, 3)
+        @param timer: a StageTimer where the end of each step is saved, or None
+        @param row: the row of the frame in the timer
         @return: mean direction of the edges of the circuit (float)
         """
         image = self.canny_trsf(image)
+        if timer is not None:
+            timer.mark(row, "canny")
         image = self.region_of_interest(image)
+        if timer is not None:
+            timer.mark(row, "roi")
         lines = self.detect_lines(image)
+        if timer is not None:
+            timer.mark(row, "hough")
         
-        return self.line_process(lines)
+        point = self.line_process(lines)
+        if timer is not None:
+            timer.mark(row, "line_process")
+        return point
 
 class Image2Prediction(PiRGBAnalysis):
     """
     Wrap the whole process from frame to apply predicted speed and direction
     """
-    def __init__(self, camera, car):
+    def __init__(self, camera, car, calibration=None):
         """
         Initialization of the attributes
         and create preprocess pipeline with ProcessChain class
         
         @param camera: PiCamera instance
         @param car: instance of Chassis or a child class
+        @param calibration: a calibration.Calibration object to correct the lens, or None
+                            (its perspective is not used, see ProcessChain)
         """
         super().__init__(camera)
         self.done = False
         self.car = car
-        self.default_direction = direction
         
-        self.process = ProcessChain()
+        self.process = ProcessChain(calibration=calibration)
         self.queue = deque([0 for _ in range(12)])
+        
+        self.timer = StageTimer(["capture"] + ProcessChain.stages + ["apply"])
+        self.log = RateLimitedLogger("line_prediction")
     
     def analyze(self, frame):
         """
@@ -146,16 +185,18 @@ class Image2Prediction(PiRGBAnalysis):
         
         @param frame: a Numpy array usable like a OpenCV image
         """
-        pt = self.process.transform(frame)
+        row = self.timer.begin()
+        pt = self.process.transform(frame, self.timer, row)
         if pt is not None:
             dir_prediction, speed_prediction = self.predict(pt)
             self.car.set_direction(dir_prediction)
-            print(dir_prediction, speed_prediction)
         else:
+            dir_prediction = None
             speed_prediction = 0.33
-            print("None 0.33")
             
-        self.car.set_speed(speed_prediction, force=True)  
+        self.car.set_speed(speed_prediction)
+        self.timer.mark(row, "apply")
+        self.log.log(direction=dir_prediction, speed=speed_prediction)
         
 
     def predict(self, x, shape=(228, 456)):
@@ -193,14 +234,16 @@ class Image2Prediction(PiRGBAnalysis):
         
         # magic formula
         p_speed = 1 - (np.abs(dA)*0.9)
-        print(p_speed)
         
         # p_speed *= 1-(np.abs(dA-dB)/2)**0.8
                 
-        return p_dir, p_speedmain
+        return p_dir, p_speed
 
 
 if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    
     car = Car().start()
     car.set_speed(1)
 
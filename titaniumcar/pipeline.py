@@ -0,0 +1,209 @@
+import logging
+from threading import Thread, Condition, Lock
+
+"""
+Run the steps from a camera frame to the car commands on separate threads.
+Between two stages, there is only one slot: the newest item always replaces
+the one which is waiting, so a slow stage works on the latest frame and
+never on a queue of stale frames.
+
+An exception in a stage stops the pipeline: it is logged, the slots are closed,
+the failure hook is called once (to stop the car) and the exception is raised
+again by the next put or stop. The other stages may still be finishing their
+current item: the hook must make the stop sticky (see Image2Prediction.stop_car).
+"""
+
+class LatestSlot:
+    """
+    A bounded queue of size 1 where the latest item wins.
+
+    The items replaced before being read are dropped and counted.
+    """
+    def __init__(self):
+        """
+        Attribute initialization
+        """
+        self.cond = Condition()
+        self.item = None
+        self.full = False
+        self.closed = False
+
+        self.put_count = 0
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Store the item, the waiting one (if any) is dropped
+
+        @param item: any object
+        @return: True if an older item was dropped
+        """
+        with self.cond:
+            dropped = self.full
+            if dropped:
+                self.dropped += 1
+            self.item = item
+            self.full = True
+            self.put_count += 1
+            self.cond.notify()
+        return dropped
+
+    def get(self, timeout=None):
+        """
+        Wait for an item and take it
+
+        @param timeout: maximum waiting time in seconds, None to wait forever
+        @return: the item, None if the slot is closed or after the timeout
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.full or self.closed, timeout):
+                return None
+            if not self.full:
+                return None
+            item = self.item
+            self.item = None
+            self.full = False
+            return item
+
+    def close(self):
+        """
+        Wake up the reader, the next get returns None
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Pipeline:
+    """
+    Chain callables on their own threads, linked by LatestSlot objects.
+
+    The input of the first stage is given with put (from the camera thread).
+    The return of a stage is the input of the next one.
+    If a stage returns None, nothing is passed to the next stage.
+    The return of the last stage is ignored.
+    """
+    def __init__(self, stages, on_error=None):
+        """
+        Attribute initialization
+
+        @param stages: list of callables with one argument
+        @param on_error: callable with the exception as argument, called once
+                         on the thread of the stage which failed, or None
+        """
+        self.stages = stages
+        self.on_error = on_error
+        self.slots = [LatestSlot() for _ in stages]
+        self.threads = []
+        self.log = logging.getLogger("titaniumcar.pipeline")
+
+        # The first failure: (index of the stage, exception), None while everything works
+        self.error = None
+        self.error_lock = Lock()
+
+    def start(self):
+        """
+        Start a thread for each stage
+
+        Return the object to chain the declaration and the start
+        pipeline = Pipeline(stages).start()
+
+        @return: itself after start
+        """
+        for i, stage in enumerate(self.stages):
+            thread = Thread(target=self._stage_loop, args=(i, stage), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def _stage_loop(self, i, stage):
+        """
+        Take the latest input, process it and give it to the next stage
+
+        @param i: index of the stage
+        @param stage: the callable
+        """
+        slot = self.slots[i]
+        if i + 1 < len(self.slots):
+            next_slot = self.slots[i + 1]
+        else:
+            next_slot = None
+
+        while True:
+            item = slot.get()
+            if item is None:
+                break
+
+            try:
+                item = stage(item)
+            except Exception as error:
+                self._fail(i, error)
+                break
+
+            if item is not None and next_slot is not None:
+                next_slot.put(item)
+
+    def _fail(self, i, error):
+        """
+        Log the failure of a stage, close the slots and call the failure hook,
+        only for the first failure
+
+        @param i: index of the stage
+        @param error: the exception raised by the stage
+        """
+        self.log.exception("stage %d failed, the pipeline is stopped", i)
+        with self.error_lock:
+            if self.error is not None:
+                return
+            self.error = (i, error)
+
+        # No new item is given to the stages before the hook
+        for slot in self.slots:
+            slot.close()
+        if self.on_error is not None:
+            try:
+                self.on_error(error)
+            except Exception:
+                self.log.exception("the failure hook of the pipeline failed")
+
+    def _raise_error(self):
+        """
+        Raise the failure of a stage in the thread of the caller
+        """
+        if self.error is not None:
+            i, error = self.error
+            raise RuntimeError("stage {} of the pipeline failed: {!r}".format(i, error)) from error
+
+    def put(self, item):
+        """
+        Give a new input to the first stage
+
+        @param item: any object except None
+        @return: True if an older input was dropped
+        @raise RuntimeError: if a stage has failed
+        """
+        self._raise_error()
+        return self.slots[0].put(item)
+
+    def stop(self, timeout=1):
+        """
+        Close the slots and wait for the threads
+
+        @param timeout: maximum waiting time in seconds for each thread
+        @raise RuntimeError: if a stage has failed
+        """
+        for slot in self.slots:
+            slot.close()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self._raise_error()
+
+    @property
+    def dropped(self):
+        """
+        Number of dropped items in front of each stage
+
+        @return: list of integers
+        """
+        return [slot.dropped for slot in self.slots]
@@ -0,0 +1,114 @@
+from collections import deque
+from time import monotonic, perf_counter, sleep
+
+"""
+PWM drivers used by car.Chassis.
+Each driver has the methods of Adafruit_PCA9685.PCA9685 used by the car:
+set_pwm_freq and set_pwm.
+"""
+
+class PCA9685Driver:
+    """
+    The real PCA9685 on the I2C bus of the Raspberry Pi
+    """
+    def __init__(self, frequency=60):
+        """
+        Connection initialization with servos
+
+        @param frequency: PWM frequency in Hz
+        """
+        from Adafruit_PCA9685 import PCA9685
+
+        self.chip = PCA9685()
+        self.set_pwm_freq(frequency)
+
+    def set_pwm_freq(self, frequency):
+        """
+        @param frequency: PWM frequency in Hz
+        """
+        self.chip.set_pwm_freq(frequency)
+
+    def set_pwm(self, channel, on, off):
+        """
+        @param channel: the output pin (0 to 15)
+        @param on: tick (0 to 4095) when the signal goes high
+        @param off: tick (0 to 4095) when the signal goes low
+        """
+        self.chip.set_pwm(channel, on, off)
+
+
+class SimulatedPCA9685:
+    """
+    An in-process PCA9685 to run the car without the hardware.
+
+    The last writes are recorded with their monotonic timestamp,
+    and each one takes the time of an I2C write (latency).
+    """
+    def __init__(self, frequency=60, latency=0.0005, history=10000):
+        """
+        Attribute initialization
+
+        @param frequency: PWM frequency in Hz
+        @param latency: duration of a write in seconds
+        @param history: number of writes kept per channel
+        """
+        self.frequency = frequency
+        self.latency = latency
+        self.history = history
+
+        # channel -> deque of the last (timestamp, on, off)
+        self.writes = {}
+        # channel -> number of writes
+        self.counts = {}
+        # channel -> last off value
+        self.values = {}
+
+    def set_pwm_freq(self, frequency):
+        """
+        @param frequency: PWM frequency in Hz
+        """
+        self.frequency = frequency
+
+    def set_pwm(self, channel, on, off):
+        """
+        Record the write and wait for the simulated latency
+
+        @param channel: the output pin (0 to 15)
+        @param on: tick (0 to 4095) when the signal goes high
+        @param off: tick (0 to 4095) when the signal goes low
+        """
+        self._wait(self.latency)
+        if channel not in self.writes:
+            self.writes[channel] = deque(maxlen=self.history)
+            self.counts[channel] = 0
+        self.writes[channel].append((monotonic(), on, off))
+        self.counts[channel] += 1
+        self.values[channel] = off
+
+    def _wait(self, duration):
+        """
+        sleep is too coarse for sub-millisecond delays, so they are busy-waited
+
+        @param duration: time in seconds
+        """
+        if duration <= 0:
+            return
+        if duration >= 0.002:
+            sleep(duration)
+            return
+        end = perf_counter() + duration
+        while perf_counter() < end:
+            pass
+
+    def summary(self):
+        """
+        @return: dict channel -> (number of writes, mean interval between the last writes in seconds)
+        """
+        result = {}
+        for channel, writes in self.writes.items():
+            if len(writes) > 1:
+                interval = (writes[-1][0] - writes[0][0]) / (len(writes) - 1)
+            else:
+                interval = 0.
+            result[channel] = (self.counts[channel], interval)
+        return result
@@ -1,11 +1,10 @@
-from Adafruit_PCA9685 import PCA9685
+from pwm import PCA9685Driver
 
 """
 Use this script to stop the car.
 """
 
-pwm = PCA9685()
-pwm.set_pwm_freq(60)
+pwm = PCA9685Driver(60)
 
 pwm.set_pwm(15, 0, 410) # dir
 pwm.set_pwm(5, 0, 390) # speed